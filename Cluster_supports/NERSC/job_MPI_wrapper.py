@@ -1,24 +1,222 @@
 #!/usr/bin/env python3
+"""
+    This script runs the event folders of a job with MPI. Rank 0 is the
+    master: it hands out event folders to the worker ranks on request until
+    the queue is empty or the walltime deadline is too close to start a new
+    event. At the end it reports the utilisation of every rank.
+
+    Local test with a stub command:
+        mpirun -np 4 python3 job_MPI_wrapper.py --command "sleep 1"
+"""
 
 from mpi4py import MPI
-from subprocess import call
-import sys
-from os import chdir
-
-def print_Usage():
-    print("Usage: {} n_threads job_id0 ".format(sys.argv[0]))
-
-try:
-    n_threads = int(sys.argv[1])
-    job_id    = int(sys.argv[2])
-except IndexError:
-    print_Usage()
-    exit(0)
-
-comm = MPI.COMM_WORLD
-size = comm.Get_size()
-rank = comm.Get_rank()
-
-event_id = rank + n_threads*(job_id - 1)
-chdir("event_{}".format(event_id))
-call("bash submit_job.script {}".format(rank), shell=True)
+from subprocess import call, check_output, SubprocessError
+from os import path
+from glob import glob
+import argparse
+import json
+import os
+import re
+import time
+
+TAG_READY = 1
+TAG_WORK = 2
+TAG_STOP = 3
+
+
+def walltime_to_seconds(walltime):
+    """This function converts a HH:MM:SS walltime string to seconds"""
+    seconds = 0
+    for field in walltime.split(":"):
+        seconds = 60*seconds + int(field)
+    return(seconds)
+
+
+def get_allocation_deadline(walltime=""):
+    """
+        This function returns the end time of the Slurm allocation (epoch
+        seconds), from $SLURM_JOB_END_TIME, squeue, or the start time of the
+        job plus the walltime. Outside Slurm, the walltime is counted from
+        now, and without it there is no deadline.
+    """
+    if os.environ.get("SLURM_JOB_END_TIME", "").isdigit():
+        return(float(os.environ["SLURM_JOB_END_TIME"]))
+    job_id = os.environ.get("SLURM_JOB_ID", "")
+    if job_id != "":
+        try:
+            end_time = check_output(
+                ["squeue", "-h", "-j", job_id, "-o", "%e"],
+                encoding='utf-8', timeout=30).strip()
+            return(time.mktime(time.strptime(end_time, "%Y-%m-%dT%H:%M:%S")))
+        except (OSError, SubprocessError, ValueError) as e:
+            print("\U0001F6AB  Can not read the end of job {}: {}".format(
+                  job_id, e), flush=True)
+    if walltime == "":
+        return(float("inf"))
+    start_time = os.environ.get("SLURM_JOB_START_TIME", "")
+    if start_time.isdigit():
+        return(float(start_time) + walltime_to_seconds(walltime))
+    return(time.time() + walltime_to_seconds(walltime))
+
+
+def get_event_folder_list(pattern):
+    """This function lists the event folders sorted by their event id"""
+    folder_list = [folder for folder in glob(pattern) if path.isdir(folder)]
+
+    def event_index(folder):
+        numbers = re.findall(r"\d+", path.basename(folder))
+        return((int(numbers[-1]) if numbers else -1, folder))
+
+    return(sorted(folder_list, key=event_index))
+
+
+def run_task(folder_list, command, rank):
+    """This function runs the command in each folder of a task"""
+    status = 0
+    env = dict(os.environ, MPI_WORKER_RANK=str(rank))
+    for folder in folder_list:
+        print("[rank {}] {}: running {} ...".format(rank, time.asctime(),
+                                                    folder), flush=True)
+        status_i = call(command, shell=True, cwd=folder, env=env)
+        if status_i != 0:
+            print("[rank {}] {} exited with status {}".format(
+                  rank, folder, status_i), flush=True)
+            status = status_i
+    return(status)
+
+
+def run_master(comm, task_list, deadline, margin):
+    """
+        This function dispatches the tasks to the workers. A new task is
+        only started if it is expected to finish before the deadline
+        (epoch seconds), using the mean duration of the finished tasks.
+    """
+    n_workers = comm.Get_size() - 1
+    n_active = n_workers
+    durations = []
+    n_skipped = 0
+    mpi_status = MPI.Status()
+    while n_active > 0:
+        # poll instead of blocking, so the master does not spin a core
+        if not comm.Iprobe(source=MPI.ANY_SOURCE, tag=TAG_READY,
+                           status=mpi_status):
+            time.sleep(0.05)
+            continue
+        worker = mpi_status.Get_source()
+        report = comm.recv(source=worker, tag=TAG_READY)
+        if report is not None:
+            durations.append(report['duration'])
+        expected = sum(durations)/len(durations) if durations else 0.
+        remaining = deadline - time.time()
+        if task_list and remaining > margin + expected:
+            comm.send(task_list.pop(0), dest=worker, tag=TAG_WORK)
+        else:
+            if task_list and remaining <= margin + expected:
+                n_skipped = len(task_list)
+            comm.send(None, dest=worker, tag=TAG_STOP)
+            n_active -= 1
+    if n_skipped > 0:
+        print("\U0001F6AB  {} tasks were not started ".format(n_skipped)
+              + "before the walltime deadline", flush=True)
+
+
+def run_worker(comm, command, rank):
+    """This function asks the master for tasks and runs them"""
+    busy_time = 0.
+    n_tasks = 0
+    report = None
+    while True:
+        comm.send(report, dest=0, tag=TAG_READY)
+        mpi_status = MPI.Status()
+        folder_list = comm.recv(source=0, tag=MPI.ANY_TAG, status=mpi_status)
+        if mpi_status.Get_tag() == TAG_STOP:
+            break
+        task_start = time.time()
+        status = run_task(folder_list, command, rank)
+        duration = time.time() - task_start
+        busy_time += duration
+        n_tasks += 1
+        report = {'duration': duration, 'status': status}
+    return({'rank': rank, 'busy_time': busy_time, 'n_tasks': n_tasks})
+
+
+def print_utilisation(stats_list, elapsed, report_file=""):
+    """This function prints the utilisation of the worker ranks"""
+    print("\U0001F3CE  Elapsed time: {:.1f} s".format(elapsed))
+    print("{:>6s} {:>8s} {:>12s} {:>12s}".format("rank", "tasks", "busy [s]",
+                                                  "utilisation"))
+    for stats in stats_list:
+        stats['utilisation'] = stats['busy_time']/max(elapsed, 1e-6)
+        print("{:>6d} {:>8d} {:>12.1f} {:>11.1f}%".format(
+              stats['rank'], stats['n_tasks'], stats['busy_time'],
+              100.*stats['utilisation']))
+    if stats_list:
+        mean_utilisation = (sum([stats['utilisation'] for stats in stats_list])
+                            / len(stats_list))
+        print("Mean utilisation of the workers: {:.1f}%".format(
+              100.*mean_utilisation), flush=True)
+    if report_file != "":
+        with open(report_file, "w") as f:
+            json.dump({'elapsed': elapsed, 'ranks': stats_list}, f, indent=4)
+
+
+def main():
+    """This is the main function"""
+    parser = argparse.ArgumentParser(
+        description='\U0001F3B6 Dispatch the event folders over MPI ranks')
+    parser.add_argument('--pattern', type=str, default="event_*",
+                        help='glob pattern of the event folders')
+    parser.add_argument('--command', type=str,
+                        default="bash submit_job.script",
+                        help='command run inside each event folder')
+    parser.add_argument('--chunk', type=int, default=1,
+                        help='number of event folders per request')
+    parser.add_argument('--walltime', type=str, default="",
+                        help=('walltime of the allocation (HH:MM:SS), no '
+                              + 'new event is started too close to its end; '
+                              + 'only used if the end time of the Slurm job '
+                              + 'is unknown'))
+    parser.add_argument('--margin', type=float, default=300.,
+                        help='seconds kept free before the walltime')
+    parser.add_argument('--report', type=str, default="",
+                        help='json file for the utilisation report')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    comm = MPI.COMM_WORLD
+    size = comm.Get_size()
+    rank = comm.Get_rank()
+
+    if rank == 0:
+        deadline = get_allocation_deadline(args.walltime)
+        if deadline < float("inf"):
+            print("\U0001F3B6  The allocation ends at {}".format(
+                  time.ctime(deadline)), flush=True)
+        folder_list = get_event_folder_list(args.pattern)
+        chunk = max(1, args.chunk)
+        task_list = [folder_list[i:i + chunk]
+                     for i in range(0, len(folder_list), chunk)]
+        print("\U0001F3B6  {} event folders in {} tasks on {} workers".format(
+              len(folder_list), len(task_list), max(1, size - 1)), flush=True)
+        if size == 1:
+            # no workers, run everything on this rank
+            stats = {'rank': 0, 'busy_time': 0., 'n_tasks': 0}
+            for folder_list_i in task_list:
+                if deadline - time.time() < args.margin:
+                    break
+                task_start = time.time()
+                run_task(folder_list_i, args.command, rank)
+                stats['busy_time'] += time.time() - task_start
+                stats['n_tasks'] += 1
+            print_utilisation([stats], time.time() - start_time, args.report)
+            return
+        run_master(comm, task_list, deadline, args.margin)
+        stats_list = comm.gather(None, root=0)[1:]
+        print_utilisation(stats_list, time.time() - start_time, args.report)
+    else:
+        stats = run_worker(comm, args.command, rank)
+        comm.gather(stats, root=0)
+
+
+if __name__ == "__main__":
+    main()
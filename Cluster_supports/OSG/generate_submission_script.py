@@ -2,10 +2,15 @@
 """This script generates the job submission script on OSG"""
 
 
+import os
 import sys
 from os import path, makedirs
 import random
 
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                             "../../utilities"))
+from cost_model import plan_job_from_parameters
+
 FILENAME = "singularity.submit"
 
 def print_usage():
@@ -13,6 +18,9 @@ def print_usage():
     print("Usage: {} ".format(sys.argv[0].split("/")[-1])
           + "Njobs Nevents_per_job SingularityImage ParameterFile jobId "
           + "[bayesFile]")
+    print("Nevents_per_job = 0 lets the cost model choose it. The memory and "
+          + "disk requests are predicted by the cost model, calibrated with "
+          + "the resource_usage_*.json files in $COST_HISTORY.")
 
 
 def write_submission_script(para_dict_):
@@ -67,14 +75,14 @@ periodic_release = ((HoldReasonCode == 13 || HoldReasonCode == 26) && (time() -
 # Send the job to Held state on failure.
 on_exit_hold = (ExitBySignal == True) || (ExitCode != 0)
 
-# The below are good base requirements for first testing jobs on OSG,
-# if you don't have a good idea of memory and disk usage.
+# The memory and disk requests are predicted by the cost model
 request_cpus = 1
-request_memory = 2 GB
-request_disk = 2 GB
+request_memory = {1} GB
+request_disk = {2} GB
 
 # Queue one job with the above specifications.
-queue {0}""".format(para_dict_["n_jobs"]))
+queue {0}""".format(para_dict_["n_jobs"], para_dict_["memory_gb"],
+                    para_dict_["disk_gb"]))
     script.close()
 
 
@@ -143,6 +151,16 @@ if __name__ == "__main__":
         print_usage()
         exit(0)
 
+    # size the jobs with the cost model
+    sys.path.insert(0, path.dirname(path.abspath(PARAMFILE)))
+    parameter_dict = __import__(PARAMFILE.split('.py')[0].split("/")[-1])
+    history_list = []
+    if os.environ.get("COST_HISTORY", "") != "":
+        history_list = os.environ["COST_HISTORY"].split(":")
+    job_plan = plan_job_from_parameters(parameter_dict, 1, N_EVENTS_PER_JOBS,
+                                        history_list, "20:00:00")
+    N_EVENTS_PER_JOBS = job_plan['n_events']
+
     para_dict = {
         'n_jobs': N_JOBS,
         'n_events_per_job': N_EVENTS_PER_JOBS,
@@ -152,6 +170,8 @@ if __name__ == "__main__":
         'job_id': JOBID,
         'bayesFlag': bayesFlag,
         'bayesFile': bayesFile,
+        'memory_gb': job_plan['memory_gb'],
+        'disk_gb': job_plan['disk_gb'],
     }
 
     main(para_dict)
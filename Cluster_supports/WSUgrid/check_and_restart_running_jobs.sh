@@ -1,6 +1,6 @@
 #!/usr/bin/env bash
 
-usage="./check_running_jobs.sh FolderName"
+usage="./check_and_restart_running_jobs.sh FolderName"
 
 jobFolder=$1
 
@@ -14,26 +14,6 @@ jobFolder=${jobFolder%"/"}
 
 echo "checking jobs in " ${jobFolder}
 
-for ijob in `ls --color=none ${jobFolder} | grep "event" `;
-do
-    eventsPath=${jobFolder}/${ijob}
-    job_idstr=`cat ${eventsPath}/job_id`
-    if [[ ${job_idstr} == "" ]]
-    then
-        job_status="F"
-    else
-        output=`qstat -x -n1 ${job_idstr} | tail -n 1`
-        job_status=`echo ${output} | awk {'print $10'}`
-    fi
-    if [[ ${job_status} == "F" ]]
-    then
-        echo "Job finished, restarting ..."
-        (
-            cd ${eventsPath}
-            qsub -q wsuq submit_job.pbs > job_id
-        )
-    else
-        echo ${output}
-    fi
-done
-
+# one qstat call for all the jobs, the finished jobs without results are
+# resubmitted (see job_monitor.py --help for the daemon mode and Slurm)
+python3 $(dirname $0)/job_monitor.py ${jobFolder} --scheduler pbs --queue wsuq --once
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+    This script monitors the jobs of a working folder and restarts the
+    ones which are stuck or failed. Each polling cycle queries the
+    scheduler once for all the jobs (PBS: qstat -x -f, Slurm: squeue, and
+    sacct for the jobs which left the queue), and then applies the
+    restart policies in bulk:
+        suspended for longer than --suspend_hours:   cancel and resubmit
+        held:                                        release
+        finished or unsubmitted without the results
+        of all its events:                           resubmit
+    The job id of every event folder is read from its job_id file, and
+    the events of the job from its submit_job.script. The time a job is
+    first seen suspended is kept in job_monitor_state.json. The scheduler
+    commands can be replaced, e.g. by a fake scheduler for testing, with
+    the --*_command options.
+
+    Usage: job_monitor.py workFolder [--scheduler slurm] [--once]
+"""
+
+import argparse
+import json
+import shlex
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from glob import glob
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..", "..",
+                             "utilities"))
+from resubmit_missing_events import check_results_file, read_job_event_ids
+
+DEFAULT_COMMANDS = {
+    'pbs': {
+        'query': "qstat -x -f",
+        'history': "",
+        'cancel': "qdel",
+        'release': "qrls",
+        'submit': "qsub",
+        'job_script': "submit_job.pbs",
+    },
+    'slurm': {
+        'query': "squeue -h --me -o %i|%T|%r",
+        'history': "sacct -n -P -X -o JobID,State,Reason -j",
+        'cancel': "scancel",
+        'release': "scontrol release",
+        'submit': "sbatch",
+        'job_script': "submit_job.script",
+    },
+}
+
+PBS_STATES = {
+    'Q': "queued", 'W': "queued", 'T': "queued", 'B': "running",
+    'R': "running", 'E': "running", 'S': "suspended", 'U': "suspended",
+    'H': "held", 'F': "finished", 'X': "finished",
+}
+
+SLURM_STATES = {
+    'PENDING': "queued", 'CONFIGURING': "queued", 'REQUEUED': "queued",
+    'RUNNING': "running", 'COMPLETING': "running", 'SUSPENDED': "suspended",
+    'STOPPED': "suspended", 'REQUEUE_HOLD': "held", 'COMPLETED': "finished",
+    'FAILED': "finished", 'TIMEOUT': "finished", 'CANCELLED': "finished",
+    'NODE_FAIL': "finished", 'OUT_OF_MEMORY': "finished",
+    'PREEMPTED': "finished", 'BOOT_FAIL': "finished",
+    'DEADLINE': "finished",
+}
+
+STATE_FILENAME = "job_monitor_state.json"
+
+
+def run_command(command, arguments=(), cwd=None):
+    """This function runs a scheduler command and returns its stdout"""
+    result = subprocess.run(shlex.split(command) + list(arguments), cwd=cwd,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    if result.returncode != 0 and result.stderr.strip() != "":
+        print("\U0001F6AB  {}: {}".format(command, result.stderr.strip()))
+    return(result.stdout)
+
+
+def short_job_id(job_id):
+    """This function strips the server name from a job id"""
+    return(job_id.strip().split(".")[0])
+
+
+def parse_qstat_full(output):
+    """
+        This function parses the output of qstat -x -f into a table
+        job id -> {'state'}
+    """
+    state_table = {}
+    job_id = None
+    for line_i in output.split("\n"):
+        if line_i.startswith("Job Id:"):
+            job_id = short_job_id(line_i.split(":", 1)[1])
+            state_table[job_id] = {'state': "unknown"}
+            continue
+        if job_id is None or "=" not in line_i:
+            continue
+        key, value = [field.strip() for field in line_i.split("=", 1)]
+        if key == "job_state":
+            state_table[job_id]['state'] = PBS_STATES.get(value, "unknown")
+    return(state_table)
+
+
+def parse_slurm_table(output):
+    """
+        This function parses the "id|state|reason" lines of squeue and
+        sacct into a table job id -> {'state'}
+    """
+    state_table = {}
+    for line_i in output.split("\n"):
+        fields = line_i.strip().split("|")
+        if len(fields) < 3:
+            continue
+        job_id = short_job_id(fields[0])
+        state = SLURM_STATES.get(fields[1].split()[0], "unknown")
+        if state == "queued" and "Held" in fields[2]:
+            state = "held"
+        state_table[job_id] = {'state': state}
+    return(state_table)
+
+
+def query_scheduler(job_id_list, scheduler, commands):
+    """
+        This function queries the states of all the jobs, with one query
+        command and (for Slurm) one history command for the jobs which are
+        no longer in the queue
+    """
+    if not job_id_list:
+        return({})
+    if scheduler == "pbs":
+        return(parse_qstat_full(run_command(commands['query'], job_id_list)))
+    state_table = parse_slurm_table(run_command(commands['query']))
+    missing_list = [job_id for job_id in job_id_list
+                    if job_id not in state_table]
+    if missing_list and commands['history'] != "":
+        state_table.update(parse_slurm_table(
+            run_command(commands['history'], [",".join(missing_list)])))
+    return(state_table)
+
+
+def read_job_folders(work_folder):
+    """
+        This function returns the event folders of the working folder with
+        their job ids ("" if the job was never submitted)
+    """
+    job_folder_list = []
+    for folder in sorted(glob(path.join(work_folder, "event_*"))):
+        if not path.isdir(folder):
+            continue
+        job_id = ""
+        if path.isfile(path.join(folder, "job_id")):
+            with open(path.join(folder, "job_id"), "r") as f:
+                job_id = short_job_id(f.read())
+        job_folder_list.append((folder, job_id))
+    return(job_folder_list)
+
+
+def has_results(folder):
+    """
+        This function checks whether a job folder has the results of all
+        its events. A job killed at its walltime still merges the events
+        it finished into a RESULTS file, so that file alone is not enough.
+    """
+    results_list = glob(path.join(folder, "RESULTS*.h5"))
+    event_id_list = read_job_event_ids(folder)
+    if not event_id_list:
+        # not a simulation_driver.py job, any results file will do
+        return(len(results_list) > 0)
+    valid_events = set()
+    for file_name in results_list:
+        check_results_file(file_name, valid_events)
+    return(valid_events.issuperset(event_id_list))
+
+
+def update_suspension(folder_state, job_id, state, now):
+    """
+        This function records when a job is first seen suspended, and
+        returns how long it has been suspended
+    """
+    if state != "suspended":
+        folder_state.pop('suspended_since', None)
+        folder_state.pop('suspended_job', None)
+        return(timedelta(0))
+    if folder_state.get('suspended_job') != job_id:
+        folder_state['suspended_job'] = job_id
+        folder_state['suspended_since'] = now.isoformat()
+    return(now - datetime.fromisoformat(folder_state['suspended_since']))
+
+
+def get_actions(job_folder_list, state_table, monitor_state, suspend_limit,
+                max_restarts, now):
+    """
+        This function applies the restart policies to the state table and
+        returns the job ids to cancel and release, the folders to resubmit,
+        and the number of jobs in each state. The suspension times are
+        updated in monitor_state.
+    """
+    cancel_list, release_list, resubmit_list = [], [], []
+    counts = {}
+    for folder, job_id in job_folder_list:
+        job_state = {'state': "unsubmitted"}
+        if job_id != "":
+            job_state = state_table.get(job_id, {'state': "finished"})
+        state = job_state['state']
+        if state in ("finished", "unsubmitted") and has_results(folder):
+            state = "done"
+        counts[state] = counts.get(state, 0) + 1
+        suspended_time = timedelta(0)
+        if state == "suspended" or folder in monitor_state:
+            suspended_time = update_suspension(
+                monitor_state.setdefault(folder, {'restarts': 0}), job_id,
+                state, now)
+
+        n_restarts = monitor_state.get(folder, {}).get('restarts', 0)
+        if n_restarts >= max_restarts:
+            continue
+        if state == "suspended":
+            if suspended_time > suspend_limit:
+                cancel_list.append(job_id)
+                resubmit_list.append(folder)
+        elif state == "held":
+            release_list.append(job_id)
+        elif state in ("finished", "unsubmitted"):
+            resubmit_list.append(folder)
+    return(cancel_list, release_list, resubmit_list, counts)
+
+
+def submit_job(folder, commands, queue=""):
+    """This function submits the job of a folder and saves its job id"""
+    arguments = []
+    if queue != "":
+        arguments += ["-q", queue]
+    output = run_command(commands['submit'],
+                         arguments + [commands['job_script']], cwd=folder)
+    if output.strip() == "":
+        return("")
+    job_id = short_job_id(output.split()[-1])
+    with open(path.join(folder, "job_id"), "w") as f:
+        f.write(job_id + "\n")
+    return(job_id)
+
+
+def monitor_cycle(work_folder, scheduler, commands, monitor_state,
+                  suspend_limit, max_restarts, queue="", dry_run=False):
+    """This function runs one polling cycle"""
+    job_folder_list = read_job_folders(work_folder)
+    state_table = query_scheduler(
+        [job_id for _, job_id in job_folder_list if job_id != ""],
+        scheduler, commands)
+    cancel_list, release_list, resubmit_list, counts = get_actions(
+        job_folder_list, state_table, monitor_state, suspend_limit,
+        max_restarts, datetime.now())
+
+    print("\U0001F50D  {}: {} jobs, ".format(time.asctime(),
+                                             len(job_folder_list))
+          + ", ".join(["{} {}".format(counts[state], state)
+                       for state in sorted(counts)]), flush=True)
+    if dry_run:
+        for job_id in cancel_list:
+            print("   would cancel {}".format(job_id))
+        for folder in resubmit_list:
+            print("   would resubmit {}".format(folder))
+        for job_id in release_list:
+            print("   would release {}".format(job_id))
+        return(counts)
+
+    if cancel_list:
+        print("\U0001F6D1  Cancelling {} suspended jobs".format(
+              len(cancel_list)))
+        run_command(commands['cancel'], cancel_list)
+    if release_list:
+        print("\U0001F513  Releasing {} held jobs".format(len(release_list)))
+        run_command(commands['release'], release_list)
+    if resubmit_list:
+        print("\U0001F504  Resubmitting {} jobs".format(len(resubmit_list)))
+    for folder in resubmit_list:
+        job_id = submit_job(folder, commands, queue)
+        folder_state = monitor_state.setdefault(folder, {'restarts': 0})
+        folder_state['restarts'] += 1
+        folder_state['job_id'] = job_id
+        update_suspension(folder_state, job_id, "queued", None)
+    if resubmit_list:
+        counts['resubmitted'] = len(resubmit_list)
+    # keep the restarts and the suspension times for the next cycles
+    with open(path.join(work_folder, STATE_FILENAME), "w") as f:
+        json.dump(monitor_state, f, indent=4)
+    return(counts)
+
+
+def main():
+    """This is the main function"""
+    parser = argparse.ArgumentParser(
+        description='\U0001F50D Monitor and restart the jobs of a folder',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('work_folder', type=str,
+                        help='working folder with the event_* job folders')
+    parser.add_argument('--scheduler', type=str, choices=['pbs', 'slurm'],
+                        default='pbs', help='batch scheduler')
+    parser.add_argument('--queue', type=str, default="",
+                        help='queue of the resubmitted jobs')
+    parser.add_argument('--interval', type=float, default=600.,
+                        help='seconds between two polling cycles')
+    parser.add_argument('--once', action='store_true',
+                        help='run a single polling cycle')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='only report the states and the actions')
+    parser.add_argument('--suspend_hours', type=float, default=24.,
+                        help='restart jobs suspended for longer than this')
+    parser.add_argument('--max_restarts', type=int, default=3,
+                        help='maximum number of restarts of a job folder')
+    for key in ['query', 'history', 'cancel', 'release', 'submit',
+                'job_script']:
+        parser.add_argument('--{}_command'.format(key), type=str,
+                            default=None,
+                            help='replace the default {} command'.format(key))
+    args = parser.parse_args()
+
+    work_folder = path.abspath(args.work_folder)
+    commands = dict(DEFAULT_COMMANDS[args.scheduler])
+    for key in commands:
+        if getattr(args, '{}_command'.format(key)) is not None:
+            commands[key] = getattr(args, '{}_command'.format(key))
+
+    monitor_state = {}
+    state_file = path.join(work_folder, STATE_FILENAME)
+    if path.isfile(state_file):
+        with open(state_file, "r") as f:
+            monitor_state = json.load(f)
+
+    suspend_limit = timedelta(hours=args.suspend_hours)
+    while True:
+        counts = monitor_cycle(work_folder, args.scheduler, commands,
+                               monitor_state, suspend_limit,
+                               args.max_restarts, args.queue, args.dry_run)
+        active = sum([counts.get(state, 0) for state in
+                      ["queued", "running", "suspended", "held",
+                       "resubmitted"]])
+        if args.once or active == 0:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,389 @@
 #!/usr/bin/env python3
 """This is a drive script to run hydro + hadronic cascade simulation"""
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from multiprocessing import Pool
-from subprocess import call
+from subprocess import call, check_output, Popen, PIPE, SubprocessError
 from os import path, mkdir, remove, makedirs, system
 from glob import glob
+from itertools import product
+import argparse
+import json
+import os
+import queue
+import resource
 import sys
+import threading
 import time
 import shutil
+import signal
+import string
 import re
 import h5py
 import numpy as np
 
+HDF5_LOCK = threading.Lock()
 
-def print_usage():
-    """This function prints out help messages"""
-    print("\U0001F3B6  " + "Usage: {} ".format(sys.argv[0])
-          + "initial_condition_type event_id n_threads"
-          + "save_ipglasma_flag")
+# number of reruns of a failed diffraction task before its event is
+# packed without it
+MAX_TASK_RETRIES = 2
 
+# leading kinematic columns of the subnucleondiffraction outputs, which
+# are left out of the Monte Carlo error estimate
+MC_KINEMATIC_COLUMNS = {'Amp': 1, 'AmpF': 2}
 
-def get_initial_condition(initial_type, iev, final_results_folder):
-    """This funciton get initial conditions"""
+# resource usage records of the stages and subprocesses, per event
+RESOURCE_USAGE = {}
+RESOURCE_LOCK = threading.Lock()
+RESOURCE_DTYPE = np.dtype([
+    ('stage', 'S16'), ('name', 'S64'), ('wall_time', 'f8'),
+    ('user_time', 'f8'), ('sys_time', 'f8'), ('max_rss_kb', 'i8'),
+    ('io_write_bytes', 'i8'), ('output_bytes', 'i8'), ('exit_status', 'i4'),
+])
+
+# state of the pilot mode: "stop" ends the job after the events in
+# flight, "abort" also terminates them; the running stage processes are
+# kept to be terminated on abort
+PILOT_STATE = {
+    'stop': False,
+    'abort': False,
+    'deadline': None,
+    'margin': 120.,
+    'event_times': [],
+}
+RUNNING_PROCS = set()
+PILOT_LOCK = threading.Lock()
+
+# entries of the code folders that are linked instead of copied, or
+# skipped, when the job is staged to node-local scratch
+STAGE_LINK_LIST = ["utilities"]
+STAGE_SKIP_LIST = ["ipglasma_results", "run.log", "run.err"]
+
+
+def load_event_manifest(final_results_folder):
+    """
+        This function reads the checkpoint manifest of an event, which
+        records the completed stages: IPGlasma, every diffraction task,
+        and the hdf5 packing, and the number of failures of every
+        diffraction task
+    """
+    manifest = new_event_manifest()
+    manifest_path = path.join(final_results_folder, "manifest.json")
+    try:
+        with open(manifest_path, "r") as f:
+            manifest.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    return(manifest)
+
+
+def new_event_manifest():
+    """This function returns the manifest of an event with no stage done"""
+    return({'ipglasma': False, 'diffraction': {}, 'failures': {},
+            'hdf5': False})
+
+
+def save_event_manifest(final_results_folder, manifest):
+    """This function writes the checkpoint manifest atomically"""
+    manifest_path = path.join(final_results_folder, "manifest.json")
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def record_resource_usage(event_id, stage, name, wall_time, rusage,
+                          output_bytes=0, exit_status=0):
+    """This function keeps the resource usage of a stage or a subprocess"""
+    record = {
+        'stage': stage,
+        'name': name,
+        'wall_time': wall_time,
+        'user_time': rusage.ru_utime,
+        'sys_time': rusage.ru_stime,
+        'max_rss_kb': rusage.ru_maxrss,
+        'io_write_bytes': rusage.ru_oublock*512,
+        'output_bytes': output_bytes,
+        'exit_status': exit_status,
+    }
+    with RESOURCE_LOCK:
+        RESOURCE_USAGE.setdefault(str(event_id), []).append(record)
+
+
+def wait_and_record(proc, event_id, stage, name, start_time, output_bytes=0):
+    """
+        This function waits for a subprocess with wait4, so that its CPU
+        time, peak RSS and block output are recorded along with the wall
+        time and exit status. It returns the exit status.
+    """
+    _, wait_status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(wait_status)
+    record_resource_usage(event_id, stage, name, time.time() - start_time,
+                          rusage, output_bytes, proc.returncode)
+    return(proc.returncode)
+
+
+@contextmanager
+def record_stage(event_id, stage):
+    """
+        This context manager records the wall time and the driver's own
+        CPU usage of a stage. The subprocesses are recorded separately.
+    """
+    who = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+    start_time = time.time()
+    usage0 = resource.getrusage(who)
+    try:
+        yield
+    finally:
+        usage1 = resource.getrusage(who)
+        delta = [usage1[i] - usage0[i] for i in range(len(usage1))]
+        # the peak RSS is not additive, keep the driver's high-water mark
+        delta[2] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rusage = resource.struct_rusage(delta)
+        record_resource_usage(event_id, stage, "driver",
+                              time.time() - start_time, rusage)
+
+
+def get_resource_usage_table(event_id):
+    """This function returns the resource usage of an event as a table"""
+    with RESOURCE_LOCK:
+        record_list = list(RESOURCE_USAGE.get(str(event_id), []))
+    table = np.zeros(len(record_list), dtype=RESOURCE_DTYPE)
+    for irecord, record in enumerate(record_list):
+        for key in RESOURCE_DTYPE.names:
+            value = record[key]
+            if isinstance(value, str):
+                value = value.encode('UTF-8')[:64]
+            table[irecord][key] = value
+    return(table)
+
+
+def get_folder_size(folder):
+    """This function returns the total size of the files in a folder"""
+    total_size = 0
+    for root, _, file_list in os.walk(folder):
+        for file_i in file_list:
+            file_path = path.join(root, file_i)
+            if path.isfile(file_path):
+                total_size += path.getsize(file_path)
+    return(total_size)
+
+
+def read_ipglasma_input(input_file=path.join("ipglasma", "input")):
+    """This function reads the IPGlasma input file into a dictionary"""
+    parameters = {}
+    if not path.isfile(input_file):
+        return(parameters)
+    with open(input_file, "r") as f:
+        for rawline in f:
+            fields = rawline.split()
+            if len(fields) == 2:
+                parameters[fields[0]] = fields[1]
+    return(parameters)
+
+
+def write_resource_summary(para_dict_, summary_folder=".", suffix=""):
+    """
+        This function writes the resource usage of all the events in the
+        job to resource_usage_<id>.json, together with the job parameters
+        needed to size future submissions, and prints per-stage totals
+    """
+    try:
+        diffractionDict = load_diffraction_parameters()
+    except (OSError, ValueError):
+        diffractionDict = {}
+    with RESOURCE_LOCK:
+        events = {key: list(value) for key, value in RESOURCE_USAGE.items()}
+    summary = {
+        'num_threads': para_dict_['num_threads'],
+        'pipeline': para_dict_.get('pipeline', False),
+        'ipglasma_parameters': read_ipglasma_input(),
+        'diffraction_parameters': diffractionDict,
+        'events': events,
+    }
+    summary_name = path.join(summary_folder, "resource_usage_{}{}.json".format(
+                                            para_dict_['event_id0'], suffix))
+    with open(summary_name, "w") as f:
+        json.dump(summary, f, indent=4)
+
+    print("\U0001F3CE  Resource usage of {} events:".format(len(events)))
+    print("{:>12s} {:>10s} {:>12s} {:>12s} {:>14s}".format(
+          "stage", "processes", "wall [s]", "cpu [s]", "max RSS [MB]"))
+    for stage in ["ipglasma", "replay", "diffraction", "hdf5"]:
+        record_list = [record for event_records in events.values()
+                       for record in event_records
+                       if record['stage'] == stage]
+        if not record_list:
+            continue
+        n_processes = len([record for record in record_list
+                           if record['name'] != "driver"])
+        wall = sum([record['wall_time'] for record in record_list
+                    if record['name'] == "driver"])
+        cpu = sum([record['user_time'] + record['sys_time']
+                   for record in record_list])
+        max_rss = max([record['max_rss_kb'] for record in record_list])
+        print("{:>12s} {:>10d} {:>12.1f} {:>12.1f} {:>14.1f}".format(
+              stage, n_processes, wall, cpu, max_rss/1024.), flush=True)
+
+
+def walltime_to_seconds(walltime):
+    """This function converts a HH:MM:SS walltime string to seconds"""
+    seconds = 0
+    for field in walltime.split(":"):
+        seconds = 60*seconds + int(field)
+    return(seconds)
+
+
+def get_allocation_deadline(walltime):
+    """
+        This function returns the end time of the Slurm allocation (epoch
+        seconds), from $SLURM_JOB_END_TIME, squeue, or the start time of the
+        job plus the walltime. Outside Slurm, the walltime is counted from
+        now.
+    """
+    if os.environ.get("SLURM_JOB_END_TIME", "").isdigit():
+        return(float(os.environ["SLURM_JOB_END_TIME"]))
+    job_id = os.environ.get("SLURM_JOB_ID", "")
+    if job_id != "":
+        try:
+            end_time = check_output(
+                ["squeue", "-h", "-j", job_id, "-o", "%e"],
+                encoding='utf-8', timeout=30).strip()
+            return(time.mktime(time.strptime(end_time, "%Y-%m-%dT%H:%M:%S")))
+        except (OSError, SubprocessError, ValueError) as e:
+            print("\U0001F6AB  Can not read the end of job {}: {}".format(
+                  job_id, e), flush=True)
+    start_time = os.environ.get("SLURM_JOB_START_TIME", "")
+    if start_time.isdigit():
+        return(float(start_time) + walltime_to_seconds(walltime))
+    return(time.time() + walltime_to_seconds(walltime))
+
+
+def start_stage_process(args, **kwargs):
+    """
+        This function starts a stage process in its own process group, so
+        that the whole group can be terminated when the job is aborted
+    """
+    with PILOT_LOCK:
+        if PILOT_STATE['abort']:
+            return(None)
+        proc = Popen(args, start_new_session=True, **kwargs)
+        RUNNING_PROCS.add(proc)
+    return(proc)
+
+
+def release_stage_process(proc):
+    """This function forgets a finished stage process"""
+    with PILOT_LOCK:
+        RUNNING_PROCS.discard(proc)
+
+
+def request_stop(signum=None, frame=None):
+    """
+        This function lets the events in flight finish and stops the job
+        from starting new ones (SIGUSR1)
+    """
+    PILOT_STATE['stop'] = True
+    print("\U0001F6A6  Stop requested, finishing the events in flight ...",
+          flush=True)
+
+
+def request_abort(signum=None, frame=None):
+    """
+        This function terminates the running stages (SIGTERM, SIGINT, or
+        the deadline). Finished diffraction tasks are already checkpointed
+        in the event hdf5 file and manifest, so a rerun resumes from them.
+    """
+    PILOT_STATE['stop'] = True
+    PILOT_STATE['abort'] = True
+    print("\U0001F6A6  Abort requested, checkpointing the events in "
+          + "flight ...", flush=True)
+    with PILOT_LOCK:
+        proc_list = list(RUNNING_PROCS)
+    for proc in proc_list:
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            continue
+
+
+def setup_pilot_mode(para_dict_):
+    """
+        This function installs the signal handlers, and with a deadline,
+        a timer which aborts the job margin seconds before it, so the
+        results can still be merged
+    """
+    signal.signal(signal.SIGUSR1, request_stop)
+    signal.signal(signal.SIGTERM, request_abort)
+    signal.signal(signal.SIGINT, request_abort)
+    if para_dict_.get('deadline', "") == "":
+        return(None)
+    PILOT_STATE['margin'] = para_dict_.get('deadline_margin', 120.)
+    PILOT_STATE['deadline'] = get_allocation_deadline(para_dict_['deadline'])
+    timer = threading.Timer(
+        max(0., PILOT_STATE['deadline'] - PILOT_STATE['margin']
+            - time.time()), request_abort)
+    timer.daemon = True
+    timer.start()
+    print("\U0001F6A6  Pilot mode: deadline at {}".format(
+          time.ctime(PILOT_STATE['deadline'])), flush=True)
+    return(timer)
+
+
+def can_start_event():
+    """
+        This function decides whether a new event can start: no stop was
+        requested, and the mean duration of the finished events still fits
+        before the deadline
+    """
+    if PILOT_STATE['stop']:
+        return(False)
+    if PILOT_STATE['deadline'] is None:
+        return(True)
+    event_times = PILOT_STATE['event_times']
+    predicted = sum(event_times)/len(event_times) if event_times else 0.
+    remaining = PILOT_STATE['deadline'] - time.time()
+    if remaining > PILOT_STATE['margin'] + predicted:
+        return(True)
+    print("\U0001F6A6  {:.0f} s left, not enough for another event ".format(
+          remaining) + "({:.0f} s predicted)".format(predicted), flush=True)
+    return(False)
+
+
+def get_initial_condition(initial_type, iev, final_results_folder,
+                          n_threads=None):
+    """
+        This funciton get initial conditions
+
+        The IPGlasma results of a previous run are reused if the event
+        manifest records that IPGlasma finished.
+    """
     if "IPGlasma" in initial_type:
-        run_ipglasma(iev)
-        res_path = collect_ipglasma_event(final_results_folder, iev)
-        WilsonLineFileList = glob(path.join(res_path, "*V-*"))
+        manifest = load_event_manifest(final_results_folder)
+        res_path = path.join(path.abspath(final_results_folder),
+                             "ipglasma_results_{}".format(iev))
+        if manifest['ipglasma']:
+            WilsonLineFileList = sorted(glob(path.join(res_path, "*V-*")))
+            if WilsonLineFileList:
+                print("\U0001F3B6  IPGlasma event {} ".format(iev)
+                      + "finished before, resume from it ...", flush=True)
+                return(WilsonLineFileList)
+
+        # a new IPGlasma event invalidates all the diffraction results
+        manifest = new_event_manifest()
+        tmp_h5 = path.join(final_results_folder,
+                           "event_{}.h5.tmp".format(iev))
+        if path.exists(tmp_h5):
+            remove(tmp_h5)
+        with record_stage(iev, "ipglasma"):
+            run_ipglasma(iev, n_threads)
+            if PILOT_STATE['abort']:
+                # the Wilson lines of an interrupted run are incomplete
+                return([])
+            res_path = collect_ipglasma_event(final_results_folder, iev)
+        WilsonLineFileList = sorted(glob(path.join(res_path, "*V-*")))
+        manifest['ipglasma'] = len(WilsonLineFileList) > 0
+        save_event_manifest(final_results_folder, manifest)
         return(WilsonLineFileList)
     else:
         print("\U0001F6AB  "
@@ -34,26 +392,400 @@ def get_initial_condition(initial_type, iev, final_results_folder):
         exit(1)
 
 
-def run_ipglasma(iev):
-    """This functions run IPGlasma"""
+def list_replay_archive(archive):
+    """
+        This function lists the IPGlasma events saved in a replay archive.
+        The archive is either a folder holding ipglasma_results_<id>
+        folders (at any depth, e.g. a whole playground), or an hdf5 file
+        with one ipglasma_results_<id> group per event. It returns a
+        dictionary from the event id to the location of the event.
+    """
+    event_dict = {}
+    if path.isdir(archive):
+        for root, dir_list, _ in os.walk(archive, followlinks=True):
+            for dir_i in dir_list:
+                match = re.fullmatch(r"ipglasma_results_(\d+)", dir_i)
+                if match is None:
+                    continue
+                res_path = path.join(root, dir_i)
+                if glob(path.join(res_path, "*V-*")):
+                    event_dict.setdefault(int(match.group(1)), res_path)
+    else:
+        with h5py.File(archive, "r") as h5f:
+            for group_name in h5f.keys():
+                match = re.fullmatch(r"ipglasma_results_(\d+)", group_name)
+                if match is not None:
+                    event_dict[int(match.group(1))] = group_name
+    return(event_dict)
+
+
+def get_replay_events(archive, idx0, nev, event_ids=None):
+    """
+        This function returns the archived events replayed by this job as
+        a dictionary from the event id to its location. With event_ids,
+        these archived events are taken. Otherwise the events are sorted
+        by id, and the job takes the nev events starting from the position
+        idx0.
+    """
+    event_dict = list_replay_archive(archive)
+    if event_ids:
+        missing_list = [iev for iev in event_ids if iev not in event_dict]
+        if missing_list:
+            print("\U0001F6AB  Events {} are not in the archive {}".format(
+                  ",".join([str(iev) for iev in missing_list]), archive),
+                  flush=True)
+        event_id_list = [iev for iev in event_ids if iev in event_dict]
+    else:
+        event_id_list = sorted(event_dict.keys())[idx0:idx0 + nev]
+    return({iev: event_dict[iev] for iev in event_id_list})
+
+
+def stage_replay_event(archive, location, res_path):
+    """
+        This function puts the saved IPGlasma results of an event in
+        res_path. Files from a folder archive are symlinked, so removing
+        the results of the event leaves the archive untouched. Files from
+        an hdf5 archive are written out.
+    """
+    if path.exists(res_path):
+        shutil.rmtree(res_path)
+    makedirs(res_path)
+    if path.isdir(archive):
+        for file_i in os.listdir(location):
+            os.symlink(path.realpath(path.join(location, file_i)),
+                       path.join(res_path, file_i))
+    else:
+        with h5py.File(archive, "r") as h5f:
+            for file_i, dset in h5f[location].items():
+                with open(path.join(res_path, file_i), "wb") as f:
+                    f.write(dset[()].tobytes())
+
+
+def get_replay_initial_condition(para_dict_, iev, final_results_folder):
+    """
+        This function gets the Wilson lines of an event from the replay
+        archive instead of running IPGlasma
+    """
+    manifest = load_event_manifest(final_results_folder)
+    res_path = path.join(path.abspath(final_results_folder),
+                         "ipglasma_results_{}".format(iev))
+    if manifest['ipglasma']:
+        WilsonLineFileList = sorted(glob(path.join(res_path, "*V-*")))
+        if WilsonLineFileList:
+            return(WilsonLineFileList)
+
+    manifest = new_event_manifest()
+    tmp_h5 = path.join(final_results_folder, "event_{}.h5.tmp".format(iev))
+    if path.exists(tmp_h5):
+        remove(tmp_h5)
+    print("\U0001F3B6  Replay the Wilson lines of event {} ...".format(iev),
+          flush=True)
+    with record_stage(iev, "replay"):
+        stage_replay_event(para_dict_['replay'],
+                           para_dict_['replay_events'][iev], res_path)
+    WilsonLineFileList = sorted(glob(path.join(res_path, "*V-*")))
+    manifest['ipglasma'] = len(WilsonLineFileList) > 0
+    save_event_manifest(final_results_folder, manifest)
+    return(WilsonLineFileList)
+
+
+def run_ipglasma(iev, n_threads=None):
+    """
+        This functions run IPGlasma
+
+        n_threads overrides the number of OpenMP threads set in
+        run_ipglasma.sh, so the pipelined mode can share the core budget
+        with the diffraction stage.
+    """
     print("\U0001F3B6  Run IPGlasma ... ")
-    call("bash ./run_ipglasma.sh {}".format(iev), shell=True)
+    env = None
+    if n_threads is not None:
+        env = dict(os.environ, IPGLASMA_NUM_THREADS=str(n_threads))
+    start_time = time.time()
+    proc = start_stage_process(["bash", "./run_ipglasma.sh", str(iev)],
+                               env=env)
+    if proc is None:
+        return
+    _, wait_status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(wait_status)
+    release_stage_process(proc)
+    record_resource_usage(
+        iev, "ipglasma", "ipglasma", time.time() - start_time, rusage,
+        get_folder_size(path.join("ipglasma", "ipglasma_results")),
+        proc.returncode)
 
 
-def run_subnucleondiffraction(WilsonLineFileList, iev, final_results_folder):
-    """This functions run subnucleon diffraction"""
-    print("\U0001F3B6  Run subnucleondiffraction ... ")
+def load_diffraction_parameters():
+    """This function reads the diffraction parameters of the job"""
+    with open(path.join("subnucleondiffraction",
+                        "diffraction_parameters.json"), "r") as f:
+        diffractionDict = json.load(f)
+    return(diffractionDict)
+
+
+def get_mc_settings(diffractionDict):
+    """
+        This function returns the settings of the adaptive Monte Carlo
+        integration, used when mcintpoints is "auto", and None otherwise
+    """
+    if diffractionDict.get('mcintpoints') != "auto":
+        return(None)
+    return({
+        'target_relerr': diffractionDict.get('mc_target_relerr', 0.01),
+        'min_points': int(diffractionDict.get('mc_min_points', 100000)),
+        'max_points': int(diffractionDict.get('mc_max_points', 10000000)),
+        'repeats': max(2, int(diffractionDict.get('mc_repeats', 4))),
+        'amplitude_floor': float(diffractionDict.get('mc_amplitude_floor',
+                                                     1e-3)),
+    })
+
+
+def get_diffraction_tasks(WilsonLineFileList, iev, diffractionDict):
+    """
+        This function lists all the independent subnucleondiffraction runs
+        of an event, one per (Wilson-line file, Q2, observable mode)
+    """
+    modeList = []
+    if diffractionDict.get('computeTotalCrossSection', 0) > 0:
+        modeList.append("AmpF")
+    if diffractionDict.get('analyzeDiffraction', 0) > 0:
+        modeList.append("Amp")
+    mc_settings = get_mc_settings(diffractionDict)
+    task_list = []
     for ifile, filenameWithPath in enumerate(WilsonLineFileList):
         xval = filenameWithPath.split("/")[-1].split("_")[2]
-        call("bash ./run_subnucleondiffraction.sh {} {} {} {}".format(
-                    iev, ifile, filenameWithPath, xval), shell=True)
-    res_folder_name = "subnucleondiffraction_results_{}".format(iev)
-    res_path = path.join(path.abspath(final_results_folder),
-                         res_folder_name)
-    if path.exists(res_path):
-        shutil.rmtree(res_path)
-    shutil.move("subnucleondiffraction/subnucleondiffraction_results",
-                res_path)
+        if diffractionDict.get('saveNucleusSnapshot', False):
+            task_list.append({
+                'mode': "picture", 'fileId': ifile,
+                'WilsonLineFile': filenameWithPath, 'xval': xval,
+                'Q2': diffractionDict['Q2List'][0],
+                'output': "picture_{}_{}".format(iev, ifile),
+                'mc': None,
+            })
+        for Q2 in diffractionDict['Q2List']:
+            for mode in modeList:
+                task_list.append({
+                    'mode': mode, 'fileId': ifile,
+                    'WilsonLineFile': filenameWithPath, 'xval': xval,
+                    'Q2': Q2,
+                    'output': "{}_Q2_{}_{}_{}_x_{}".format(
+                        mode, Q2, iev, ifile, xval),
+                    'mc': mc_settings,
+                })
+    return(task_list)
+
+
+def run_diffraction_process(task, iev, name, env=None):
+    """
+        This function runs subnucleondiffraction once for a task and
+        parses its stdout. It returns the exit status and the table.
+    """
+    start_time = time.time()
+    proc = start_stage_process(
+        ["bash", "./run_subnucleondiffraction.sh", str(iev),
+         str(task['fileId']), task['WilsonLineFile'], task['xval'],
+         str(task['Q2']), task['mode']],
+        stdout=PIPE, encoding='utf-8', env=env)
+    if proc is None:
+        return(-signal.SIGTERM, [], np.array([]))
+    stream = CountingStream(proc.stdout)
+    try:
+        # the process is reaped by wait4, which does not close its pipe
+        with proc.stdout:
+            header_list, data = parse_table_stream(stream)
+    finally:
+        status = wait_and_record(proc, iev, "diffraction", name, start_time,
+                                 stream.n_bytes)
+        release_stage_process(proc)
+    if status != 0:
+        print("\U0001F6AB  subnucleondiffraction task {} ".format(name)
+              + "exited with status {}".format(status), flush=True)
+    return(status, header_list, data)
+
+
+def estimate_mc_error(mode, data_list, amplitude_floor=1e-3):
+    """
+        This function estimates the relative Monte Carlo error of the
+        mean amplitude from the spread between independent repeats. The
+        leading kinematic columns (t for Amp, and one more for AmpF) are
+        excluded, and the (Re, Im) column pairs are complex amplitudes.
+
+        The error is the largest relative error |dA|/|A| over the rows,
+        so the large-t rows are converged as well as the dominant small-t
+        ones. Rows with |A| below amplitude_floor times the largest |A|
+        of the component, e.g. at the diffractive minima, are left out.
+    """
+    n_kinematic = MC_KINEMATIC_COLUMNS.get(mode, 0)
+    samples = np.array([np.atleast_2d(data)[:, n_kinematic:]
+                        for data in data_list])
+    mean = np.mean(samples, axis=0)
+    error = np.std(samples, axis=0, ddof=1)/np.sqrt(len(data_list))
+    n_pairs = mean.shape[1]//2
+    if n_pairs == 0:
+        return(mean, 0.)
+    # (n_rows, n_complex) magnitudes of the amplitudes and their errors
+    abs_mean = np.hypot(mean[:, 0:2*n_pairs:2], mean[:, 1:2*n_pairs:2])
+    abs_error = np.hypot(error[:, 0:2*n_pairs:2], error[:, 1:2*n_pairs:2])
+    valid = abs_mean > amplitude_floor*np.max(abs_mean, axis=0)
+    if not np.any(valid):
+        return(mean, 0.)
+    return(mean, float(np.max(abs_error[valid]/abs_mean[valid])))
+
+
+def run_adaptive_diffraction(task, iev):
+    """
+        This function runs a task with independent random seeds at an
+        increasing number of Monte Carlo points, until the relative error
+        of the mean amplitude reaches the target or the maximum number of
+        points is used. It returns the exit status, the header, the mean
+        table, and the Monte Carlo attributes to record.
+    """
+    mc = task['mc']
+    n_points = mc['min_points']
+    rng = np.random.default_rng()
+    while True:
+        header_list = []
+        data_list = []
+        seed_list = rng.integers(1, 2**31 - 1, size=mc['repeats'])
+        for irepeat, seed in enumerate(seed_list):
+            env = dict(os.environ, MCINTPOINTS=str(n_points),
+                       GSL_RNG_SEED=str(seed))
+            status, header_i, data = run_diffraction_process(
+                task, iev, "{}_N{}_r{}".format(task['output'], n_points,
+                                               irepeat), env)
+            if status != 0:
+                return(status, header_i, data, {})
+            if irepeat == 0:
+                header_list = header_i
+            data_list.append(data)
+        mean, relerr = estimate_mc_error(task['mode'], data_list,
+                                         mc['amplitude_floor'])
+        if relerr <= mc['target_relerr'] or n_points >= mc['max_points']:
+            break
+        n_points = min(mc['max_points'], max(
+            2*n_points, int(1.2*n_points*(relerr/mc['target_relerr'])**2)))
+
+    n_kinematic = MC_KINEMATIC_COLUMNS.get(task['mode'], 0)
+    data = np.atleast_2d(data_list[0]).copy()
+    data[:, n_kinematic:] = mean
+    if np.ndim(data_list[0]) == 1:
+        data = data[0]
+    print("\U0001F3B2  {}: {} points x {} repeats, ".format(
+          task['output'], n_points, mc['repeats'])
+          + "relative error {:.2e}".format(relerr), flush=True)
+    mc_attrs = {
+        'mcintpoints': n_points,
+        'mc_repeats': mc['repeats'],
+        'mc_relative_error': relerr,
+        'mc_target_relerr': mc['target_relerr'],
+        'mc_error_criterion': np.bytes_("max_row_relative"),
+        'mc_amplitude_floor': mc['amplitude_floor'],
+    }
+    return(0, header_list, data, mc_attrs)
+
+
+def run_diffraction_task(task, iev, h5group, manifest,
+                         final_results_folder):
+    """
+        This function runs one subnucleondiffraction task and streams its
+        stdout straight into the hdf5 group of the event. A successful task
+        is flushed to disk and then recorded in the event manifest. A
+        failed task writes no table, and its failure is counted in the
+        manifest.
+    """
+    if PILOT_STATE['abort']:
+        return(-signal.SIGTERM)
+    if task['mc'] is None:
+        status, header_list, data = run_diffraction_process(
+                                                task, iev, task['output'])
+        mc_attrs = {}
+    else:
+        status, header_list, data, mc_attrs = run_adaptive_diffraction(
+                                                                task, iev)
+    if status != 0:
+        # the table of a failed or aborted task may be truncated, so it is
+        # never written: only finished tasks have a dataset in the event
+        with HDF5_LOCK:
+            if task['output'] in h5group:
+                del h5group[task['output']]
+            if not PILOT_STATE['abort']:
+                # an aborted task is rerun and does not use up a retry
+                manifest['failures'][task['output']] = (
+                    manifest['failures'].get(task['output'], 0) + 1)
+                save_event_manifest(final_results_folder, manifest)
+        return(status)
+    with HDF5_LOCK:
+        add_table_to_hdf5(h5group, task['output'], header_list, data,
+                          mc_attrs)
+        h5group.file.flush()
+        manifest['diffraction'][task['output']] = True
+        save_event_manifest(final_results_folder, manifest)
+    return(status)
+
+
+class CountingStream:
+    """This class counts the bytes read from a text stream line by line"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.n_bytes = 0
+
+    def __iter__(self):
+        for rawline in self.stream:
+            self.n_bytes += len(rawline)
+            yield rawline
+
+
+def get_failed_tasks(manifest, max_retries=MAX_TASK_RETRIES):
+    """
+        This function lists the diffraction tasks of a manifest which
+        failed more than max_retries times, and are given up
+    """
+    return(sorted([name for name, n_failures in manifest['failures'].items()
+                   if n_failures > max_retries
+                   and not manifest['diffraction'].get(name, False)]))
+
+
+def run_subnucleondiffraction(WilsonLineFileList, iev, h5group,
+                              final_results_folder, n_workers=1,
+                              task_filter=None, max_retries=MAX_TASK_RETRIES):
+    """
+        This functions run subnucleon diffraction
+
+        All the (Wilson-line file, Q2, mode) tasks of the event, or those
+        selected by task_filter, are scheduled over a pool of n_workers
+        single-threaded processes. Tasks recorded as finished in the
+        manifest of final_results_folder are skipped. A failed task is
+        rerun up to max_retries times, counted over all the runs of the
+        job, and then given up. It returns False if some tasks are left
+        to resume, e.g. after an abort.
+    """
+    print("\U0001F3B6  Run subnucleondiffraction ... ")
+    manifest = load_event_manifest(final_results_folder)
+    failed_list = get_failed_tasks(manifest, max_retries)
+    task_list = [
+        task for task in get_diffraction_tasks(
+            WilsonLineFileList, iev, load_diffraction_parameters())
+        if not (manifest['diffraction'].get(task['output'], False)
+                and task['output'] in h5group)
+        and task['output'] not in failed_list
+        and (task_filter is None or task_filter(task))
+    ]
+    while task_list:
+        n_workers = max(1, min(n_workers, len(task_list)))
+        print("\U0001F3B6  {} tasks on {} workers".format(
+              len(task_list), n_workers), flush=True)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            status_list = list(executor.map(
+                lambda task: run_diffraction_task(
+                    task, iev, h5group, manifest, final_results_folder),
+                task_list))
+        if PILOT_STATE['abort']:
+            return(status_list.count(0) == len(status_list))
+        failed_list = get_failed_tasks(manifest, max_retries)
+        task_list = [task for task, status in zip(task_list, status_list)
+                     if status != 0 and task['output'] not in failed_list]
+    return(True)
 
 
 def collect_ipglasma_event(final_results_folder, event_id):
@@ -67,8 +799,79 @@ def collect_ipglasma_event(final_results_folder, event_id):
     return(res_path)
 
 
-def zip_results_into_hdf5(final_results_folder, event_id, para_dict):
-    """This function combines all the results into hdf5"""
+def parse_table_stream(stream):
+    """
+        This function parses a text table in a single pass. It returns
+        the header lines (the ones containing "#") with their line numbers
+        and the numerical rows as an array, like np.loadtxt does.
+    """
+    header_list = []
+    rows = []
+    for iline, rawline in enumerate(stream):
+        if "#" in rawline:
+            header_list.append((iline, rawline))
+            rawline = rawline.split("#")[0]
+        fields = rawline.split()
+        if fields:
+            rows.append([float(field) for field in fields])
+    if rows:
+        data = np.squeeze(np.array(rows))
+    else:
+        data = np.array([])
+    return(header_list, data)
+
+
+def add_table_to_hdf5(h5group, dataset_name, header_list, data,
+                      attrs=None):
+    """This function saves a parsed table into the hdf5 group"""
+    if dataset_name in h5group:
+        del h5group[dataset_name]
+    h5data = h5group.create_dataset("{0}".format(dataset_name),
+                                    data=data,
+                                    compression="gzip",
+                                    compression_opts=9)
+    for iline, header_text in header_list:
+        try:
+            h5data.attrs.create("{}".format(iline), np.bytes_(header_text))
+        except UnicodeEncodeError:
+            continue
+    if attrs is not None:
+        for key, value in attrs.items():
+            h5data.attrs.create(key, value)
+
+
+def open_event_hdf5(final_results_folder, event_id):
+    """
+        This function opens the hdf5 file of an event. It is written under
+        a temporary name until zip_results_into_hdf5 finalizes it. A
+        partial file left by an interrupted run is reopened, so finished
+        diffraction tasks are kept; an unreadable one is started over.
+    """
+    results_name = "event_{}".format(event_id)
+    h5_path = path.join(final_results_folder, "{}.h5.tmp".format(results_name))
+    if path.exists(h5_path):
+        try:
+            hf = h5py.File(h5_path, "a")
+            gtemp = hf.require_group("{0}".format(results_name))
+            return(hf, gtemp)
+        except (OSError, ValueError, TypeError):
+            print("\U0001F6AB  {} is corrupted, start over ...".format(
+                  h5_path), flush=True)
+            remove(h5_path)
+    manifest = load_event_manifest(final_results_folder)
+    manifest['diffraction'] = {}
+    manifest['failures'] = {}
+    save_event_manifest(final_results_folder, manifest)
+    hf = h5py.File(h5_path, "w")
+    gtemp = hf.create_group("{0}".format(results_name))
+    return(hf, gtemp)
+
+
+def zip_results_into_hdf5(final_results_folder, event_id, para_dict, hf):
+    """
+        This function adds the initial state results to the event hdf5
+        file, which already holds the diffraction results, and finalizes it
+    """
     results_name = "event_{}".format(event_id)
     initial_state_filelist = [
         'NcollList{}.dat'.format(event_id),
@@ -77,59 +880,40 @@ def zip_results_into_hdf5(final_results_folder, event_id, para_dict):
         'usedParameters{}.dat'.format(event_id),
     ]
 
-    resfolder = path.join(final_results_folder, results_name)
-    if path.exists(resfolder):
-        shutil.rmtree(resfolder)
-    mkdir(resfolder)
-
     curr_time = time.asctime()
-    print("[{}] converting {} to hdf5".format(curr_time, resfolder),
+    print("[{}] converting {} to hdf5".format(curr_time, results_name),
           flush=True)
 
+    gtemp = hf[results_name]
     if ("IPGlasma" in para_dict['initial_type']):
         initial_folder = path.join(
             final_results_folder,
             "ipglasma_results_{}".format(event_id))
         for inifilename in initial_state_filelist:
-            inifile = path.join(initial_folder, inifilename)
-            if path.isfile(inifile):
-                shutil.move(inifile, resfolder)
-    diffraction_folder = path.join(
-            final_results_folder,
-            "subnucleondiffraction_results_{}".format(event_id))
-    diffraction_filelist = glob(path.join(diffraction_folder, "*"))
-    for file_i in diffraction_filelist:
-        shutil.move(file_i, resfolder)
-
-    hf = h5py.File("{0}.h5".format(results_name), "w")
-    gtemp = hf.create_group("{0}".format(results_name))
-    file_list = glob(path.join(resfolder, "*"))
-    for file_path in file_list:
-        print("Adding file: {} ...".format(file_path))
-        file_name = file_path.split("/")[-1]
-        if "usedParameters" in file_name:
-            parafile = open(file_path)
-            for iline, rawline in enumerate(parafile.readlines()):
-                paraline = rawline.strip('\n')
-                gtemp.attrs.create("{0}".format(iline), np.bytes_(paraline))
-        else:
-            dtemp = np.loadtxt(file_path, encoding='utf-8')
-            h5data = gtemp.create_dataset("{0}".format(file_name),
-                                          data=dtemp,
-                                          compression="gzip",
-                                          compression_opts=9)
-            ftemp = open(file_path, "r", encoding='utf-8')
-            for iline, header_text in enumerate(ftemp.readlines()):
-                if "#" in header_text:
-                    try:
-                        h5data.attrs.create("{}".format(iline),
-                                            np.bytes_(header_text))
-                    except UnicodeEncodeError:
-                        continue
-            ftemp.close()
+            file_path = path.join(initial_folder, inifilename)
+            if not path.isfile(file_path):
+                continue
+            print("Adding file: {} ...".format(file_path))
+            if "usedParameters" in inifilename:
+                parafile = open(file_path)
+                for iline, rawline in enumerate(parafile.readlines()):
+                    paraline = rawline.strip('\n')
+                    gtemp.attrs.create("{0}".format(iline),
+                                       np.bytes_(paraline))
+                parafile.close()
+            else:
+                with open(file_path, "r", encoding='utf-8') as ftemp:
+                    header_list, dtemp = parse_table_stream(ftemp)
+                add_table_to_hdf5(gtemp, inifilename, header_list, dtemp)
+    # keep the cost of the event next to its results
+    gtemp.attrs.create("resource_usage", get_resource_usage_table(event_id))
+    tmp_path = hf.filename
     hf.close()
-    shutil.move("{}.h5".format(results_name), final_results_folder)
-    shutil.rmtree(resfolder, ignore_errors=True)
+    os.replace(tmp_path, path.join(final_results_folder,
+                                   "{}.h5".format(results_name)))
+    manifest = load_event_manifest(final_results_folder)
+    manifest['hdf5'] = True
+    save_event_manifest(final_results_folder, manifest)
     return(True)
 
 
@@ -147,123 +931,781 @@ def remove_unwanted_outputs(final_results_folder,
         shutil.rmtree(ipglasmafolder, ignore_errors=True)
 
 
+def get_unique_group_name(group_name, exist_group_keys):
+    """
+        This function returns a group name that does not collide with the
+        existing ones by appending the first free label among a, b, ..., z,
+        aa, ab, ...
+    """
+    if group_name not in exist_group_keys:
+        return(group_name)
+    label_len = 1
+    while True:
+        for label in product(string.ascii_lowercase, repeat=label_len):
+            new_name = "{0}{1}".format(group_name, "".join(label))
+            if new_name not in exist_group_keys:
+                return(new_name)
+        label_len += 1
+
+
 def combine_all_hdf5_results(idx):
     """
         This functions combine all the hdf5 files into one
+
+        The groups are copied natively into a single output file handle,
+        and name collisions are resolved deterministically.
     """
     RESULTS_NAME = "RESULTS_{}".format(idx)
-    EVENT_LIST = glob("EVENT_RESULTS_*/*.h5")
-    exist_group_keys = []
+    EVENT_LIST = sorted(glob("EVENT_RESULTS_*/*.h5"))
+    start_time = time.time()
+    exist_group_keys = set()
+    h5Res = h5py.File("{}.h5".format(RESULTS_NAME), "w")
     for ievent, event_path in enumerate(EVENT_LIST):
         print("processing {0} ... ".format(event_path))
-        event_name = event_path.split("/")[-1]
-        hftemp = h5py.File(event_path, "r")
-        glist = list(hftemp.keys())
-        hftemp.close()
-        for igroup, gtemp in enumerate(glist):
-            gtemp2 = gtemp
-            random_string_len = 1
-            tol = 0
-            while gtemp2 in exist_group_keys:
-                randomlabel = randomString(random_string_len)
-                gtemp2 = "{0}{1}".format(gtemp, randomlabel)
-                tol += 1
-                if tol > 30:
-                    random_string_len += 1
-                    tol = 0
-            if gtemp2 != gtemp:
-                print("Conflict in mergeing {0}, use {1}".format(gtemp, gtemp2))
-            exist_group_keys.append(gtemp2)
-            system('h5copy -i {0} -o {1}.h5 -s {2} -d {3}'.format(
-                event_path, RESULTS_NAME, gtemp, gtemp2))
+        with h5py.File(event_path, "r") as hftemp:
+            for gtemp in hftemp.keys():
+                gtemp2 = get_unique_group_name(gtemp, exist_group_keys)
+                if gtemp2 != gtemp:
+                    print("Conflict in mergeing {0}, use {1}".format(
+                        gtemp, gtemp2))
+                exist_group_keys.add(gtemp2)
+                h5py.h5o.copy(hftemp.id, gtemp.encode('UTF-8'),
+                              h5Res.id, gtemp2.encode('UTF-8'))
+    h5Res.close()
+    print("\U0001F3CE  Merged {0} groups from {1} files into {2}.h5 ".format(
+          len(exist_group_keys), len(EVENT_LIST), RESULTS_NAME)
+          + "in {:.2f} s".format(time.time() - start_time), flush=True)
 
 
+def prepare_event_folder(event_id):
+    """
+        This function prepares the results folder of a given event.
+        It returns False if the event has already finished properly.
+    """
+    final_results_folder = "EVENT_RESULTS_{}".format(event_id)
+    if path.exists(final_results_folder):
+        print("{} exists ...".format(final_results_folder), flush=True)
+        results_file = path.join(final_results_folder,
+                                 "event_{}.h5".format(event_id))
+        if path.exists(results_file):
+            print("{} finished properly. No need to rerun.".format(event_id),
+                  flush=True)
+            return False
+        print("Rerun {} ...".format(final_results_folder), flush=True)
+    else:
+        mkdir(final_results_folder)
+    return True
 
 
-def main(para_dict_):
-    """This is the main function"""
-    initial_type = para_dict_['initial_type']
-    num_threads = para_dict_['num_threads']
-    curr_time = time.asctime()
-    print("\U0001F3CE  [{}] Number of threads: {}".format(curr_time,
-                                                          num_threads),
+def record_failed_tasks(iev, event_group, failed_list):
+    """
+        This function records the given up diffraction tasks of an event
+        as an attribute of its hdf5 group
+    """
+    if not failed_list:
+        return
+    print("\U0001F6AB  Event {} is packed without {} failed ".format(
+          iev, len(failed_list))
+          + "diffraction tasks: {}".format(", ".join(failed_list)),
           flush=True)
+    event_group.attrs.create("failed_tasks", np.array(
+        [np.bytes_(name) for name in failed_list]))
 
-    nev = para_dict_['n_events']
+
+def finish_event(WilsonLineFileList, iev, para_dict_, n_workers=1):
+    """
+        This function runs all the stages after IPGlasma for one event:
+        the diffraction calculations, the hdf5 packing, and the clean up.
+        It returns whether the event was packed, and the list of the
+        diffraction tasks given up after all their retries.
+    """
+    event_id = str(iev)
+    final_results_folder = "EVENT_RESULTS_{}".format(event_id)
+    max_retries = para_dict_.get('max_task_retries', MAX_TASK_RETRIES)
+
+    # compute diffractive cross-sections from the produced Wilson Lines
+    # and stream them into the hdf5 file of the event
+    hf, event_group = open_event_hdf5(final_results_folder, event_id)
+    with record_stage(event_id, "diffraction"):
+        status = run_subnucleondiffraction(WilsonLineFileList, iev,
+                                           event_group, final_results_folder,
+                                           n_workers, None, max_retries)
+    if not status:
+        # keep the partial results, a rerun resumes the missing tasks
+        hf.close()
+        print("\U0001F6AB  Event {} has unfinished diffraction ".format(iev)
+              + "tasks, it will be resumed in the next run.", flush=True)
+        return(False, [])
+    failed_list = get_failed_tasks(load_event_manifest(final_results_folder),
+                                   max_retries)
+    record_failed_tasks(iev, event_group, failed_list)
+
+    # zip results into a hdf5 database
+    with record_stage(event_id, "hdf5"):
+        status = zip_results_into_hdf5(final_results_folder, event_id,
+                                       para_dict_, hf)
+
+    # remove the unwanted outputs if event is finished properly
+    if status:
+        if para_dict_.get('job_folder', "") != "":
+            sync_event_to_job_folder(event_id, para_dict_)
+        remove_unwanted_outputs(final_results_folder, event_id,
+                                para_dict_['save_ipglasma'])
+    return(status, failed_list)
+
+
+def split_thread_budget(num_threads):
+    """
+        This function splits the core budget of the job between the
+        IPGlasma stage and the diffraction worker pool in the pipelined
+        mode. With a single thread both stages get one core.
+    """
+    n_diffraction = max(1, num_threads // 2)
+    n_ipglasma = max(1, num_threads - n_diffraction)
+    return n_ipglasma, n_diffraction
+
+
+def parse_event_ids(event_ids_str):
+    """
+        This function parses a list of event ids like "3,7,10-12" into
+        a sorted list of integers
+    """
+    event_id_list = set()
+    for field in event_ids_str.split(","):
+        field = field.strip()
+        if field == "":
+            continue
+        if "-" in field:
+            id_start, id_end = field.split("-")
+            event_id_list.update(range(int(id_start), int(id_end) + 1))
+        else:
+            event_id_list.add(int(field))
+    return(sorted(event_id_list))
+
+
+def get_event_id_list(para_dict_):
+    """This function returns the ids of the events run by this job"""
+    if para_dict_.get('replay', "") != "":
+        # the archived events, selected by position or by event_ids
+        return(list(para_dict_['replay_events'].keys()))
+    if para_dict_.get('event_ids', []):
+        return(list(para_dict_['event_ids']))
     idx0 = para_dict_['event_id0']
-    iev = idx0
+    return(list(range(idx0, idx0 + para_dict_['n_events'])))
+
+
+def get_event_wilson_lines(para_dict_, iev, final_results_folder,
+                           n_threads=None):
+    """
+        This function returns the Wilson lines of an event, either from a
+        new IPGlasma run or from the replay archive
+    """
+    if para_dict_.get('replay', "") != "":
+        return(get_replay_initial_condition(para_dict_, iev,
+                                            final_results_folder))
+    return(get_initial_condition(para_dict_['initial_type'], iev,
+                                 final_results_folder, n_threads))
+
+
+def run_events_sequentially(para_dict_):
+    """
+        This function runs the events one after another. It returns the
+        number of failed IPGlasma runs and of events left unfinished or
+        packed with failed diffraction tasks.
+    """
+    event_id_list = get_event_id_list(para_dict_)
+    replay = para_dict_.get('replay', "") != ""
+    ievent = 0
     Nfailed = 0
-    while iev < idx0 + nev:
+    ntol = 5
+    while ievent < len(event_id_list):
         curr_time = time.asctime()
 
-        ntol = 5
+        iev = event_id_list[ievent]
         event_id = str(iev)
         final_results_folder = "EVENT_RESULTS_{}".format(event_id)
-        if path.exists(final_results_folder):
-            print("{} exists ...".format(final_results_folder), flush=True)
-            results_file = path.join(final_results_folder,
-                                     "event_{}.h5".format(event_id))
-            status = False
-            if path.exists(results_file):
-                status = True
-            if status:
-                print(
-                    "{} finished properly. No need to rerun.".format(event_id),
-                    flush=True)
-                iev += 1
-                continue
-            print("Rerun {} ...".format(final_results_folder), flush=True)
-        else:
-            mkdir(final_results_folder)
+        if not can_start_event():
+            break
+        if not prepare_event_folder(event_id):
+            ievent += 1
+            continue
+        event_start = time.time()
         print("[{}] Generate initial condition ... ".format(curr_time),
               flush=True)
 
         # run IPGlasma
-        WilsonLineFileList = get_initial_condition(
-                            initial_type, iev, final_results_folder)
+        WilsonLineFileList = get_event_wilson_lines(
+                            para_dict_, iev, final_results_folder)
 
         if not WilsonLineFileList:
+            if PILOT_STATE['abort']:
+                break
             # the result file list is empty
             print("The IPGlasma event {} did not finish properly,".format(iev)
                   + " skip ... ")
-            if ntol > 0:
+            if replay:
+                # rerunning cannot fix an archived event
+                Nfailed += 1
+                ievent += 1
+            elif ntol > 0:
                 ntol -= 1
                 Nfailed += 1
             else:
                 # avoid too many rerun, give up if fails 5 times consecutively
                 ntol = 5
-                iev += 1
+                ievent += 1
             continue
 
-        # compute diffractive cross-sections from the produced Wilson Lines
-        run_subnucleondiffraction(WilsonLineFileList, iev,
-                                  final_results_folder)
+        ntol = 5
+        packed, failed_list = finish_event(WilsonLineFileList, iev,
+                                           para_dict_,
+                                           para_dict_['num_threads'])
+        if packed:
+            PILOT_STATE['event_times'].append(time.time() - event_start)
+        if not packed or failed_list:
+            Nfailed += 1
+        ievent += 1
+    return Nfailed
+
+
+def run_events_pipelined(para_dict_):
+    """
+        This function overlaps the IPGlasma stage of the next event with
+        the diffraction and hdf5 stages of the current event.
+
+        A producer thread runs IPGlasma and hands the finished events to a
+        consumer thread through a bounded queue, so at most
+        `max_in_flight` events wait for the diffraction stage at any time.
+        It returns the number of failed IPGlasma runs and of events left
+        unfinished or packed with failed diffraction tasks.
+    """
+    event_id_list = get_event_id_list(para_dict_)
+    replay = para_dict_.get('replay', "") != ""
+    n_ipglasma, n_diffraction = split_thread_budget(
+                                            para_dict_['num_threads'])
+    print("\U0001F3CE  Pipelined mode: {} threads for IPGlasma, ".format(
+          n_ipglasma)
+          + "{} for diffraction, {} event(s) in flight".format(
+          n_diffraction, para_dict_['max_in_flight']), flush=True)
+
+    event_queue = queue.Queue(maxsize=para_dict_['max_in_flight'])
+    errors = []
+    stats = {'Nfailed': 0}
+
+    def producer():
+        try:
+            ievent = 0
+            ntol = 5
+            while ievent < len(event_id_list):
+                if errors:
+                    break
+                iev = event_id_list[ievent]
+                event_id = str(iev)
+                final_results_folder = "EVENT_RESULTS_{}".format(event_id)
+                if not can_start_event():
+                    break
+                if not prepare_event_folder(event_id):
+                    ievent += 1
+                    continue
+                event_start = time.time()
+                print("[{}] Generate initial condition for event {} ... ".format(
+                      time.asctime(), iev), flush=True)
+                WilsonLineFileList = get_event_wilson_lines(
+                    para_dict_, iev, final_results_folder, n_ipglasma)
+                if not WilsonLineFileList:
+                    if PILOT_STATE['abort']:
+                        break
+                    print("The IPGlasma event {} did not finish ".format(iev)
+                          + "properly, skip ... ", flush=True)
+                    stats['Nfailed'] += 1
+                    if replay:
+                        ievent += 1
+                    elif ntol > 0:
+                        ntol -= 1
+                    else:
+                        # give up if fails 5 times consecutively
+                        ntol = 5
+                        ievent += 1
+                    continue
+                ntol = 5
+                event_queue.put((iev, WilsonLineFileList, event_start))
+                ievent += 1
+        except Exception as err:
+            errors.append(err)
+        finally:
+            event_queue.put(None)
+
+    def consumer():
+        while True:
+            item = event_queue.get()
+            if item is None:
+                break
+            if errors or PILOT_STATE['abort']:
+                continue
+            iev, WilsonLineFileList, event_start = item
+            try:
+                packed, failed_list = finish_event(
+                    WilsonLineFileList, iev, para_dict_, n_diffraction)
+                if packed:
+                    PILOT_STATE['event_times'].append(
+                                                time.time() - event_start)
+                if not packed or failed_list:
+                    stats['Nfailed'] += 1
+            except Exception as err:
+                errors.append(err)
+
+    threads = [threading.Thread(target=producer, name="ipglasma"),
+               threading.Thread(target=consumer, name="diffraction")]
+    for thread_i in threads:
+        thread_i.start()
+    for thread_i in threads:
+        # join with a timeout, so the signal handlers run promptly
+        while thread_i.is_alive():
+            thread_i.join(1.)
+    if errors:
+        raise errors[0]
+    return stats['Nfailed']
 
-        # zip results into a hdf5 database
-        status = zip_results_into_hdf5(final_results_folder, event_id,
-                                       para_dict_)
 
-        # remove the unwanted outputs if event is finished properly
-        if status:
-            remove_unwanted_outputs(final_results_folder, event_id,
-                                    para_dict_['save_ipglasma'])
-        iev += 1
+def decode_task_index(task_index, para_dict_, n_Q2):
+    """
+        This function maps the index of a diffraction array task of the
+        job to its (event id, Wilson-line file index, Q2 index)
+    """
+    n_per_event = para_dict_['n_wilson_files']*n_Q2
+    event_id_list = get_event_id_list(para_dict_)
+    if task_index//n_per_event >= len(event_id_list):
+        return(None, 0, 0)
+    iev = event_id_list[task_index//n_per_event]
+    ifile = (task_index % n_per_event)//n_Q2
+    iQ2 = task_index % n_Q2
+    return(iev, ifile, iQ2)
+
+
+def run_ipglasma_stage(para_dict_):
+    """
+        This function runs only the IPGlasma stage of the events of the
+        job (the first stage of the DAG mode). It returns the number of
+        events without Wilson lines.
+    """
+    Nfailed = 0
+    for iev in get_event_id_list(para_dict_):
+        if not can_start_event():
+            break
+        event_id = str(iev)
+        final_results_folder = "EVENT_RESULTS_{}".format(event_id)
+        if not prepare_event_folder(event_id):
+            continue
+        WilsonLineFileList = get_event_wilson_lines(
+            para_dict_, iev, final_results_folder, para_dict_['num_threads'])
+        if not WilsonLineFileList:
+            print("The IPGlasma event {} did not finish properly".format(iev),
+                  flush=True)
+            Nfailed += 1
+    return(Nfailed)
+
+
+def save_task_resource_usage(task_folder, iev):
+    """
+        This function adds the resource usage of the event in this process
+        to the resource_usage.json of a diffraction array task, which the
+        merge stage collects into the event
+    """
+    usage_file = path.join(task_folder, "resource_usage.json")
+    record_list = load_task_resource_usage(task_folder)
+    with RESOURCE_LOCK:
+        record_list += RESOURCE_USAGE.get(str(iev), [])
+    with open(usage_file + ".tmp", "w") as f:
+        json.dump(record_list, f, indent=4)
+    os.replace(usage_file + ".tmp", usage_file)
+
+
+def load_task_resource_usage(task_folder):
+    """This function reads the resource usage of a diffraction array task"""
+    try:
+        with open(path.join(task_folder, "resource_usage.json"), "r") as f:
+            return(json.load(f))
+    except (OSError, ValueError):
+        return([])
+
+
+def get_dag_task_folder(final_results_folder, ifile, iQ2):
+    """This function returns the folder of a diffraction array task"""
+    return(path.join(final_results_folder,
+                     "diffraction_{}_{}".format(ifile, iQ2)))
+
+
+def run_diffraction_stage(para_dict_):
+    """
+        This function runs the diffraction tasks of one (event, Wilson-line
+        file, Q2) on a single core (the second stage of the DAG mode). The
+        results go to a task folder with its own hdf5 file and manifest, so
+        the array tasks never write to the same file. It returns the
+        number of failed tasks.
+    """
+    diffractionDict = load_diffraction_parameters()
+    Q2List = diffractionDict['Q2List']
+    iev, ifile, iQ2 = decode_task_index(para_dict_['task_index'], para_dict_,
+                                        len(Q2List))
+    if iev is None:
+        print("Task {} is beyond the events of the job".format(
+              para_dict_['task_index']))
+        return(0)
+    final_results_folder = "EVENT_RESULTS_{}".format(iev)
+    if path.exists(path.join(final_results_folder, "event_{}.h5".format(iev))):
+        print("Event {} finished properly. No need to rerun.".format(iev))
+        return(0)
+    manifest = load_event_manifest(final_results_folder)
+    res_path = path.join(path.abspath(final_results_folder),
+                         "ipglasma_results_{}".format(iev))
+    WilsonLineFileList = sorted(glob(path.join(res_path, "*V-*")))
+    if not manifest['ipglasma'] or not WilsonLineFileList:
+        print("\U0001F6AB  No Wilson lines for event {}".format(iev),
+              flush=True)
+        return(1)
+    if ifile >= len(WilsonLineFileList):
+        # the array is sized for the largest number of Wilson-line files
+        print("Event {} has no Wilson-line file {}, nothing to do".format(
+              iev, ifile))
+        return(0)
+
+    task_folder = get_dag_task_folder(final_results_folder, ifile, iQ2)
+    if not path.exists(task_folder):
+        makedirs(task_folder)
+    h5_path = path.join(task_folder, "tasks.h5")
+    try:
+        hf = h5py.File(h5_path, "a")
+    except OSError:
+        remove(h5_path)
+        save_event_manifest(task_folder, new_event_manifest())
+        hf = h5py.File(h5_path, "a")
+
+    def task_filter(task):
+        if task['fileId'] != ifile:
+            return(False)
+        if task['mode'] == "picture":
+            return(iQ2 == 0)
+        return(task['Q2'] == Q2List[iQ2])
+
+    max_retries = para_dict_.get('max_task_retries', MAX_TASK_RETRIES)
+    with record_stage(iev, "diffraction"):
+        status = run_subnucleondiffraction(WilsonLineFileList, iev, hf,
+                                           task_folder, 1, task_filter,
+                                           max_retries)
+    hf.close()
+    save_task_resource_usage(task_folder, iev)
+    failed_list = get_failed_tasks(load_event_manifest(task_folder),
+                                   max_retries)
+    return(0 if status and not failed_list else 1)
+
+
+def merge_dag_event(iev, para_dict_):
+    """
+        This function packs the results of the diffraction array tasks of
+        an event into its hdf5 file (the merge stage of the DAG mode). It
+        returns whether the event was packed, and the list of the
+        diffraction tasks given up after all their retries. The event is
+        not packed while some tasks can still be rerun.
+    """
+    event_id = str(iev)
+    final_results_folder = "EVENT_RESULTS_{}".format(event_id)
+    if path.exists(path.join(final_results_folder,
+                             "event_{}.h5".format(event_id))):
+        return(True, [])
+    manifest = load_event_manifest(final_results_folder)
+    res_path = path.join(path.abspath(final_results_folder),
+                         "ipglasma_results_{}".format(iev))
+    WilsonLineFileList = sorted(glob(path.join(res_path, "*V-*")))
+    if not manifest['ipglasma'] or not WilsonLineFileList:
+        return(False, [])
+    max_retries = para_dict_.get('max_task_retries', MAX_TASK_RETRIES)
+
+    task_list = get_diffraction_tasks(WilsonLineFileList, iev,
+                                      load_diffraction_parameters())
+    hf, event_group = open_event_hdf5(final_results_folder, event_id)
+    task_folder_list = glob(get_dag_task_folder(final_results_folder,
+                                                "*", "*"))
+    failed_list = []
+    for task_folder in task_folder_list:
+        task_manifest = load_event_manifest(task_folder)
+        failed_list += get_failed_tasks(task_manifest, max_retries)
+        h5_path = path.join(task_folder, "tasks.h5")
+        if not path.exists(h5_path):
+            continue
+        with h5py.File(h5_path, "r") as task_h5:
+            for name in task_h5.keys():
+                if (name in event_group
+                        or not task_manifest['diffraction'].get(name, False)):
+                    continue
+                task_h5.copy(task_h5[name], event_group, name=name)
+    missing_list = [task['output'] for task in task_list
+                    if task['output'] not in event_group
+                    and task['output'] not in failed_list]
+    if missing_list:
+        hf.close()
+        print("\U0001F6AB  Event {} misses {} diffraction tasks".format(
+              iev, len(missing_list)), flush=True)
+        return(False, [])
+    failed_list = sorted(failed_list)
+    record_failed_tasks(iev, event_group, failed_list)
+    # the cost of the array tasks is kept with the event
+    for task_folder in task_folder_list:
+        record_list = load_task_resource_usage(task_folder)
+        with RESOURCE_LOCK:
+            RESOURCE_USAGE.setdefault(event_id, []).extend(record_list)
+    status = zip_results_into_hdf5(final_results_folder, event_id,
+                                   para_dict_, hf)
+    if status:
+        for task_folder in task_folder_list:
+            shutil.rmtree(task_folder, ignore_errors=True)
+        remove_unwanted_outputs(final_results_folder, event_id,
+                                para_dict_['save_ipglasma'])
+    return(status, failed_list)
+
+
+def run_merge_stage(para_dict_):
+    """
+        This function merges the events of the job after the diffraction
+        array (the last stage of the DAG mode). It returns the number of
+        events left unfinished or packed with failed diffraction tasks.
+    """
+    Nfailed = 0
+    for iev in get_event_id_list(para_dict_):
+        packed, failed_list = merge_dag_event(iev, para_dict_)
+        if not packed or failed_list:
+            Nfailed += 1
     combine_all_hdf5_results(para_dict_['event_id0'])
+    return(Nfailed)
+
+
+def run_stage(para_dict_):
+    """This function runs a single stage of the DAG mode"""
+    setup_pilot_mode(para_dict_)
+    stage = para_dict_['stage']
+    print("\U0001F3B6  [{}] DAG stage: {}".format(time.asctime(), stage),
+          flush=True)
+    if stage == "ipglasma":
+        Nfailed = run_ipglasma_stage(para_dict_)
+        write_resource_summary(para_dict_, suffix="_ipglasma")
+    elif stage == "diffraction":
+        Nfailed = run_diffraction_stage(para_dict_)
+    else:
+        Nfailed = run_merge_stage(para_dict_)
+        # with the diffraction costs collected from the array tasks
+        write_resource_summary(para_dict_, suffix="_merge")
+    print("# of unfinished items in stage {}: {}".format(stage, Nfailed))
+    return(Nfailed)
+
+
+def resolve_scratch_root(scratch):
+    """
+        This function picks the node-local scratch directory. With "auto",
+        it uses $TMPDIR, then /dev/shm, then /tmp.
+    """
+    if scratch != "auto":
+        return(path.abspath(scratch))
+    candidate_list = [os.environ.get("TMPDIR", ""), "/dev/shm", "/tmp"]
+    for candidate in candidate_list:
+        if candidate != "" and os.access(candidate, os.W_OK):
+            return(candidate)
+    return(path.abspath("."))
+
+
+def stage_job_to_scratch(scratch_root, para_dict_):
+    """
+        This function copies the executables and the input files of the job
+        to a node-local scratch folder, where all the stages will run.
+        Events already finished in the job folder are linked in, so they
+        are skipped and still included in the final merge.
+    """
+    job_folder = path.abspath(".")
+    staging_folder = path.join(
+        scratch_root, "IPGlasmaFramework_{}_{}".format(
+            para_dict_['event_id0'], os.getpid()))
+    if path.exists(staging_folder):
+        shutil.rmtree(staging_folder)
+    makedirs(staging_folder)
+    print("\U0001F3CE  Staging the job to {} ...".format(staging_folder),
+          flush=True)
+    for script_i in ["run_ipglasma.sh", "run_subnucleondiffraction.sh"]:
+        if path.isfile(script_i):
+            shutil.copy(script_i, staging_folder)
+    for code_folder in ["ipglasma", "subnucleondiffraction"]:
+        if not path.isdir(code_folder):
+            continue
+        mkdir(path.join(staging_folder, code_folder))
+        for entry_i in os.listdir(code_folder):
+            source = path.join(job_folder, code_folder, entry_i)
+            target = path.join(staging_folder, code_folder, entry_i)
+            if entry_i in STAGE_SKIP_LIST:
+                continue
+            if entry_i in STAGE_LINK_LIST:
+                os.symlink(path.realpath(source), target)
+            elif path.isdir(source):
+                shutil.copytree(source, target)
+            else:
+                shutil.copy2(source, target)
+
+    for iev in get_event_id_list(para_dict_):
+        event_folder = "EVENT_RESULTS_{}".format(iev)
+        results_name = path.join(event_folder, "event_{}.h5".format(iev))
+        if path.exists(results_name):
+            makedirs(path.join(staging_folder, event_folder))
+            os.symlink(path.join(job_folder, results_name),
+                       path.join(staging_folder, results_name))
+        elif path.exists(path.join(event_folder, "manifest.json")):
+            # resume from the checkpoint of an interrupted run
+            shutil.copytree(event_folder,
+                            path.join(staging_folder, event_folder))
+    return(staging_folder)
+
+
+def checkpoint_scratch_events(para_dict_):
+    """
+        This function copies the unfinished events from the scratch folder
+        back to the job folder, so that the next run can resume them
+    """
+    for iev in get_event_id_list(para_dict_):
+        event_folder = "EVENT_RESULTS_{}".format(iev)
+        if (path.exists(path.join(event_folder, "event_{}.h5".format(iev)))
+                or not path.exists(path.join(event_folder, "manifest.json"))):
+            continue
+        target_folder = path.join(para_dict_['job_folder'], event_folder)
+        if path.exists(target_folder):
+            shutil.rmtree(target_folder)
+        shutil.copytree(event_folder, target_folder)
+
+
+def sync_event_to_job_folder(event_id, para_dict_):
+    """
+        This function copies the final results of an event from the scratch
+        folder back to the job folder
+    """
+    final_results_folder = "EVENT_RESULTS_{}".format(event_id)
+    target_folder = path.join(para_dict_['job_folder'], final_results_folder)
+    if not path.exists(target_folder):
+        makedirs(target_folder)
+    results_name = "event_{}.h5".format(event_id)
+    shutil.copy2(path.join(final_results_folder, results_name),
+                 path.join(target_folder, results_name + ".tmp"))
+    os.replace(path.join(target_folder, results_name + ".tmp"),
+               path.join(target_folder, results_name))
+    ipglasma_folder = path.join(final_results_folder,
+                                "ipglasma_results_{}".format(event_id))
+    if para_dict_['save_ipglasma'] and path.isdir(ipglasma_folder):
+        target_ipglasma = path.join(target_folder,
+                                    "ipglasma_results_{}".format(event_id))
+        if path.exists(target_ipglasma):
+            shutil.rmtree(target_ipglasma)
+        shutil.copytree(ipglasma_folder, target_ipglasma)
+
+
+def main(para_dict_):
+    """This is the main function"""
+    num_threads = para_dict_['num_threads']
+    curr_time = time.asctime()
+    print("\U0001F3CE  [{}] Number of threads: {}".format(curr_time,
+                                                          num_threads),
+          flush=True)
+
+    nev = para_dict_['n_events']
+    if para_dict_.get('replay', "") != "":
+        para_dict_['replay_events'] = get_replay_events(
+            para_dict_['replay'], para_dict_['event_id0'], nev,
+            para_dict_.get('event_ids', []))
+        nev = len(para_dict_['replay_events'])
+        print("\U0001F3B6  Replay {} events from {}".format(
+              nev, para_dict_['replay']), flush=True)
+    if para_dict_.get('stage', "all") != "all":
+        run_stage(para_dict_)
+        return
+    deadline_timer = setup_pilot_mode(para_dict_)
+    staging_folder = None
+    if para_dict_.get('scratch', "") != "":
+        para_dict_['job_folder'] = path.abspath(".")
+        staging_folder = stage_job_to_scratch(
+            resolve_scratch_root(para_dict_['scratch']), para_dict_)
+        os.chdir(staging_folder)
+    Nfailed = 0
+    try:
+        if para_dict_.get('pipeline', False) and nev > 1:
+            Nfailed = run_events_pipelined(para_dict_)
+        else:
+            Nfailed = run_events_sequentially(para_dict_)
+    finally:
+        # always leave the merged results of the finished events
+        if deadline_timer is not None:
+            deadline_timer.cancel()
+        combine_all_hdf5_results(para_dict_['event_id0'])
+        if staging_folder is not None:
+            checkpoint_scratch_events(para_dict_)
+            results_name = "RESULTS_{}.h5".format(para_dict_['event_id0'])
+            if path.exists(results_name):
+                shutil.copy2(results_name, para_dict_['job_folder'])
+            os.chdir(para_dict_['job_folder'])
+            shutil.rmtree(staging_folder, ignore_errors=True)
+        write_resource_summary(para_dict_)
     print("# of failed events: {0}, failure rate: {1:.3f}".format(
-                                Nfailed, float(Nfailed)/float(Nfailed + nev)))
+          Nfailed, float(Nfailed)/float(max(1, Nfailed + nev))))
 
 
 if __name__ == "__main__":
-    try:
-        INITIAL_CONDITION_TYPE = str(sys.argv[1])
-        EVENT_ID0 = int(sys.argv[2])
-        N_EVENTS = int(sys.argv[3])
-        N_THREADS = int(sys.argv[4])
-        SAVE_IPGLASMA = (sys.argv[5].lower() == "true")
-        #SEED = int(sys.argv[6])
-    except IndexError:
-        print_usage()
-        exit(0)
+    parser = argparse.ArgumentParser(
+        description='\U0001F3B6 Run IPGlasma + subnucleondiffraction events')
+    parser.add_argument('initial_condition_type', type=str,
+                        help='initial condition type')
+    parser.add_argument('event_id0', type=int, help='first event id')
+    parser.add_argument('n_events', type=int, help='number of events')
+    parser.add_argument('n_threads', type=int, help='number of threads')
+    parser.add_argument('save_ipglasma', type=str,
+                        help='flag to keep the IPGlasma results')
+    parser.add_argument('--pipeline', action='store_true',
+                        help=('overlap IPGlasma of the next event with the '
+                              + 'diffraction of the current one'))
+    parser.add_argument('--max_in_flight', type=int, default=1,
+                        help=('number of finished IPGlasma events allowed '
+                              + 'to wait for the diffraction stage'))
+    parser.add_argument('--scratch', type=str, default="",
+                        help=('run all stages in a node-local folder '
+                              + '(a path, or "auto" for $TMPDIR, /dev/shm, '
+                              + '/tmp) and copy back only the final results'))
+    parser.add_argument('--deadline', type=str, default="",
+                        help=('walltime of the allocation (HH:MM:SS); new '
+                              + 'events start only if they are predicted '
+                              + 'to finish, and the job is checkpointed '
+                              + 'and merged before the end of the Slurm '
+                              + 'job, or the walltime from now outside '
+                              + 'Slurm'))
+    parser.add_argument('--deadline_margin', type=float, default=120.,
+                        help=('seconds before the deadline kept to '
+                              + 'checkpoint and merge the results'))
+    parser.add_argument('--stage', type=str, default="all",
+                        choices=["all", "ipglasma", "diffraction", "merge"],
+                        help=('run a single stage of the DAG mode instead '
+                              + 'of the full events'))
+    parser.add_argument('--task_index', type=int, default=0,
+                        help=('index of the diffraction array task within '
+                              + 'the job'))
+    parser.add_argument('--n_wilson_files', type=int, default=1,
+                        help=('largest number of Wilson-line files per '
+                              + 'event, which sizes the diffraction array'))
+    parser.add_argument('--replay', type=str, default="",
+                        help=('run only subnucleondiffraction over the saved '
+                              + 'Wilson lines in a folder or hdf5 archive; '
+                              + 'event_id0 is then the position of the first '
+                              + 'archived event of this job'))
+    parser.add_argument('--max_task_retries', type=int,
+                        default=MAX_TASK_RETRIES,
+                        help=('number of reruns of a failed diffraction '
+                              + 'task before its event is packed without '
+                              + 'it'))
+    parser.add_argument('--event_ids', type=str, default="",
+                        help=('run only these event ids, e.g. "3,7,10-12", '
+                              + 'instead of event_id0 ... event_id0 + '
+                              + 'n_events - 1; with --replay, the archived '
+                              + 'events with these ids'))
+    args = parser.parse_args()
+    INITIAL_CONDITION_TYPE = args.initial_condition_type
 
     known_initial_types = [
         "IPGlasma", "IPSat"
@@ -278,11 +1720,26 @@ if __name__ == "__main__":
 
     para_dict = {
         'initial_type': INITIAL_CONDITION_TYPE,
-        'event_id0': EVENT_ID0,
-        'n_events': N_EVENTS,
-        'num_threads': N_THREADS,
-        'save_ipglasma': SAVE_IPGLASMA,
-        #'random_seed': SEED,
+        'event_id0': args.event_id0,
+        'n_events': args.n_events,
+        'num_threads': args.n_threads,
+        'save_ipglasma': (args.save_ipglasma.lower() == "true"),
+        'pipeline': args.pipeline,
+        'max_in_flight': max(1, args.max_in_flight),
+        'scratch': args.scratch,
+        'replay': args.replay,
+        'deadline': args.deadline,
+        'deadline_margin': args.deadline_margin,
+        'stage': args.stage,
+        'task_index': args.task_index,
+        'n_wilson_files': max(1, args.n_wilson_files),
+        'max_task_retries': max(0, args.max_task_retries),
     }
+    if args.replay != "":
+        para_dict['replay'] = path.abspath(args.replay)
+    if args.event_ids != "":
+        para_dict['event_ids'] = parse_event_ids(args.event_ids)
+        para_dict['event_id0'] = para_dict['event_ids'][0]
+        para_dict['n_events'] = len(para_dict['event_ids'])
 
     main(para_dict)
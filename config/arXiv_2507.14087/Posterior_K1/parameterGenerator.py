@@ -4,38 +4,49 @@
     can be read in by the iEBE-MUSIC package.
 """
 
-import pickle
 import sys
+from os import path
 
 parameterName = [
     "m", "BG", "BGq", "useConstituentQuarkProton", "smearingWidth",
     "QsmuRatio", "m_jimwlk", "Lambda_QCD_jimwlk"
 ]
 
-try:
-    setId = int(sys.argv[1])
-    setFlag = int(sys.argv[2])
-    paramFile = str(sys.argv[3])
-except:
-    print("Usage: parameterGenerator.py <setId> <setFlag> <paramFile>")
-    sys.exit(1)
-
-with open("chain.pkl", 'rb') as f:
-    data = pickle.load(f)
-
-setName = 'chain'
-
-nParamSets = data[setName].shape[0]
-setId = setId % nParamSets
-paramSet = data[setName][setId, :]
-print(f"Using parameter set: {setId} from {setName}")
-paramDict = {}
-for i, param_i in enumerate(parameterName):
-    paramDict[param_i] = paramSet[i]
-paramDict['UVdamp'] = 0.
-paramDict['omega'] = 1.
-paramDict['Kfactor'] = 1.
-
-with open(paramFile, "w") as f:
-    for key_i in paramDict.keys():
-        f.write("{}  {}\n".format(key_i, paramDict[key_i]))
+
+def get_parameter_dict(paramSet):
+    """This function maps a row of the posterior chain to the parameters"""
+    paramDict = {}
+    for i, param_i in enumerate(parameterName):
+        paramDict[param_i] = paramSet[i]
+    paramDict['UVdamp'] = 0.
+    paramDict['omega'] = 1.
+    paramDict['Kfactor'] = 1.
+    return(paramDict)
+
+
+if __name__ == "__main__":
+    try:
+        setId = int(sys.argv[1])
+        setFlag = int(sys.argv[2])
+        paramFile = str(sys.argv[3])
+    except:
+        print("Usage: parameterGenerator.py <setId> <setFlag> <paramFile>")
+        sys.exit(1)
+
+    # read the chain through the memory-mapped posterior store
+    sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                                 "../.."))
+    from posterior_store import open_chain
+
+    setName = 'chain'
+    chain = open_chain(path.dirname(path.abspath(__file__)), setName)
+
+    nParamSets = chain.shape[0]
+    setId = setId % nParamSets
+    paramSet = chain[setId, :]
+    print(f"Using parameter set: {setId} from {setName}")
+    paramDict = get_parameter_dict(paramSet)
+
+    with open(paramFile, "w") as f:
+        for key_i in paramDict.keys():
+            f.write("{}  {}\n".format(key_i, paramDict[key_i]))
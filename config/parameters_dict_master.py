@@ -7,15 +7,20 @@ from os import path, makedirs
 import sys
 import shutil
 import argparse
+import copy
+import hashlib
+import json
 
 # control parameters
 control_dict = {
     'initial_state_type': "IPGlasma",  # options: IPGlasma, IPsat
-    'walltime': "10:00:00",            # walltime to run
+    'walltime': "10:00:00",            # walltime to run ("auto": cost model)
+    'max_walltime': "24:00:00",        # longest walltime for "auto"
     'save_ipglasma_results': False,    # flag to save IPGlasma results
     'usePosteriorParameters': False,   # flag to use posterior parameters
     'PosteriorChainFilePath': "config/arXiv_2507.14087/Posterior_wK",
-    'PosteriorParamSet': 0,
+    'PosteriorParamSet': 0,            # -1: random set drawn from the seed
+    'PosteriorDrawPerJob': False,      # draw a set for every job
 }
 
 
@@ -139,79 +144,141 @@ path_list = [
 ]
 
 
-def update_parameters_dict(par_dict_path, ran_seed) -> None:
-    """This function update the parameters dictionaries with user's settings"""
-    par_diretory = path.dirname(par_dict_path)
-    sys.path.insert(0, par_diretory)
-    print(par_diretory)
-    parameters_dict = __import__(par_dict_path.split('.py')[0].split('/')[-1])
+RENDER_CACHE = {}
+
+
+def get_merged_parameters(user_parameters, ran_seed=-1, bayes_dict=None):
+    """
+        This function merges the master parameters with the user's settings
+        and the parameters from a bayesian analysis or posterior draw. It
+        returns a deep copy of Parameters_list and leaves the master
+        dictionaries untouched. user_parameters is the user parameter
+        module (or a dict of its dictionaries).
+    """
+    if not isinstance(user_parameters, dict):
+        user_parameters = {
+            'control_dict': user_parameters.control_dict,
+            'ipglasma_dict': getattr(user_parameters, 'ipglasma_dict', {}),
+        }
     initial_condition_type = (
-                    parameters_dict.control_dict['initial_state_type'])
-    if initial_condition_type in ("IPGlasma"):
-        ipglasma_dict.update(parameters_dict.ipglasma_dict)
+                    user_parameters['control_dict']['initial_state_type'])
+    merged_list = []
+    for parameters_dict, fname, itype in Parameters_list:
+        merged_dict = copy.deepcopy(parameters_dict)
+        if (parameters_dict is ipglasma_dict
+                and initial_condition_type in ("IPGlasma")):
+            merged_dict.update(
+                copy.deepcopy(user_parameters['ipglasma_dict']))
+
+            # set random seed
+            if ran_seed == -1:
+                merged_dict['useTimeForSeed'] = 1
+            else:
+                merged_dict['seed'] = ran_seed
+
+            if "Rapidity" in merged_dict:
+                # backward compatibility
+                merged_dict['RapidityA'] = merged_dict['Rapidity']
+                merged_dict['RapidityB'] = merged_dict['Rapidity']
+
+        if parameters_dict is ipglasma_dict and bayes_dict is not None:
+            for key, val in bayes_dict.items():
+                if key in merged_dict.keys():
+                    merged_dict[key] = float(val)
+        merged_list.append((merged_dict, fname, itype))
+    return(merged_list)
 
-        # set random seed
-        if ran_seed == -1:
-            ipglasma_dict['useTimeForSeed'] = 1
-        else:
-            ipglasma_dict['seed'] = ran_seed
 
-        if "Rapidity" in ipglasma_dict:
-            # backward compatibility
-            ipglasma_dict['RapidityA'] = ipglasma_dict['Rapidity']
-            ipglasma_dict['RapidityB'] = ipglasma_dict['Rapidity']
+def read_bayes_file(bayes_file):
+    """This function reads a parameter file from bayesian analysis"""
+    bayes_dict = {}
+    with open(bayes_file, "r") as parfile:
+        for line in parfile:
+            if line.strip() == "":
+                continue
+            key, val = line.split()
+            bayes_dict[key] = float(val)
+    return(bayes_dict)
 
 
-def update_parameters_bayesian(bayes_file) -> None:
-    parfile = open(bayes_file, "r")
-    for line in parfile:
-        key, val = line.split()
-        if key in ipglasma_dict.keys():
-            ipglasma_dict[key] = float(val)
+def get_parameters_hash(parameters_list):
+    """This function returns the content hash of a merged parameter set"""
+    content = json.dumps([[parameters_dict, fname, itype]
+                          for parameters_dict, fname, itype in parameters_list],
+                         sort_keys=True, default=str)
+    return(hashlib.sha1(content.encode()).hexdigest())
 
 
-def output_parameters_to_files(workfolder=".") -> None:
-    """This function outputs parameters in dictionaries to files"""
+def render_parameters(parameters_dict, itype):
+    """This function renders a parameter dictionary to the file content"""
+    lines = []
+    for key_name in parameters_dict:
+        if itype in (0, 2):
+            lines.append("{parameter_name}  {parameter_value}\n".format(
+                parameter_name=key_name,
+                parameter_value=parameters_dict[key_name]))
+        elif itype == 1:
+            lines.append("{parameter_name} = {parameter_value}\n".format(
+                parameter_name=key_name,
+                parameter_value=parameters_dict[key_name]))
+        elif itype == 3:
+            if key_name in ("type", "database_name_pattern"): continue
+            if isinstance(parameters_dict[key_name], list):
+                if parameters_dict[key_name] != []:
+                    varStr = ",".join(
+                        [str(var) for var in parameters_dict[key_name]])
+                    lines.append(f"{key_name}  {varStr}\n")
+            else:
+                lines.append("{parameter_name}  {parameter_value}\n".format(
+                    parameter_name=key_name,
+                    parameter_value=parameters_dict[key_name]))
+        elif itype == 4:
+            lines.append("[{}]\n".format(key_name))
+            for subkey_name in parameters_dict[key_name]:
+                lines.append("{parameter_name} = {parameter_value}\n".format(
+                    parameter_name=subkey_name,
+                    parameter_value=parameters_dict[key_name][subkey_name]))
+    if itype == 2:
+        lines.append("EndOfData")
+    elif itype == 3:
+        lines.append("EndOfFile")
+    return("".join(lines))
+
+
+def render_input_files(parameters_list):
+    """
+        This function renders the input files of a merged parameter set.
+        It returns a list of (relative file path, content). The rendered
+        files are cached by the content hash of the parameter set.
+    """
+    parameters_hash = get_parameters_hash(parameters_list)
+    if parameters_hash not in RENDER_CACHE:
+        RENDER_CACHE[parameters_hash] = [
+            (path.join(path_list[idict], fname),
+             render_parameters(parameters_dict, itype))
+            for idict, (parameters_dict, fname, itype)
+            in enumerate(parameters_list)]
+    return(RENDER_CACHE[parameters_hash])
+
+
+def write_input_files(parameters_list, workfolder=".") -> None:
+    """
+        This function writes the input files of a merged parameter set to
+        workfolder. An existing file with identical content is not rewritten.
+    """
     workfolder = path.abspath(workfolder)
     print("\U0001F375  Output input parameter files to {}...".format(
                                                                 workfolder))
-    for idict, (parameters_dict, fname, itype) in enumerate(Parameters_list):
-        output_folder = path.join(workfolder, path_list[idict])
-        if not path.exists(output_folder):
-            makedirs(output_folder)
-        f = open(path.join(output_folder, fname), "w")
-        for key_name in parameters_dict:
-            if itype in (0, 2):
-                f.write("{parameter_name}  {parameter_value}\n".format(
-                    parameter_name=key_name,
-                    parameter_value=parameters_dict[key_name]))
-            elif itype == 1:
-                f.write("{parameter_name} = {parameter_value}\n".format(
-                    parameter_name=key_name,
-                    parameter_value=parameters_dict[key_name]))
-            elif itype == 3:
-                if key_name in ("type", "database_name_pattern"): continue
-                if isinstance(parameters_dict[key_name], list):
-                    if parameters_dict[key_name] != []:
-                        varStr = ",".join(
-                            [str(var) for var in parameters_dict[key_name]])
-                        f.write(f"{key_name}  {varStr}\n")
-                else:
-                    f.write("{parameter_name}  {parameter_value}\n".format(
-                        parameter_name=key_name,
-                        parameter_value=parameters_dict[key_name]))
-            elif itype == 4:
-                f.write("[{}]\n".format(key_name))
-                for subkey_name in parameters_dict[key_name]:
-                    f.write("{parameter_name} = {parameter_value}\n".format(
-                        parameter_name=subkey_name,
-                        parameter_value=parameters_dict[key_name][subkey_name])
-                    )
-        if itype == 2:
-            f.write("EndOfData")
-        elif itype == 3:
-            f.write("EndOfFile")
-        f.close()
+    for file_name, content in render_input_files(parameters_list):
+        file_name = path.join(workfolder, file_name)
+        if path.isfile(file_name):
+            with open(file_name, "r") as f:
+                if f.read() == content:
+                    continue
+        if not path.exists(path.dirname(file_name)):
+            makedirs(path.dirname(file_name))
+        with open(file_name, "w") as f:
+            f.write(content)
 
 
 if __name__ == "__main__":
@@ -231,7 +298,11 @@ if __name__ == "__main__":
                         type=int, default=-1,
                         help='input random seed')
     args = parser.parse_args()
-    update_parameters_dict(path.abspath(args.par_dict), args.random_seed)
+    par_dict_path = path.abspath(args.par_dict)
+    sys.path.insert(0, path.dirname(par_dict_path))
+    user_parameters = __import__(par_dict_path.split('.py')[0].split('/')[-1])
+    bayes_dict = None
     if args.bayes_file != "":
-        update_parameters_bayesian(args.bayes_file)
-    output_parameters_to_files(args.path)
+        bayes_dict = read_bayes_file(args.bayes_file)
+    write_input_files(get_merged_parameters(user_parameters, args.random_seed,
+                                            bayes_dict), args.path)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+    This script stores the posterior chains of a Bayesian analysis
+    (Posterior_*/chain.pkl) as memory-mapped numpy arrays, and draws the
+    parameter sets of the jobs from them.
+
+    The pickle file is converted once to chain.npy, with a column index in
+    chain_index.json. Later draws only read the selected rows.
+
+    Usage: posterior_store.py Posterior_folder [n_sets seed]
+"""
+
+import sys
+import json
+import pickle
+import importlib.util
+from os import path
+import numpy as np
+
+INDEX_FILENAME = "chain_index.json"
+
+
+def load_parameter_generator(chain_folder):
+    """
+        This function imports the parameterGenerator.py of a posterior
+        folder, which maps a row of the chain to the model parameters
+    """
+    spec = importlib.util.spec_from_file_location(
+        "parameterGenerator_{}".format(path.basename(path.abspath(
+            chain_folder))),
+        path.join(chain_folder, "parameterGenerator.py"))
+    generator = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(generator)
+    return(generator)
+
+
+def convert_chain(chain_folder, set_name="chain"):
+    """
+        This function converts the chain in chain.pkl to chain.npy and
+        writes the column index. The source size and modification time
+        are recorded, so that a changed pickle file is converted again.
+    """
+    pickle_file = path.join(chain_folder, "chain.pkl")
+    with open(pickle_file, "rb") as f:
+        data = pickle.load(f)
+    chain = np.ascontiguousarray(data[set_name], dtype=np.float64)
+    np.save(path.join(chain_folder, "{}.npy".format(set_name)), chain)
+    generator = load_parameter_generator(chain_folder)
+    index = {
+        'set_name': set_name,
+        'shape': list(chain.shape),
+        'columns': {name: i for i, name in
+                    enumerate(generator.parameterName)},
+        'source_size': path.getsize(pickle_file),
+        'source_mtime': path.getmtime(pickle_file),
+    }
+    with open(path.join(chain_folder, INDEX_FILENAME), "w") as f:
+        json.dump(index, f, indent=4)
+    print("\U0001F4BE  Converted {} ({} sets) to {}.npy".format(
+          pickle_file, chain.shape[0], set_name))
+    return(chain)
+
+
+def open_chain(chain_folder, set_name="chain"):
+    """
+        This function returns the chain as a memory-mapped array. It is
+        converted from the pickle file if needed. If the folder is not
+        writable, the pickle file is read into memory instead.
+    """
+    pickle_file = path.join(chain_folder, "chain.pkl")
+    npy_file = path.join(chain_folder, "{}.npy".format(set_name))
+    index_file = path.join(chain_folder, INDEX_FILENAME)
+    up_to_date = path.isfile(npy_file) and path.isfile(index_file)
+    if up_to_date and path.isfile(pickle_file):
+        with open(index_file, "r") as f:
+            index = json.load(f)
+        up_to_date = (index.get('set_name') == set_name
+                      and index['source_size'] == path.getsize(pickle_file)
+                      and index['source_mtime'] == path.getmtime(pickle_file))
+    if not up_to_date:
+        try:
+            convert_chain(chain_folder, set_name)
+        except OSError as e:
+            print("\U0001F6AB  Can not write the chain store: {}".format(e))
+            with open(pickle_file, "rb") as f:
+                return(np.asarray(pickle.load(f)[set_name]))
+    return(np.load(npy_file, mmap_mode="r"))
+
+
+def draw_parameter_sets(chain_folder, n_sets, seed=-1, set_id=-1):
+    """
+        This function draws n_sets parameter sets from the posterior chain
+        in one vectorised call. With set_id >= 0 all the draws use that
+        set. Otherwise the sets are drawn uniformly, reproducibly for a
+        given seed (seed = -1: from the system entropy). It returns a list
+        of (set id, parameter dictionary).
+    """
+    chain = open_chain(chain_folder)
+    n_rows = chain.shape[0]
+    if set_id >= 0:
+        set_ids = np.full(n_sets, set_id % n_rows, dtype=np.int64)
+    else:
+        rng = np.random.default_rng(None if seed == -1 else seed)
+        set_ids = rng.integers(0, n_rows, size=n_sets)
+    # fancy indexing reads only the selected rows of the memory map
+    unique_ids, inverse = np.unique(set_ids, return_inverse=True)
+    rows = np.asarray(chain[unique_ids, :])
+    generator = load_parameter_generator(chain_folder)
+    parameter_list = [
+        {key: float(val) for key, val in
+         generator.get_parameter_dict(row).items()} for row in rows]
+    return([(int(unique_ids[i]), parameter_list[i]) for i in inverse])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(1)
+    CHAIN_FOLDER = path.abspath(sys.argv[1])
+    if len(sys.argv) < 4:
+        convert_chain(CHAIN_FOLDER)
+    else:
+        for set_id, parameters in draw_parameter_sets(
+                CHAIN_FOLDER, int(sys.argv[2]), int(sys.argv[3])):
+            print(set_id, json.dumps(parameters))
@@ -2,12 +2,14 @@
 """This script generate all the running jobs."""
 
 import sys
+import os
 from os import path, mkdir,path
 import shutil
-import subprocess
 import argparse
+import json
 from math import ceil
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 
 known_initial_types = [
     "IPGlasma", "IPsat",
@@ -19,9 +21,10 @@ support_cluster_list = [
 
 
 def write_script_header(cluster, script, n_threads, event_id, walltime,
-                        working_folder):
+                        working_folder, mem=None):
     """This function write the header of the job submission script"""
-    mem = 4*n_threads
+    if mem is None:
+        mem = 4*n_threads
     if cluster == "nersc":
         script.write("""#!/bin/bash -l
 #SBATCH -p shared
@@ -93,7 +96,7 @@ cd {4:s}
 cd {4:s}
 """.format(event_id, n_threads, mem, walltime, working_folder))
     elif cluster in ("local", "OSG"):
-        script.write("#!/bin/bash")
+        script.write("#!/bin/bash\n")
     else:
         print("\U0001F6AB  unrecognized cluster name :", cluster)
         print("Available options: ", support_cluster_list)
@@ -119,16 +122,11 @@ def generate_nersc_mpi_job_script(folder_name, n_nodes, n_threads,
 
 export OMP_PROC_BIND=true
 export OMP_PLACES=threads
+export OMP_NUM_THREADS={2:d}
 
-num_of_nodes={0:d}
-# run all the job
-for (( nodeid=1; nodeid <= $num_of_nodes; nodeid++ ))
-do
-    export OMP_NUM_THREADS={2:d}
-    srun -N 1 -n {3:d} -c {2:d} python job_MPI_wrapper.py {3:d} $nodeid &
-done
-wait
-""".format(n_nodes, walltime, n_threads, n_jobs_per_node))
+# rank 0 dispatches the event folders to the other ranks
+srun -N {0:d} -n {3:d} -c {2:d} --overcommit python job_MPI_wrapper.py --walltime {1:s}
+""".format(n_nodes, walltime, n_threads, n_nodes*n_jobs_per_node + 1))
     script.close()
 
 
@@ -151,22 +149,18 @@ def generate_nerscKNL_mpi_job_script(folder_name, n_nodes, n_threads,
 
 export OMP_PROC_BIND=true
 export OMP_PLACES=cores
+export OMP_NUM_THREADS={2:d}
 
-num_of_nodes={0:d}
-# run all the job
-for (( nodeid=1; nodeid <= $num_of_nodes; nodeid++ ))
-do
-    export OMP_NUM_THREADS={2:d}
-    srun -N 1 -n {3:d} -c {2:d} python job_MPI_wrapper.py {3:d} $nodeid &
-done
-wait
-""".format(n_nodes, walltime, n_threads, n_jobs_per_node))
+# rank 0 dispatches the event folders to the other ranks
+srun -N {0:d} -n {3:d} -c {2:d} --overcommit python job_MPI_wrapper.py --walltime {1:s}
+""".format(n_nodes, walltime, n_threads, n_nodes*n_jobs_per_node + 1))
     script.close()
 
 
 def generate_full_job_script(cluster_name, folder_name, initial_type,
                              ev0_id, n_ev, n_threads, ipglasma_flag, python_venv,
-                             walltime,array_job=False):
+                             walltime,array_job=False, driver_options="",
+                             mem=None, stagger=0):
     """This function generates full job script"""
     working_folder = folder_name
     event_id = working_folder.split('/')[-1]
@@ -177,31 +171,195 @@ def generate_full_job_script(cluster_name, folder_name, initial_type,
 
     script = open(path.join(working_folder, script_name), "w")
     write_script_header(cluster_name, script, n_threads, event_id, walltime,
-                        working_folder)
+                        working_folder, mem)
 
-    if python_venv != "":
-        script.write(f"source {path.abspath(python_venv)}/bin/activate")
+    if python_venv not in ("", "-1"):
+        script.write(f"source {path.abspath(python_venv)}/bin/activate\n")
 
 
     if cluster_name != "OSG": 
         if array_job==False:
             script.write("""
-    python3 simulation_driver.py {0:s} {1:d} {2:d} {3:d} {4} > run.log
-    """.format(initial_type, ev0_id, n_ev, n_threads, ipglasma_flag))
+    export IPGLASMA_STAGGER=${{IPGLASMA_STAGGER:-{6:d}}}
+    python3 simulation_driver.py {0:s} {1:d} {2:d} {3:d} {4} {5} > run.log
+    """.format(initial_type, ev0_id, n_ev, n_threads, ipglasma_flag,
+               driver_options, stagger))
         else:
             # generate array job script
             script.write("""
-(cd event_${{SLURM_ARRAY_TASK_ID}}; python3 simulation_driver.py {0:s} ${{SLURM_ARRAY_TASK_ID}} {1:d} {2:d} {3} > run.log)
-            """.format(initial_type, n_ev, n_threads, ipglasma_flag))
+(cd event_${{SLURM_ARRAY_TASK_ID}}; export IPGLASMA_STAGGER=${{SLURM_ARRAY_TASK_ID}}; python3 simulation_driver.py {0:s} ${{SLURM_ARRAY_TASK_ID}} {1:d} {2:d} {3} {4} > run.log)
+            """.format(initial_type, n_ev, n_threads, ipglasma_flag,
+                       driver_options))
     else:
         script.write("""
-python3 simulation_driver.py {0:s} {1:d} {2:d} {3:d} {4}
-""".format(initial_type, ev0_id, n_ev, n_threads, ipglasma_flag))
+python3 simulation_driver.py {0:s} {1:d} {2:d} {3:d} {4} {5}
+""".format(initial_type, ev0_id, n_ev, n_threads, ipglasma_flag,
+           driver_options))
+    script.close()
+
+
+def generate_dag_stage_script(folder_name, initial_type, ev0_id, n_ev,
+                              n_threads, ipglasma_flag, python_venv,
+                              n_wilson_files, driver_options="", stagger=0):
+    """
+        This function generates the script running one stage of the DAG
+        mode in a job folder: ipglasma, diffraction <task_index>, or merge
+    """
+    script = open(path.join(folder_name, "run_stage.sh"), "w")
+    script.write("""#!/usr/bin/env bash
+
+stage=$1
+task_index=${{2:-0}}
+export IPGLASMA_STAGGER=${{IPGLASMA_STAGGER:-{0:d}}}
+""".format(stagger))
+    if python_venv not in ("", "-1"):
+        script.write(f"source {path.abspath(python_venv)}/bin/activate\n")
+    script.write("""
+python3 simulation_driver.py {0:s} {1:d} {2:d} {3:d} {4} {5} --stage $stage --task_index $task_index --n_wilson_files {6:d} > run_${{stage}}_${{task_index}}.log
+""".format(initial_type, ev0_id, n_ev, n_threads, ipglasma_flag,
+           driver_options, n_wilson_files))
+    script.close()
+
+
+def get_array_chunks(n_array, max_array_size):
+    """
+        This function splits an array of n_array elements into chunks of
+        at most max_array_size elements. It returns a list of (offset,
+        size).
+    """
+    max_array_size = max(1, max_array_size)
+    return([(offset, min(max_array_size, n_array - offset))
+            for offset in range(0, n_array, max_array_size)])
+
+
+def generate_slurm_dag(folder_name, n_jobs, n_tasks_per_job, n_threads,
+                       walltime, mem, max_array_size=1000, array_throttle=0):
+    """
+        This function generates the Slurm arrays of the DAG mode: an
+        IPGlasma array with one element per job folder, a dependent
+        single-core array with one element per (event, Wilson-line file,
+        Q2) diffraction task, and a final merge job.
+
+        The arrays are submitted by submit_dag.sh in chunks of at most
+        max_array_size elements, below the MaxArraySize of Slurm, and the
+        chunk offset is added to the array index. With array_throttle > 0,
+        at most that many elements of a chunk run at a time.
+    """
+    working_folder = folder_name
+    stage_list = [
+        ("ipglasma", n_jobs, n_threads, mem,
+         "cd event_${task_id}\nbash run_stage.sh ipglasma\n"),
+        ("diffraction", n_jobs*n_tasks_per_job, 1, 2,
+         "ijob=$((task_id / {0:d}))\n".format(n_tasks_per_job)
+         + "cd event_${ijob}\n"
+         + "bash run_stage.sh diffraction "
+         + "$((task_id % {0:d}))\n".format(n_tasks_per_job)),
+        ("merge", 1, 1, 2,
+         "for ijob in $(seq 0 {0:d}); do\n".format(n_jobs - 1)
+         + "    (cd event_${ijob}; bash run_stage.sh merge)\ndone\n"),
+    ]
+    throttle = ""
+    if array_throttle > 0:
+        throttle = "%{}".format(array_throttle)
+    submit_lines = []
+    dependency = ""
+    for stage, n_array, n_cpus, mem_stage, commands in stage_list:
+        script = open(path.join(working_folder,
+                                "submit_dag_{}.script".format(stage)), "w")
+        script.write("""#!/usr/bin/env bash
+#SBATCH --job-name {0:s}
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task={1:d}
+#SBATCH --mem={2:.0f}G
+#SBATCH -t {3:s}
+#SBATCH -o log/{0:s}_%A_%a.log
+
+# the array is submitted in chunks by submit_dag.sh, with the offset of
+# the chunk in DAG_TASK_OFFSET
+task_id=$((SLURM_ARRAY_TASK_ID + ${{DAG_TASK_OFFSET:-0}}))
+cd {4:s}
+{5:s}""".format(stage, n_cpus, mem_stage, walltime, working_folder,
+                commands))
+        script.close()
+
+        jid_list = []
+        for ichunk, (offset, size) in enumerate(
+                get_array_chunks(n_array, max_array_size)):
+            jid_list.append("${{jid_{}_{}}}".format(stage, ichunk))
+            submit_lines.append(
+                "jid_{0}_{1}=$(sbatch --parsable{2} --array=0-{3}{4} ".format(
+                    stage, ichunk, dependency, size - 1, throttle)
+                + "--export=ALL,DAG_TASK_OFFSET={0} ".format(offset)
+                + "submit_dag_{}.script)".format(stage))
+        dependency = " --dependency=afterany:{}".format(":".join(jid_list))
+
+    script = open(path.join(working_folder, "submit_dag.sh"), "w")
+    script.write("""#!/usr/bin/env bash
+
+mkdir -p log
+{}
+""".format("\n".join(submit_lines)))
     script.close()
 
 
-def generate_script_ipglasma(folder_name, nthreads, cluster_name, event_id):
-    """This function generates script for IPGlasma simulation"""
+def generate_condor_dag(folder_name, n_jobs, n_tasks_per_job, n_threads,
+                        mem):
+    """
+        This function generates the HTCondor DAGMan description of the DAG
+        mode, with the same three stages as the Slurm arrays
+    """
+    working_folder = folder_name
+    stage_list = [
+        ("ipglasma", n_jobs, n_threads, mem,
+         "event_$(Process)", "ipglasma"),
+        ("diffraction", n_jobs*n_tasks_per_job, 1, 2,
+         "event_$INT(ijob)", "diffraction $INT(itask)"),
+        ("merge", n_jobs, 1, 2, "event_$(Process)", "merge"),
+    ]
+    for stage, n_queue, n_cpus, mem_stage, initialdir, arguments in stage_list:
+        script = open(path.join(working_folder,
+                                "dag_{}.sub".format(stage)), "w")
+        script.write("""universe = vanilla
+executable = /bin/bash
+""")
+        if stage == "diffraction":
+            script.write("""ijob = $(Process) / {0:d}
+itask = $(Process) % {0:d}
+""".format(n_tasks_per_job))
+        script.write("""arguments = run_stage.sh {0:s}
+initialdir = {1:s}
+should_transfer_files = NO
+
+error = ../log/{2:s}.$(Cluster).$(Process).error
+output = ../log/{2:s}.$(Cluster).$(Process).output
+log = ../log/{2:s}.log
+
+request_cpus = {3:d}
+request_memory = {4:.0f} GB
+
+queue {5:d}
+""".format(arguments, initialdir, stage, n_cpus, mem_stage, n_queue))
+        script.close()
+
+    script = open(path.join(working_folder, "jobs.dag"), "w")
+    script.write("""JOB IPGLASMA dag_ipglasma.sub
+JOB DIFFRACTION dag_diffraction.sub
+JOB MERGE dag_merge.sub
+PARENT IPGLASMA CHILD DIFFRACTION
+PARENT DIFFRACTION CHILD MERGE
+""")
+    script.close()
+    if not path.exists(path.join(working_folder, "log")):
+        mkdir(path.join(working_folder, "log"))
+
+
+def generate_script_ipglasma(folder_name, nthreads, cluster_name):
+    """
+        This function generates script for IPGlasma simulation
+
+        The script is shared by all the jobs. The start of the jobs is
+        staggered by $IPGLASMA_STAGGER seconds, set in submit_job.script.
+    """
     working_folder = folder_name
 
     script = open(path.join(working_folder, "run_ipglasma.sh"), "w")
@@ -222,12 +380,12 @@ rm -fr $results_folder/*
 
     if nthreads > 0:
         script.write("""
-export OMP_NUM_THREADS={0:d}
+export OMP_NUM_THREADS=${{IPGLASMA_NUM_THREADS:-{0:d}}}
 """.format(nthreads))
 
     if cluster_name != "OSG":
-        script.write("sleep {}".format(event_id))
-        script.write("""
+        script.write("""sleep ${IPGLASMA_STAGGER:-0}
+
 # IPGlasma evolution (run 1 event)
 ./ipglasma input 1> run.log 2> run.err
 """)
@@ -254,90 +412,77 @@ mv run.err $results_folder/
     script.close()
 
 
-def generate_script_subnucleondiffraction(folder_name, event_id,
-                                          diffractionDict):
-    """This function generates script for computing subnucleon diffraction"""
+def generate_script_subnucleondiffraction(folder_name, diffractionDict):
+    """
+        This function generates script for computing subnucleon diffraction
+
+        The script runs a single (Wilson-line file, Q2, mode) task and
+        writes the result to stdout, so that simulation_driver.py can
+        schedule all the tasks of an event over the reserved cores. The
+        diffraction parameters are saved next to it for the driver to
+        build the task list.
+    """
     working_folder = folder_name
 
     script = open(path.join(working_folder, "run_subnucleondiffraction.sh"),
                   "w")
 
-    common_options="-dipole 1 ipglasma_binary $WilsonLineFile -mcintpoints {mcintpoints} -wavef {wavef_model} -wavef_file {wavef_file} -Q2 $Q2 -xp $xval".format(
-           mcintpoints=diffractionDict['mcintpoints'],
+    # with "auto", the driver sets MCINTPOINTS and GSL_RNG_SEED for every
+    # repeat of the adaptive Monte Carlo integration
+    mcintpoints = diffractionDict['mcintpoints']
+    if mcintpoints == "auto":
+        mcintpoints = diffractionDict.get('mc_min_points', 100000)
+    common_options="-dipole 1 ipglasma_binary $WilsonLineFile -mcintpoints ${{MCINTPOINTS:-{mcintpoints}}} -wavef {wavef_model} -wavef_file {wavef_file} -Q2 $Q2 -xp $xval".format(
+           mcintpoints=mcintpoints,
            wavef_model=diffractionDict['wavef_model'],
            wavef_file=diffractionDict['wavef_file']
            )
 
-    results_folder = 'subnucleondiffraction_results'
     script.write("""#!/bin/bash
 
-resultsFolder={0:s}
 evid=$1
 fileId=$2
 WilsonLineFile=$3
 xval=$4
+Q2=$5
+mode=$6
 
 
 cd subnucleondiffraction
 
-mkdir -p $resultsFolder
+((Random_number=$RANDOM))
 
-""".format(results_folder))
+case $mode in
+""")
 
     if diffractionDict['saveNucleusSnapshot']:
         script.write("""
-./subnucleondiffraction -dipole 1 {common_options} -print_nucleus > ${resultsFolder}/picture_${evid}_${fileId}
-
-""").format(common_options=common_options)
+picture)
+    ./subnucleondiffraction {common_options} -print_nucleus
+    ;;
+""".format(common_options=common_options))
 
     if diffractionDict['computeTotalCrossSection'] > 0:
         script.write("""
-# run subnucleon diffraction
-
-""")
-        Q2ListStr = " ".join([str(Q2) for Q2 in diffractionDict['Q2List']])
-        script.write("""
-for Q2 in {Q2List}
-do
-    """.format(Q2List=Q2ListStr))
-        script.write(
-        "outputFile=${resultsFolder}/AmpF_Q2_${Q2}_${evid}_${fileId}_x_${xval}"
-        )
-        script.write("""
-    ((Randum_number=$RANDOM))
-    GSL_RNG_SEED=$Randum_number ./subnucleondiffraction {options} -totalcrosssections -maxb {maxb} -nbperp {nbperp} -ntheta {ntheta} > $outputFile
-
-done
-
+AmpF)
+    # run subnucleon diffraction
+    GSL_RNG_SEED=${{GSL_RNG_SEED:-$Random_number}} ./subnucleondiffraction {options} -totalcrosssections -maxb {maxb} -nbperp {nbperp} -ntheta {ntheta}
+    ;;
 """.format(options=common_options,
            maxb=diffractionDict['maxb'],
            nbperp=diffractionDict['nbperp'],
-           ntheta=diffractionDict['ntheta'],
-           mcintpoints=diffractionDict['mcintpoints'],)
+           ntheta=diffractionDict['ntheta'],)
         )
 
     if diffractionDict['analyzeDiffraction'] > 0:
-        script.write("""
-# run subnucleon diffraction
-""")
-
-        Q2ListStr = " ".join([str(Q2) for Q2 in diffractionDict['Q2List']])
-        script.write("""
-for Q2 in {Q2List}
-do
-    """.format(Q2List=Q2ListStr))
-        script.write(
-        "outputFile=${resultsFolder}/Amp_Q2_${Q2}_${evid}_${fileId}_x_${xval}"
-        )
         tlistStr = ""
         if 'tlist' in diffractionDict.keys() and diffractionDict['tlist'] != []:
             tlistStr = "-tlist " + ",".join([str(t) for t in diffractionDict['tlist']])
         script.write("""
-    ((Random_number=$RANDOM))
-    GSL_RNG_SEED=$Random_number ./subnucleondiffraction {options} -mint {mint} -maxt {maxt} -tstep {tstep} {tlist} > $outputFile
-
-done
-
+Amp)
+    # run subnucleon diffraction
+    GSL_RNG_SEED=${{GSL_RNG_SEED:-$Random_number}} ./subnucleondiffraction {options} -mint {mint} -maxt {maxt} -tstep {tstep} {tlist}
+    ;;
 """.format( options=common_options,
             mint=diffractionDict['mint'],
            maxt=diffractionDict['maxt'],
@@ -346,67 +491,173 @@ done
            )
         )
 
-    script.write("cd ..")
+    script.write("""
+*)
+    echo "unknown diffraction mode: $mode" 1>&2
+    exit 1
+    ;;
+esac
+""")
 
     script.close()
 
+    with open(path.join(working_folder, "subnucleondiffraction",
+                        "diffraction_parameters.json"), "w") as f:
+        json.dump(diffractionDict, f, indent=4)
 
-def generate_event_folders(initial_condition_type,
-                           package_root_path, code_path, working_folder,
-                           cluster_name, event_id, event_id_offset,
-                           n_ev, n_threads, save_ipglasma_flag,
-                           diffractionDict, python_virtual_environment,
-                           walltime):
-    """This function creates the event folder structure"""
-    event_folder = path.join(working_folder, 'event_%d' % event_id)
+
+def generate_shared_files(initial_condition_type, code_path, working_folder,
+                          cluster_name, n_threads, diffractionDict):
+    """
+        This function renders the files which are identical in all the job
+        folders once, in working_folder/shared_files. It returns the list of
+        (source, link name) pairs to be linked into every job folder.
+    """
+    shared_folder = path.join(working_folder, 'shared_files')
     param_folder = path.join(working_folder, 'model_parameters')
-    mkdir(event_folder)
-    shutil.copy(path.join(code_path, 'simulation_driver.py'),
-                event_folder)
+    mkdir(shared_folder)
+    shutil.copy(path.join(code_path, 'simulation_driver.py'), shared_folder)
+    link_list = [
+        (path.join(shared_folder, 'simulation_driver.py'),
+         'simulation_driver.py'),
+    ]
     if initial_condition_type in ("IPGlasma"):
-        generate_script_ipglasma(event_folder, n_threads, cluster_name,
-                                 event_id)
-        mkdir(path.join(event_folder, 'ipglasma'))
-        shutil.copyfile(path.join(param_folder, 'IPGlasma/input'),
-                        path.join(event_folder, 'ipglasma/input'))
-        link_list = [
-            'qs2Adj_vs_Tp_vs_Y_200.in', 'utilities', 'ipglasma',
-            'nucleusConfigurations',
-        ]
-        for link_i in link_list:
-            subprocess.call("ln -s {0:s} {1:s}".format(
-                path.abspath(path.join(code_path,
-                                       'ipglasma_code/{}'.format(link_i))),
-                path.join(event_folder, "ipglasma/{}".format(link_i))),
-                shell=True)
-
-        # subnucleondiffraction
-        mkdir(path.join(event_folder, 'subnucleondiffraction'))
-
         # Check that user specified a valid vector meson wave function
         if not path.isfile(path.join(
                     code_path, 'subnucleondiffraction_code/{}'.format(diffractionDict["wavef_file"]))):
             sys.exit(f"\nWave function file {diffractionDict['wavef_file']} does not exist!")
 
-
-        generate_script_subnucleondiffraction(event_folder,
-                                              event_id, diffractionDict)
-        link_list = ['build/bin/subnucleondiffraction', diffractionDict["wavef_file"]]
-
-        for link_i in link_list:
-            subprocess.call("ln -s {0:s} {1:s}".format(
+        mkdir(path.join(shared_folder, 'ipglasma'))
+        mkdir(path.join(shared_folder, 'subnucleondiffraction'))
+        shutil.copyfile(path.join(param_folder, 'IPGlasma/input'),
+                        path.join(shared_folder, 'ipglasma/input'))
+        generate_script_ipglasma(shared_folder, n_threads, cluster_name)
+        generate_script_subnucleondiffraction(shared_folder, diffractionDict)
+        for file_i in ['run_ipglasma.sh', 'run_subnucleondiffraction.sh',
+                       'ipglasma/input',
+                       'subnucleondiffraction/diffraction_parameters.json']:
+            link_list.append((path.join(shared_folder, file_i), file_i))
+        for link_i in ['qs2Adj_vs_Tp_vs_Y_200.in', 'utilities', 'ipglasma',
+                       'nucleusConfigurations']:
+            link_list.append((
+                path.abspath(path.join(code_path,
+                                       'ipglasma_code/{}'.format(link_i))),
+                "ipglasma/{}".format(link_i)))
+        for link_i in ['build/bin/subnucleondiffraction',
+                       diffractionDict["wavef_file"]]:
+            link_list.append((
                 path.abspath(path.join(
                     code_path, 'subnucleondiffraction_code/{}'.format(link_i))),
-                path.join(event_folder,
-                          "subnucleondiffraction/{}".format(
-                                                    link_i.split("/")[-1]))),
-                shell=True)
+                "subnucleondiffraction/{}".format(link_i.split("/")[-1])))
+    return(link_list)
+
+
+def generate_event_folders(initial_condition_type, link_list, working_folder,
+                           cluster_name, event_id, event_id_offset,
+                           n_ev, n_threads, save_ipglasma_flag,
+                           python_virtual_environment,
+                           walltime, driver_options="", mem=None,
+                           n_wilson_files=0, input_files=()):
+    """
+        This function creates the event folder structure. The shared files
+        are symlinked in, only the job scripts and the input_files, a list
+        of (file name, content) specific to the job, are written per job.
+    """
+    event_folder = path.join(working_folder, 'event_%d' % event_id)
+    mkdir(event_folder)
+    if initial_condition_type in ("IPGlasma"):
+        mkdir(path.join(event_folder, 'ipglasma'))
+        mkdir(path.join(event_folder, 'subnucleondiffraction'))
+    job_file_list = [file_name for file_name, _ in input_files]
+    for source, link_name in link_list:
+        if link_name not in job_file_list:
+            os.symlink(source, path.join(event_folder, link_name))
+    for file_name, content in input_files:
+        with open(path.join(event_folder, file_name), "w") as f:
+            f.write(content)
 
     generate_full_job_script(cluster_name, event_folder,
                              initial_condition_type,
                              event_id_offset, n_ev, n_threads,
                              save_ipglasma_flag, python_virtual_environment,
-                             walltime)
+                             walltime, driver_options=driver_options,
+                             mem=mem, stagger=event_id)
+    if n_wilson_files > 0:
+        generate_dag_stage_script(event_folder, initial_condition_type,
+                                  event_id_offset, n_ev, n_threads,
+                                  save_ipglasma_flag,
+                                  python_virtual_environment,
+                                  n_wilson_files, driver_options,
+                                  stagger=event_id)
+
+
+def write_jobs_manifest(working_folder, job_list, common_dict,
+                        parameter_sets=None):
+    """
+        This function writes the per-job differences (job index, first
+        event id, number of events, and the posterior set if drawn per
+        job) and the common settings of all the jobs into
+        working_folder/jobs_manifest.json
+    """
+    manifest = dict(common_dict)
+    manifest['columns'] = ['job', 'event_id0', 'n_events']
+    if parameter_sets:
+        manifest['columns'].append('posterior_set')
+        manifest['parameter_sets'] = {str(set_id): parameters for
+                                      set_id, parameters in
+                                      sorted(parameter_sets.items())}
+    manifest['jobs'] = job_list
+    with open(path.join(working_folder, "jobs_manifest.json"), "w") as f:
+        json.dump(manifest, f, separators=(',', ':'))
+
+
+def generate_all_event_folders(initial_condition_type, link_list,
+                               working_folder, cluster_name, job_list,
+                               n_threads, save_ipglasma_flag, python_venv,
+                               walltime, driver_options="", mem=None,
+                               n_wilson_files=0, n_workers=1,
+                               show_progress=True, job_input_files=None):
+    """
+        This function creates the folders of all the jobs in job_list,
+        with n_workers threads. Creating a folder is dominated by file
+        system calls, which release the GIL. job_input_files maps a job
+        index to the list of its own input files.
+    """
+    if job_input_files is None:
+        job_input_files = {}
+    n_jobs = len(job_list)
+    toolbar_width = 40
+    if show_progress:
+        sys.stdout.write("\U0001F375  Generating {} jobs [{}]".format(
+            n_jobs, " "*toolbar_width))
+        sys.stdout.flush()
+        sys.stdout.write("\b"*(toolbar_width + 1))
+
+    def generate_job(job_i):
+        ijob, event_id_offset, n_ev = job_i[:3]
+        generate_event_folders(initial_condition_type, link_list,
+                               working_folder, cluster_name,
+                               ijob, event_id_offset, n_ev, n_threads,
+                               save_ipglasma_flag, python_venv, walltime,
+                               driver_options, mem, n_wilson_files,
+                               job_input_files.get(ijob, ()))
+
+    if n_workers > 1:
+        pool = ThreadPoolExecutor(max_workers=n_workers)
+        results = pool.map(generate_job, job_list)
+    else:
+        results = map(generate_job, job_list)
+    for ijob, _ in enumerate(results):
+        progress_i = (int(float(ijob + 1)/n_jobs*toolbar_width)
+                      - int(float(ijob)/n_jobs*toolbar_width))
+        if show_progress and progress_i > 0:
+            sys.stdout.write("#"*progress_i)
+            sys.stdout.flush()
+    if n_workers > 1:
+        pool.shutdown()
+    if show_progress:
+        sys.stdout.write("\n")
+        sys.stdout.flush()
 
 
 def create_a_working_folder(workfolder_path):
@@ -453,7 +704,7 @@ def main():
                         metavar='',
                         type=int,
                         default=1,
-                        help='number of events per job')
+                        help='number of events per job (0: chosen by the cost model)')
     parser.add_argument('-n_th',
                         '--n_threads',
                         metavar='',
@@ -492,6 +743,64 @@ def main():
                         help='Python virtual environment loaded before running jobs')
     parser.add_argument('--copy', action='store_true')
     parser.add_argument("--continueFlag", action="store_true")
+    parser.add_argument('--pipeline', action='store_true',
+                        help=('overlap IPGlasma and diffraction stages of '
+                              + 'consecutive events within a job'))
+    parser.add_argument('--scratch',
+                        metavar='',
+                        type=str,
+                        default='',
+                        help=('node-local folder to run the events in '
+                              + '("auto": $TMPDIR, /dev/shm or /tmp)'))
+    parser.add_argument('--dag',
+                        metavar='',
+                        type=str,
+                        choices=['', 'slurm', 'condor'],
+                        default='',
+                        help=('split the jobs into an IPGlasma array, a '
+                              + 'single-core diffraction array, and a merge '
+                              + 'node (slurm or condor)'))
+    parser.add_argument('--max_array_size',
+                        metavar='',
+                        type=int,
+                        default=1000,
+                        help=('largest Slurm array submitted at once in the '
+                              + 'DAG mode, below the MaxArraySize of the '
+                              + 'cluster'))
+    parser.add_argument('--array_throttle',
+                        metavar='',
+                        type=int,
+                        default=0,
+                        help=('most elements of a Slurm array chunk running '
+                              + 'at a time in the DAG mode (0: no limit)'))
+    parser.add_argument('--pilot', action='store_true',
+                        help=('pass the walltime to the driver as a '
+                              + 'deadline, so it starts only the events that '
+                              + 'fit and merges the results before the end'))
+    parser.add_argument('--cost_history',
+                        metavar='',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help=('resource_usage_*.json files of previous runs '
+                              + 'to calibrate the cost model, used when '
+                              + 'walltime is "auto" or n_events is 0'))
+    parser.add_argument('--replay',
+                        metavar='',
+                        type=str,
+                        default='',
+                        help=('folder or hdf5 archive of saved IPGlasma '
+                              + 'results; run only subnucleondiffraction '
+                              + 'over them (sets the number of jobs)'))
+    parser.add_argument('--run_local', action='store_true',
+                        help=('run the generated jobs on this machine, as '
+                              + 'many at a time as the cores and memory '
+                              + 'allow (-c local)'))
+    parser.add_argument('--n_gen_workers',
+                        metavar='',
+                        type=int,
+                        default=1,
+                        help='number of threads creating the job folders')
     args = parser.parse_args()
 
     if len(sys.argv) < 2:
@@ -563,89 +872,159 @@ def main():
         code_path = path.join(working_folder_name, "codes")
         shutil.copytree("{}/codes".format(code_package_path), code_path)
 
+    # render the input files in-process with the parameter master
+    sys.path.insert(0, path.join(code_package_path, "config"))
+    import parameters_dict_master
+    from posterior_store import draw_parameter_sets
+
     usePosteriorParameters = False
+    posteriorDrawPerJob = False
     paramFile = path.join(working_folder_name, "iEBE_parameters.txt")
+    bayes_dict = None
     if 'usePosteriorParameters' in parameter_dict.control_dict.keys():
         usePosteriorParameters = (
             parameter_dict.control_dict['usePosteriorParameters'])
     if usePosteriorParameters:
         if 'PosteriorChainFilePath' in parameter_dict.control_dict.keys():
-            posteriorChainFilePath = (
+            posteriorChainFolder = path.join(
+                code_package_path,
                 parameter_dict.control_dict['PosteriorChainFilePath'])
             setId = parameter_dict.control_dict['PosteriorParamSet']
-            setFlag = 0
-            if setId == -1:
-                if seed == -1:
-                    random.seed(time.time())
-                else:
-                    random.seed(seed)
-                setId = random.randint(0, 1000000)
-            subprocess.call(
-                "(cd {}/{}; python3 parameterGenerator.py {} {} {})".format(
-                    code_package_path, posteriorChainFilePath, setId, setFlag,
-                    paramFile),
-                shell=True)
+            posteriorDrawPerJob = parameter_dict.control_dict.get(
+                'PosteriorDrawPerJob', False)
+            if not posteriorDrawPerJob:
+                setId, bayes_dict = draw_parameter_sets(
+                    posteriorChainFolder, 1, seed, setId)[0]
+                print("Using parameter set: {}".format(setId))
+                with open(paramFile, "w") as f:
+                    for key_i in bayes_dict.keys():
+                        f.write("{}  {}\n".format(key_i, bayes_dict[key_i]))
 
     if args.bayes_file != "":
         args.bayes_file = path.join(path.abspath("."), args.bayes_file)
-        subprocess.call("(cd {}/config; ".format(code_package_path)
-                        + "python3 parameters_dict_master.py "
-                        + "-path {} -par {} -b {} -seed {};)".format(
-                            working_folder_name, path.abspath(args.par_dict),
-                            args.bayes_file, seed),
-                        shell=True)
+        bayes_dict = parameters_dict_master.read_bayes_file(args.bayes_file)
         shutil.copy(args.bayes_file, working_folder_name)
-    elif usePosteriorParameters:
-        subprocess.call("(cd {}/config; ".format(code_package_path)
-                        + "python3 parameters_dict_master.py "
-                        + "-path {} -par {} -b {} -seed {};)".format(
-                            working_folder_name, path.abspath(args.par_dict),
-                            paramFile, seed),
-                        shell=True)
-    else:
-        subprocess.call(
-            "(cd {}/config; ".format(code_package_path)
-            + "python3 parameters_dict_master.py "
-            + "-path {} -par {} -seed {};)".format(
-                working_folder_name, path.abspath(args.par_dict), seed),
-            shell=True)
+    parameters_dict_master.write_input_files(
+        parameters_dict_master.get_merged_parameters(parameter_dict, seed,
+                                                     bayes_dict),
+        working_folder_name)
 
     walltime = '10:00:00'
     if "walltime" in parameter_dict.control_dict.keys():
         walltime = parameter_dict.control_dict["walltime"]
-
-    toolbar_width = 40
-    sys.stdout.write("\U0001F375  Generating {} jobs [{}]".format(
-        n_jobs, " "*toolbar_width))
-    sys.stdout.flush()
-    sys.stdout.write("\b"*(toolbar_width + 1))
+    mem = None
+    if walltime == "auto" or n_ev <= 0:
+        # size the jobs with the cost model
+        sys.path.insert(0, path.join(code_package_path, "utilities"))
+        from cost_model import plan_job_from_parameters
+        max_walltime = None
+        if cluster_name == "OSG":
+            max_walltime = "20:00:00"
+        job_plan = plan_job_from_parameters(parameter_dict, n_threads, n_ev,
+                                            args.cost_history, max_walltime)
+        n_ev = job_plan['n_events']
+        if walltime == "auto":
+            walltime = job_plan['walltime']
+            mem = job_plan['memory_gb']
+
+    driver_options = ""
+    if args.pipeline:
+        driver_options += " --pipeline"
+    if args.scratch != "":
+        driver_options += " --scratch {}".format(args.scratch)
+    if args.pilot:
+        driver_options += " --deadline {}".format(walltime)
+    if args.replay != "":
+        # one job per n_ev archived events, the jobs pick their events
+        # by position in the sorted archive
+        sys.path.insert(0, path.join(code_package_path, "codes"))
+        from simulation_driver import list_replay_archive
+        replay_path = path.abspath(args.replay)
+        n_replay_events = len(list_replay_archive(replay_path))
+        if n_replay_events == 0:
+            print("\U0001F6AB  No saved Wilson lines found in {}".format(
+                  replay_path))
+            exit(1)
+        n_jobs = (n_replay_events + n_ev - 1)//n_ev
+        print("\U0001F3B6  Replay {} events in {} jobs".format(
+              n_replay_events, n_jobs))
+        driver_options += " --replay {}".format(replay_path)
+    driver_options = driver_options.strip()
+
+    n_wilson_files = 0
+    if args.dag != "":
+        # the diffraction array has one task per (event, Wilson-line file,
+        # Q2); it is sized for the largest number of Wilson-line files
+        sys.path.insert(0, path.join(code_package_path, "utilities"))
+        from cost_model import get_cost_features
+        n_wilson_files = get_cost_features(
+            parameter_dict.ipglasma_dict,
+            parameter_dict.diffraction_dict)['n_wilson_lines']
+
+    save_ipglasma_flag = False
+    if initial_condition_type in ("IPGlasma"):
+        save_ipglasma_flag = (
+                parameter_dict.control_dict['save_ipglasma_results'])
+    job_list = []
     event_id_offset = osg_job_id
+    if cluster_name == "OSG":
+        event_id_offset = osg_job_id*n_ev
     for ijob in range(n_jobs):
-        progress_i = (int(float(ijob + 1)/n_jobs*toolbar_width)
-                      - int(float(ijob)/n_jobs*toolbar_width))
-        for ii in range(progress_i):
-            sys.stdout.write("#")
-            sys.stdout.flush()
-        if cluster_name == "OSG":
-            event_id_offset = osg_job_id*n_ev
-        save_ipglasma_flag = False
-        if initial_condition_type in ("IPGlasma"):
-            save_ipglasma_flag = (
-                    parameter_dict.control_dict['save_ipglasma_results'])
-        generate_event_folders(initial_condition_type,
-                               code_package_path, code_path,
-                               working_folder_name, cluster_name,
-                               ijob, event_id_offset, n_ev, n_threads,
-                               save_ipglasma_flag,
-                               parameter_dict.diffraction_dict,
-                               python_venv, walltime)
+        job_list.append([ijob, event_id_offset, n_ev])
         event_id_offset += n_ev
-    sys.stdout.write("\n")
-    sys.stdout.flush()
+
+    # draw one posterior parameter set per job, each job gets its own input
+    job_input_files = {}
+    parameter_sets = {}
+    if posteriorDrawPerJob and args.bayes_file == "":
+        posterior_sets = draw_parameter_sets(posteriorChainFolder, n_jobs,
+                                             seed, setId)
+        for job_i, (setId_i, posterior_dict) in zip(job_list, posterior_sets):
+            job_i.append(setId_i)
+            parameter_sets[setId_i] = posterior_dict
+            job_input_files[job_i[0]] = [
+                (path.join("ipglasma", path.basename(file_name)), content)
+                for file_name, content in
+                parameters_dict_master.render_input_files(
+                    parameters_dict_master.get_merged_parameters(
+                        parameter_dict, seed, posterior_dict))]
+
+    link_list = generate_shared_files(initial_condition_type, code_path,
+                                      working_folder_name, cluster_name,
+                                      n_threads,
+                                      parameter_dict.diffraction_dict)
+    generate_all_event_folders(initial_condition_type, link_list,
+                               working_folder_name, cluster_name, job_list,
+                               n_threads, save_ipglasma_flag, python_venv,
+                               walltime, driver_options, mem, n_wilson_files,
+                               n_workers=args.n_gen_workers,
+                               job_input_files=job_input_files)
+    write_jobs_manifest(working_folder_name, job_list, {
+        'initial_state_type': initial_condition_type,
+        'cluster_name': cluster_name,
+        'n_threads': n_threads,
+        'walltime': walltime,
+        'driver_options': driver_options,
+        'shared_files': [[source, link_name]
+                         for source, link_name in link_list],
+    }, parameter_sets)
 
     generate_full_job_script(cluster_name, working_folder_name, initial_condition_type,
                              -1, n_ev, n_threads, save_ipglasma_flag, python_venv,
-                             walltime,array_job=True)
+                             walltime,array_job=True,
+                             driver_options=driver_options, mem=mem)
+
+    if args.dag != "":
+        n_tasks_per_job = (n_ev*n_wilson_files
+                           *len(parameter_dict.diffraction_dict['Q2List']))
+        dag_mem = mem if mem is not None else 4*n_threads
+        if args.dag == "slurm":
+            generate_slurm_dag(working_folder_name, n_jobs, n_tasks_per_job,
+                               n_threads, walltime, dag_mem,
+                               args.max_array_size, args.array_throttle)
+        else:
+            generate_condor_dag(working_folder_name, n_jobs, n_tasks_per_job,
+                                n_threads, dag_mem)
 
     pwd = path.abspath(".")
     script_path = path.join(code_package_path, "utilities")
@@ -676,6 +1055,11 @@ def main():
             path.join(code_package_path,
                       'Cluster_supports/WSUgrid/submit_all_jobs.sh'), pwd)
 
+    if args.run_local and cluster_name == "local":
+        sys.path.insert(0, path.join(code_package_path, "utilities"))
+        from run_local_jobs import run_local_jobs
+        run_local_jobs(working_folder_name)
+
 
 if __name__ == "__main__":
     main()
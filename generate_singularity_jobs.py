@@ -16,9 +16,10 @@ support_cluster_list = ["wsugrid", "osg", "local", "stampede2", "anvil"]
 
 
 def write_script_header(cluster, script, n_threads, event_id, walltime,
-                        working_folder):
+                        working_folder, mem=None):
     """This function write the header of the job submission script"""
-    mem = 4*n_threads
+    if mem is None:
+        mem = 4*n_threads
     if cluster == "wsugrid":
         script.write("""#!/usr/bin/env bash
 #SBATCH --job-name event_{0}
@@ -84,7 +85,8 @@ export OMP_NUM_THREADS={4:d}
 module load ooops
 set_io_param_batch $SLURM_JOBID 0 low
 
-ibrun python3 job_MPI_wrapper.py
+# rank 0 dispatches the event folders to the other ranks
+ibrun python3 job_MPI_wrapper.py --walltime {3:s}
 
 # after all runs finish, collect results into one hdf5 file
 # and transfer it to $WORK
@@ -95,7 +97,7 @@ mkdir -p $WORK/RESULTS
 cp -r temp/* $WORK/RESULTS/
 rm -fr `pwd`
 
-""".format(queueName, n_nodes, n_jobs, walltime, n_threads))
+""".format(queueName, n_nodes, n_jobs + 1, walltime, n_threads))
     script.close()
 
 
@@ -125,7 +127,10 @@ export OMP_PROC_BIND=true
 export OMP_PLACES=threads
 export OMP_NUM_THREADS=$SLURM_CPUS_PER_TASK
 
-mpirun -np $SLURM_NTASKS python3 job_MPI_wrapper.py
+# rank 0 dispatches the event folders to the other ranks; it is mostly
+# idle, so it is started as an extra rank and every task runs events
+mpirun --oversubscribe -np $((SLURM_NTASKS + 1)) \\
+    python3 job_MPI_wrapper.py --walltime {3:s}
 
 # after all runs finish, collect results into one hdf5 file
 # and transfer it to $PROJECT
@@ -143,7 +148,8 @@ rm -fr `pwd`
 def generate_event_folders(workingFolder, clusterName, eventId,
                            singularityRepoPath, executeScript, parameterFile,
                            bayesParamFile, eventId0, nEvents,
-                           nThreads, seed, wallTime):
+                           nThreads, seed, wallTime, scratchPath="",
+                           mem=None):
     """This function creates the event folder structure"""
     eventFolder = path.join(workingFolder, 'event_{}'.format(eventId))
     mkdir(eventFolder)
@@ -151,14 +157,18 @@ def generate_event_folders(workingFolder, clusterName, eventId,
     # generate job running script
     workingFolderName = workingFolder.split('/')[-1]
     workFolderPath = "playground_{0}_{1}".format(workingFolderName, eventId)
-    if clusterName == "stampede2":
-        workFolderPath = "/tmp/" + workFolderPath
+    if scratchPath == "" and clusterName == "stampede2":
+        scratchPath = "/tmp"
+    if scratchPath != "":
+        # run the events in a node-local folder, only the final results
+        # are collected back to the event folder
+        workFolderPath = path.join(scratchPath, workFolderPath)
     workFolderName = workFolderPath.split('/')[-1]
     executeScriptName = executeScript.split('/')[-1]
     parameterFileName = parameterFile.split('/')[-1]
     script = open(path.join(eventFolder, "submit_job.script"), "w")
     write_script_header(clusterName, script, nThreads, eventId, wallTime,
-                        eventFolder)
+                        eventFolder, mem)
     script.write("""
 h5Stat=`ls *.h5 2>/dev/null`
 
@@ -238,7 +248,8 @@ def main():
                         metavar='',
                         type=int,
                         default=1,
-                        help='number of events per job to run')
+                        help=('number of events per job to run '
+                              + '(0: chosen by the cost model)'))
     parser.add_argument('-n_th',
                         '--n_threads',
                         metavar='',
@@ -275,6 +286,21 @@ def main():
                         type=int,
                         default='-1',
                         help='Random Seed (-1: according to system time)')
+    parser.add_argument('--scratch',
+                        metavar='',
+                        type=str,
+                        default='',
+                        help=('node-local folder to run the events in, '
+                              + 'e.g. $TMPDIR or /dev/shm '
+                              + '(default /tmp on stampede2)'))
+    parser.add_argument('--cost_history',
+                        metavar='',
+                        type=str,
+                        nargs='*',
+                        default=[],
+                        help=('resource_usage_*.json files of previous runs '
+                              + 'to calibrate the cost model, used when '
+                              + 'walltime is "auto" or n_event is 0'))
     args = parser.parse_args()
 
     if len(sys.argv) < 2:
@@ -308,6 +334,18 @@ def main():
     sys.path.insert(0, par_diretory)
     parameter_dict = __import__(args.par_dict.split('.py')[0].split("/")[-1])
     wallTime = parameter_dict.control_dict['walltime']
+    mem = None
+    if wallTime == "auto" or n_event_per_job <= 0:
+        # size the jobs with the cost model
+        sys.path.insert(0, path.join(code_package_path, "utilities"))
+        from cost_model import plan_job_from_parameters
+        job_plan = plan_job_from_parameters(parameter_dict, n_threads,
+                                            n_event_per_job,
+                                            args.cost_history)
+        n_event_per_job = job_plan['n_events']
+        if wallTime == "auto":
+            wallTime = job_plan['walltime']
+            mem = job_plan['memory_gb']
 
     working_folder_name = path.abspath(working_folder_name)
     create_a_working_folder(working_folder_name)
@@ -331,7 +369,8 @@ def main():
                                singularityRepoPath, executeScript,
                                parameterFile, args.bayes_file,
                                i_job*n_event_per_job, n_event_per_job,
-                               n_threads, seed, wallTime)
+                               n_threads, seed, wallTime, args.scratch,
+                               mem)
     sys.stdout.write("\n")
     sys.stdout.flush()
 
@@ -356,7 +395,7 @@ def main():
             nThreadsPerNode = 160
         shutil.copy(
             path.join(code_package_path,
-                      'Cluster_supports/Stampede2/job_MPI_wrapper.py'),
+                      'Cluster_supports/NERSC/job_MPI_wrapper.py'),
             working_folder_name)
         n_nodes = max(1, int(n_jobs*n_threads/nThreadsPerNode))
         if n_nodes*nThreadsPerNode < n_jobs*n_threads:
@@ -374,7 +413,7 @@ def main():
         nThreadsPerNode = 128
         shutil.copy(
             path.join(code_package_path,
-                      'Cluster_supports/Anvil/job_MPI_wrapper.py'),
+                      'Cluster_supports/NERSC/job_MPI_wrapper.py'),
             working_folder_name)
         n_nodes = max(1, int(n_jobs*n_threads/nThreadsPerNode))
         nTaskPerNode = int(nThreadsPerNode/n_threads)
@@ -56,6 +56,12 @@ diffraction_dict = {
     "wavef_model": 'boostedgaussian',       # "gauslc"
     "wavef_file": 'gauss-boosted.dat',      # "gaus-lc.dat"
     "mcintpoints": 2000000,                  # "auto"
+    "mc_target_relerr": 0.01,               # adaptive MC ("auto" only)
+    "mc_min_points": 100000,
+    "mc_max_points": 10000000,
+    "mc_repeats": 4,                        # independent seeds per step
+    "mc_amplitude_floor": 1e-3,             # rows with a smaller |A|/max|A|
+                                            # are left out of the error
     "maxb": 20.,                            # GeV^-1
     "nbperp": 40,
     "ntheta": 32,
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+    This module accumulates the diffraction amplitudes of one (mode, Q2, x)
+    event by event. Per grid point (t for Amp, (b, theta) for AmpF) it
+    keeps the power sums of the real and imaginary parts up to the 4th
+    order, and of |A|^2 = Re^2 + Im^2 up to the 2nd order, so that the
+    memory does not grow with the number of events. Partial accumulators,
+    e.g. of different results files, merge exactly, and are saved to small
+    npz files.
+
+    With a block size, the first-order sums are also kept per block of
+    events, for the jackknife and bootstrap errors of resampling.py.
+
+    Usage: amplitude_accumulator.py partial1.npz [partial2.npz ...]
+"""
+
+import sys
+import json
+from os import path
+import numpy as np
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+from amplitude_index import iterate_amplitude_tables
+
+# number of leading kinematic columns and of complex amplitude components
+TABLE_LAYOUT = {'Amp': (1, 1), 'AmpF': (2, 2)}
+MAX_ORDER = 4
+
+
+class AmplitudeAccumulator:
+    """
+        This class keeps the power sums of the amplitude tables of one
+        (mode, Q2, x) on a fixed kinematic grid
+    """
+
+    def __init__(self, mode="Amp", Q2="0", x="0", block_size=0):
+        self.mode = mode
+        self.Q2 = Q2
+        self.x = x
+        self.block_size = block_size
+        self.n_events = 0
+        self.kinematics = None      # (n_rows, n_kinematic columns)
+        # power_sums[k - 1, icol, irow] = sum over events of value^k for
+        # the real and imaginary columns
+        self.power_sums = None
+        # abs2_sums[k - 1, icomp, irow] = sum over events of |A|^(2k)
+        self.abs2_sums = None
+        # per block of block_size events: the number of events, and the
+        # sums of the amplitude columns and of |A|^2
+        self.block_n = np.zeros(0, dtype=np.int64)
+        self.block_sums = None
+        self.block_abs2 = None
+
+    def get_columns(self, tables):
+        """
+            This function splits the tables into the kinematic columns and
+            the real and imaginary amplitude columns
+        """
+        n_kinematic, n_complex = TABLE_LAYOUT[self.mode]
+        if tables.shape[-1] < n_kinematic + 2*n_complex:
+            raise ValueError("A {} table needs {} columns, got {}".format(
+                self.mode, n_kinematic + 2*n_complex, tables.shape[-1]))
+        return(tables[..., :n_kinematic],
+               tables[..., n_kinematic:n_kinematic + 2*n_complex])
+
+    def check_grid(self, kinematics):
+        """This function sets the grid, or checks that it is unchanged"""
+        if self.kinematics is None:
+            n_complex = TABLE_LAYOUT[self.mode][1]
+            n_rows = kinematics.shape[0]
+            self.kinematics = np.array(kinematics, dtype=np.float64)
+            self.power_sums = np.zeros((MAX_ORDER, 2*n_complex, n_rows))
+            self.abs2_sums = np.zeros((2, n_complex, n_rows))
+            self.block_sums = np.zeros((0, 2*n_complex, n_rows))
+            self.block_abs2 = np.zeros((0, n_complex, n_rows))
+        elif (kinematics.shape != self.kinematics.shape
+              or not np.allclose(kinematics, self.kinematics)):
+            raise ValueError("The grid of the {} table at Q2 = {}, ".format(
+                             self.mode, self.Q2)
+                             + "x = {} changed".format(self.x))
+
+    def add_events(self, tables):
+        """
+            This function adds the tables of several events, an array of
+            shape (n_events, n_rows, n_columns)
+        """
+        tables = np.asarray(tables, dtype=np.float64)
+        if tables.shape[0] == 0:
+            return
+        kinematics, amplitudes = self.get_columns(tables)
+        self.check_grid(kinematics[0])
+        # (n_events, n_amplitude_columns, n_rows)
+        amplitudes = np.swapaxes(amplitudes, 1, 2)
+        power = np.ones_like(amplitudes)
+        for k in range(MAX_ORDER):
+            power *= amplitudes
+            self.power_sums[k] += np.sum(power, axis=0)
+        abs2 = amplitudes[:, 0::2, :]**2 + amplitudes[:, 1::2, :]**2
+        self.abs2_sums[0] += np.sum(abs2, axis=0)
+        self.abs2_sums[1] += np.sum(abs2**2, axis=0)
+        self.n_events += tables.shape[0]
+        if self.block_size > 0:
+            self.add_blocks(amplitudes, abs2)
+
+    def add_blocks(self, amplitudes, abs2):
+        """
+            This function adds the events to the block sums. The last block
+            is filled first, then new blocks are started.
+        """
+        n_new = amplitudes.shape[0]
+        start = 0
+        if len(self.block_n) > 0 and self.block_n[-1] < self.block_size:
+            start = min(n_new, self.block_size - self.block_n[-1])
+            self.block_sums[-1] += np.sum(amplitudes[:start], axis=0)
+            self.block_abs2[-1] += np.sum(abs2[:start], axis=0)
+            self.block_n[-1] += start
+        if start == n_new:
+            return
+        offsets = np.arange(0, n_new - start, self.block_size)
+        self.block_sums = np.concatenate((self.block_sums, np.add.reduceat(
+            amplitudes[start:], offsets, axis=0)))
+        self.block_abs2 = np.concatenate((self.block_abs2, np.add.reduceat(
+            abs2[start:], offsets, axis=0)))
+        self.block_n = np.concatenate((self.block_n, np.diff(
+            np.append(offsets, n_new - start))))
+
+    def add_event(self, table):
+        """This function adds the table of one event"""
+        self.add_events(np.asarray(table)[np.newaxis, ...])
+
+    def merge(self, other):
+        """This function adds the sums of another accumulator"""
+        if other.n_events == 0:
+            return(self)
+        if (other.mode, other.Q2, other.x) != (self.mode, self.Q2, self.x):
+            raise ValueError("Can not merge {} Q2 = {} x = {} ".format(
+                             other.mode, other.Q2, other.x)
+                             + "into {} Q2 = {} x = {}".format(
+                             self.mode, self.Q2, self.x))
+        self.check_grid(other.kinematics)
+        self.power_sums += other.power_sums
+        self.abs2_sums += other.abs2_sums
+        self.n_events += other.n_events
+        # the blocks of both accumulators are kept as they are
+        self.block_size = max(self.block_size, other.block_size)
+        self.block_n = np.concatenate((self.block_n, other.block_n))
+        self.block_sums = np.concatenate((self.block_sums, other.block_sums))
+        self.block_abs2 = np.concatenate((self.block_abs2, other.block_abs2))
+        return(self)
+
+    def coarsen_blocks(self, max_blocks):
+        """
+            This function sums consecutive blocks, so that there are at
+            most max_blocks blocks
+        """
+        n_blocks = len(self.block_n)
+        if n_blocks <= max_blocks:
+            return
+        offsets = np.arange(0, n_blocks, int(np.ceil(n_blocks/max_blocks)))
+        self.block_n = np.add.reduceat(self.block_n, offsets)
+        self.block_sums = np.add.reduceat(self.block_sums, offsets, axis=0)
+        self.block_abs2 = np.add.reduceat(self.block_abs2, offsets, axis=0)
+        self.block_size = int(np.max(self.block_n))
+
+    def moment(self, order=1):
+        """This function returns the mean of value^order per column"""
+        return(self.power_sums[order - 1]/max(self.n_events, 1))
+
+    def std(self, order=1):
+        """
+            This function returns the standard deviation of value^order per
+            column, normalized by the number of events as np.std
+        """
+        variance = self.moment(2*order) - self.moment(order)**2
+        return(np.sqrt(np.maximum(variance, 0.)))
+
+    def mean_abs2(self):
+        """This function returns <|A|^2> per complex component"""
+        return(self.abs2_sums[0]/max(self.n_events, 1))
+
+    def std_abs2(self):
+        """This function returns the standard deviation of |A|^2"""
+        variance = self.abs2_sums[1]/max(self.n_events, 1) - self.mean_abs2()**2
+        return(np.sqrt(np.maximum(variance, 0.)))
+
+    def get_arrays(self, prefix=""):
+        """This function returns the state as a dictionary of arrays"""
+        empty = np.zeros(0)
+        arrays = {'mode': self.mode, 'Q2': self.Q2, 'x': self.x,
+                  'block_size': self.block_size,
+                  'n_events': self.n_events,
+                  'kinematics': self.kinematics,
+                  'power_sums': self.power_sums,
+                  'abs2_sums': self.abs2_sums,
+                  'block_n': self.block_n,
+                  'block_sums': self.block_sums,
+                  'block_abs2': self.block_abs2}
+        return({prefix + key: empty if value is None else np.asarray(value)
+                for key, value in arrays.items()})
+
+    @classmethod
+    def from_arrays(cls, data, prefix=""):
+        """This function creates an accumulator from get_arrays"""
+        accumulator = cls(str(data[prefix + 'mode']),
+                          str(data[prefix + 'Q2']), str(data[prefix + 'x']),
+                          int(data[prefix + 'block_size']))
+        accumulator.n_events = int(data[prefix + 'n_events'])
+        if accumulator.n_events > 0:
+            for key in ['kinematics', 'power_sums', 'abs2_sums', 'block_n',
+                        'block_sums', 'block_abs2']:
+                setattr(accumulator, key, np.array(data[prefix + key]))
+        return(accumulator)
+
+
+def save_accumulators(filename, accumulator_list, metadata=None):
+    """
+        This function saves a list of accumulators to one npz file, with
+        an optional dictionary of metadata
+    """
+    arrays = {'n_accumulators': len(accumulator_list),
+              'metadata': json.dumps(metadata or {})}
+    for i, accumulator in enumerate(accumulator_list):
+        arrays.update(accumulator.get_arrays("{}/".format(i)))
+    np.savez(filename, **arrays)
+
+
+def read_accumulator_metadata(filename):
+    """This function reads the metadata of a npz file of accumulators"""
+    with np.load(filename, allow_pickle=False) as data:
+        if 'metadata' not in data.files:
+            return({})
+        return(json.loads(str(data['metadata'])))
+
+
+def load_accumulators(filename):
+    """This function loads the list of accumulators of a npz file"""
+    with np.load(filename, allow_pickle=False) as data:
+        return([AmplitudeAccumulator.from_arrays(data, "{}/".format(i))
+                for i in range(int(data['n_accumulators']))])
+
+
+def accumulate_amplitudes(hf_list, index, mode="Amp", chunk_size=256,
+                          block_size=0):
+    """
+        This function accumulates the amplitude tables of all the (Q2, x)
+        of an index (see amplitude_index.py), reading chunk_size events at
+        a time. It returns a list of accumulators.
+    """
+    accumulator_list = []
+    for (Q2, x), entry_list in index.items():
+        accumulator = AmplitudeAccumulator(mode, Q2, x, block_size)
+        for tables in iterate_amplitude_tables(hf_list, entry_list, mode,
+                                               chunk_size):
+            accumulator.add_events(tables)
+        accumulator_list.append(accumulator)
+    return(accumulator_list)
+
+
+def merge_accumulators(accumulator_list):
+    """
+        This function merges lists of accumulators into one accumulator per
+        (mode, Q2, x). It returns a dictionary (mode, Q2, x) -> accumulator.
+    """
+    merged = {}
+    for accumulator in accumulator_list:
+        key = (accumulator.mode, accumulator.Q2, accumulator.x)
+        if key not in merged:
+            merged[key] = AmplitudeAccumulator(*key, accumulator.block_size)
+        merged[key].merge(accumulator)
+    return(merged)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(1)
+    for (MODE, Q2, X), ACC in merge_accumulators(
+            [accumulator for file_i in sys.argv[1:]
+             for accumulator in load_accumulators(file_i)]).items():
+        print("{:5s} Q2 = {:8s} x = {:14s} {} events ".format(
+              MODE, Q2, X, ACC.n_events)
+              + "in {} blocks on {} grid points".format(
+              len(ACC.block_n),
+              0 if ACC.kinematics is None else ACC.kinematics.shape[0]))
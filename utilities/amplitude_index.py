@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+    This module indexes the diffraction amplitudes in the results hdf5
+    files. The dataset names written by simulation_driver.py,
+        <mode>_Q2_<Q2>_<event id>_<file id>_x_<x>,
+    are parsed once in a single pass over the file metadata, and the
+    tables of a (Q2, x) pair are then read into one preallocated array.
+
+    Usage: amplitude_index.py results.h5 [results2.h5 ...]
+"""
+
+import re
+import sys
+import numpy as np
+import h5py
+
+AMPLITUDE_PATTERN = re.compile(
+    r"(?P<mode>AmpF|Amp)_Q2_(?P<Q2>[^_]+)_(?P<event_id>\d+)_"
+    r"(?P<file_id>\d+)_x_(?P<x>[^_]+)")
+
+# number of columns an amplitude table needs: t, Re A, Im A and
+# b, theta, Re F_T, Im F_T, Re F_L, Im F_L
+MIN_COLUMNS = {'Amp': 3, 'AmpF': 6}
+
+
+def parse_amplitude_name(dataset_name):
+    """
+        This function parses the name of an amplitude dataset. It returns
+        (mode, Q2, x, event id, file id) or None for the other datasets.
+    """
+    match = AMPLITUDE_PATTERN.fullmatch(dataset_name)
+    if match is None:
+        return(None)
+    return(match.group("mode"), match.group("Q2"), match.group("x"),
+           int(match.group("event_id")), int(match.group("file_id")))
+
+
+def build_amplitude_index(hf_list, mode="Amp"):
+    """
+        This function lists the amplitude datasets of the given mode in the
+        opened hdf5 files. It returns a dictionary (Q2, x) -> list of
+        (file index, group name, dataset name), sorted by Q2 and x. The Q2
+        and x are kept as the strings in the dataset names.
+    """
+    index = {}
+    for ifile, hf in enumerate(hf_list):
+        for group_name, group in hf.items():
+            if not isinstance(group, h5py.Group):
+                continue
+            for dataset_name in group.keys():
+                key = parse_amplitude_name(dataset_name)
+                if key is None or key[0] != mode:
+                    continue
+                index.setdefault((key[1], key[2]), []).append(
+                    (ifile, group_name, dataset_name))
+    return({key: index[key] for key in sorted(
+            index, key=lambda Q2_x: (float(Q2_x[0]), float(Q2_x[1])))})
+
+
+def get_x_list(index, Q2=None):
+    """This function returns the x values of the index, for one Q2"""
+    return([x for Q2_i, x in index if Q2 is None or Q2_i == Q2])
+
+
+def get_Q2_list(index):
+    """This function returns the Q2 values of the index"""
+    return(sorted({Q2 for Q2, _ in index}, key=float))
+
+
+def get_table_shape(hf_list, entry_list, mode="Amp"):
+    """
+        This function returns the shape of the first valid amplitude table
+        of the index entries, or None if there is none
+    """
+    for ifile, group_name, dataset_name in entry_list:
+        dset = hf_list[ifile][group_name][dataset_name]
+        if dset.ndim == 2 and dset.shape[1] >= MIN_COLUMNS[mode]:
+            return(dset.shape)
+    return(None)
+
+
+def iterate_amplitude_tables(hf_list, entry_list, mode="Amp",
+                             chunk_size=256):
+    """
+        This function reads the amplitude tables of the index entries of a
+        (Q2, x) pair in chunks of up to chunk_size events. It yields arrays
+        of shape (n_events, n_rows, n_columns) which reuse one buffer, so
+        the memory does not grow with the number of events. The tables
+        with a different shape than the first valid one, e.g. empty tables
+        of failed tasks, are skipped. NaNs are set to 0.
+    """
+    shape = get_table_shape(hf_list, entry_list, mode)
+    if shape is None:
+        return
+    data = np.empty((min(chunk_size, len(entry_list)),) + shape,
+                    dtype=np.float64)
+    n_events = 0
+    for ifile, group_name, dataset_name in entry_list:
+        dset = hf_list[ifile][group_name][dataset_name]
+        if dset.shape != shape:
+            continue
+        dset.read_direct(data[n_events])
+        n_events += 1
+        if n_events == data.shape[0]:
+            np.nan_to_num(data, copy=False)
+            yield data
+            n_events = 0
+    if n_events > 0:
+        np.nan_to_num(data[:n_events], copy=False)
+        yield data[:n_events]
+
+
+def read_amplitude_tables(hf_list, entry_list, mode="Amp"):
+    """
+        This function reads all the amplitude tables of the index entries
+        of a (Q2, x) pair into one array of shape (n_events, n_rows,
+        n_columns)
+    """
+    # a single chunk holds all the events
+    for data in iterate_amplitude_tables(hf_list, entry_list, mode,
+                                         max(1, len(entry_list))):
+        return(data)
+    return(np.zeros((0, 0, MIN_COLUMNS[mode])))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        exit(1)
+    HF_LIST = [h5py.File(file_i, "r") for file_i in sys.argv[1:]]
+    for MODE in ["Amp", "AmpF"]:
+        for (Q2, x), ENTRIES in build_amplitude_index(HF_LIST, MODE).items():
+            print("{:5s} Q2 = {:8s} x = {:14s} {} events".format(
+                  MODE, Q2, x, len(ENTRIES)))
+    for hf in HF_LIST:
+        hf.close()
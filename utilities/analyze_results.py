@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+    This script analyzes many results files of a production at once,
+    without merging them into one file first. Every file is reduced in a
+    worker process to the accumulated amplitudes of each (mode, Q2, x)
+    (see amplitude_accumulator.py). The partial results are merged and
+    give both the dsigma/dt spectra of compute_dsigma_dt.py and the
+    integrated cross sections of compute_totalCrossSections.py.
+
+    The reduced results of every file are cached in .analysis_cache next
+    to it, with the path, size and modification time of the file and the
+    analysis settings. A later analysis only reduces the new or changed
+    files, e.g. to follow the convergence while the production runs.
+
+    Usage: analyze_results.py "RESULTS_*.h5" [more files] [-j n_workers]
+"""
+
+import sys
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from os import path
+import h5py
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+from amplitude_index import build_amplitude_index, get_Q2_list
+from amplitude_accumulator import (accumulate_amplitudes, load_accumulators,
+                                   merge_accumulators,
+                                   read_accumulator_metadata,
+                                   save_accumulators)
+from resampling import MAX_BLOCKS, N_SAMPLES, get_block_size
+import compute_dsigma_dt
+import compute_totalCrossSections
+
+CACHE_FOLDERNAME = ".analysis_cache"
+CACHE_VERSION = 1
+
+
+def reduce_results_file(filename, max_blocks=MAX_BLOCKS, chunk_size=256):
+    """
+        This function reduces the Amp and AmpF tables of a results file to
+        a list of accumulators, with at most max_blocks blocks of events
+        per (mode, Q2, x)
+    """
+    accumulator_list = []
+    with h5py.File(filename, "r") as hf:
+        for mode in ["Amp", "AmpF"]:
+            index = build_amplitude_index([hf], mode)
+            if not index:
+                continue
+            block_size = get_block_size(max(
+                [len(entry_list) for entry_list in index.values()]),
+                max_blocks)
+            accumulator_list += accumulate_amplitudes(
+                [hf], index, mode, chunk_size, block_size)
+    return(accumulator_list)
+
+
+def get_cache_key(filename, max_blocks):
+    """
+        This function returns the key of the reduced results of a file:
+        its path, size and modification time, and the analysis settings
+    """
+    file_stat = os.stat(filename)
+    return({
+        'path': path.abspath(filename),
+        'size': file_stat.st_size,
+        'mtime_ns': file_stat.st_mtime_ns,
+        'settings': {'max_blocks': max_blocks, 'version': CACHE_VERSION},
+    })
+
+
+def get_cache_file(filename, cache_folder=""):
+    """
+        This function returns the cache file of a results file, in
+        cache_folder or by default in .analysis_cache next to it
+    """
+    filename = path.abspath(filename)
+    if cache_folder == "":
+        cache_folder = path.join(path.dirname(filename), CACHE_FOLDERNAME)
+    path_hash = hashlib.sha1(filename.encode()).hexdigest()[:8]
+    return(path.join(cache_folder, "{}_{}.npz".format(
+        path.basename(filename), path_hash)))
+
+
+def reduce_results_file_cached(filename, max_blocks=MAX_BLOCKS,
+                               cache_folder=""):
+    """
+        This function returns the reduced results of a file from its cache
+        if the file and the settings did not change, and reduces it and
+        updates the cache otherwise. With cache_folder None, no cache is
+        used. It returns the list of accumulators and whether they were
+        read from the cache.
+    """
+    if cache_folder is None:
+        return(reduce_results_file(filename, max_blocks), False)
+    cache_key = get_cache_key(filename, max_blocks)
+    cache_file = get_cache_file(filename, cache_folder)
+    if path.isfile(cache_file):
+        try:
+            if read_accumulator_metadata(cache_file) == cache_key:
+                return(load_accumulators(cache_file), True)
+        except (OSError, ValueError, KeyError) as e:
+            print("\U0001F6AB  Can not read the cache {}: {}".format(
+                  cache_file, e))
+
+    accumulator_list = reduce_results_file(filename, max_blocks)
+    tmp_file = "{}.{}.tmp.npz".format(cache_file[:-4], os.getpid())
+    try:
+        os.makedirs(path.dirname(cache_file), exist_ok=True)
+        save_accumulators(tmp_file, accumulator_list, cache_key)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print("\U0001F6AB  Can not write the cache {}: {}".format(
+              cache_file, e))
+    return(accumulator_list, False)
+
+
+def reduce_results_files(file_list, n_workers=1, max_blocks=MAX_BLOCKS,
+                         cache_folder=""):
+    """
+        This function reduces the results files in a pool of n_workers
+        processes, or reads them from the cache, and merges the partial
+        results. It returns a dictionary (mode, Q2, x) -> accumulator.
+    """
+    accumulator_list = []
+    n_cached = 0
+    if n_workers > 1 and len(file_list) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            for ifile, (partial_list, from_cache) in enumerate(executor.map(
+                    reduce_results_file_cached, file_list,
+                    [max_blocks]*len(file_list),
+                    [cache_folder]*len(file_list))):
+                n_cached += int(from_cache)
+                print("\r\U0001F9EE  Reduced {}/{} files ({} cached)".format(
+                      ifile + 1, len(file_list), n_cached), end="",
+                      flush=True)
+                accumulator_list += partial_list
+    else:
+        for ifile, filename in enumerate(file_list):
+            partial_list, from_cache = reduce_results_file_cached(
+                filename, max_blocks, cache_folder)
+            n_cached += int(from_cache)
+            print("\r\U0001F9EE  Reduced {}/{} files ({} cached)".format(
+                  ifile + 1, len(file_list), n_cached), end="", flush=True)
+            accumulator_list += partial_list
+    print("")
+    merged = merge_accumulators(accumulator_list)
+    for accumulator in merged.values():
+        accumulator.coarsen_blocks(max_blocks)
+    return(merged)
+
+
+def write_dsigma_dt(merged, output_folder, error_method, n_samples, seed):
+    """This function writes the dsigma/dt outputs of all the (Q2, x)"""
+    amp_list = [acc for (mode, _, _), acc in merged.items() if mode == "Amp"]
+    Q2_list = get_Q2_list({(acc.Q2, acc.x): None for acc in amp_list})
+    for accumulator in amp_list:
+        print("Q2 = {}, x = {}: total number of events: {}".format(
+              accumulator.Q2, accumulator.x, accumulator.n_events))
+        compute_dsigma_dt.write_results(
+            output_folder,
+            compute_dsigma_dt.get_output_label(accumulator.Q2, accumulator.x,
+                                               Q2_list),
+            compute_dsigma_dt.compute_dsigma_dt(accumulator, error_method,
+                                                n_samples, seed))
+
+
+def write_total_cross_sections(merged, output_folder, method, n_samples,
+                               seed):
+    """This function writes the integrated cross sections of all the Q2"""
+    ampF_list = [acc for (mode, _, _), acc in merged.items()
+                 if mode == "AmpF"]
+    Q2_list = get_Q2_list({(acc.Q2, acc.x): None for acc in ampF_list})
+    for Q2 in Q2_list:
+        results = []
+        # sorted from the largest x, as in the evolution
+        for accumulator in sorted([acc for acc in ampF_list if acc.Q2 == Q2],
+                                  key=lambda acc: float(acc.x),
+                                  reverse=True):
+            print(f"x={accumulator.x}: Number of events: "
+                  + f"{accumulator.n_events}")
+            b_vals, theta_vals = compute_totalCrossSections.get_grid(
+                accumulator.kinematics[:, 0], accumulator.kinematics[:, 1])
+            results.append((accumulator.x,
+                            compute_totalCrossSections.resample_cross_sections(
+                                accumulator, b_vals, theta_vals, method,
+                                n_samples, seed)))
+        label = ""
+        if len(Q2_list) > 1:
+            label = f"_Q2_{Q2}"
+        compute_totalCrossSections.write_cross_sections(
+            path.join(output_folder, f"total_cross_sections{label}.dat"),
+            results)
+
+
+def get_file_list(pattern_list):
+    """This function expands the file names and glob patterns"""
+    file_list = []
+    for pattern in pattern_list:
+        match_list = sorted(glob(pattern))
+        if not match_list:
+            print("\U0001F6AB  No file matches {}".format(pattern))
+        file_list += [path.abspath(file_i) for file_i in match_list
+                      if path.abspath(file_i) not in file_list]
+    return(file_list)
+
+
+def main():
+    """This is the main function"""
+    parser = argparse.ArgumentParser(
+        description='\U0001F9EE Analyze many results files in parallel',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('results_files', type=str, nargs='+',
+                        help='results files or glob patterns, e.g. '
+                             + '"RESULTS_*.h5"')
+    parser.add_argument('-o', '--output_folder', type=str,
+                        default="analysis", help='output folder')
+    parser.add_argument('-j', '--n_workers', type=int,
+                        default=os.cpu_count() or 1,
+                        help='number of worker processes')
+    parser.add_argument('--max_blocks', type=int, default=MAX_BLOCKS,
+                        help='maximum number of blocks of events')
+    parser.add_argument('--method', type=str, default="jackknife",
+                        choices=['jackknife', 'bootstrap'],
+                        help='resampling for the integrated cross sections')
+    parser.add_argument('--dsigma_error', type=str, default="analytic",
+                        choices=['analytic', 'jackknife', 'bootstrap'],
+                        help='error of the dsigma/dt spectra')
+    parser.add_argument('--n_resamples', type=int, default=N_SAMPLES,
+                        help='number of resamples')
+    parser.add_argument('--seed', type=int, default=-1,
+                        help='random seed of the resampling (-1: random)')
+    parser.add_argument('--cache_folder', type=str, default="",
+                        help='folder of the reduction cache (default: '
+                             + CACHE_FOLDERNAME + ' next to the results)')
+    parser.add_argument('--no_cache', action='store_true',
+                        help='reduce all the files without the cache')
+    args = parser.parse_args()
+
+    file_list = get_file_list(args.results_files)
+    if not file_list:
+        exit(1)
+    os.makedirs(args.output_folder, exist_ok=True)
+    print("\U0001F9EE  Analyzing {} files with {} workers".format(
+          len(file_list), args.n_workers))
+    start_time = time.time()
+    cache_folder = None if args.no_cache else args.cache_folder
+    if cache_folder:
+        cache_folder = path.abspath(cache_folder)
+    merged = reduce_results_files(file_list, args.n_workers,
+                                  args.max_blocks, cache_folder)
+    save_accumulators(path.join(args.output_folder, "accumulators.npz"),
+                      list(merged.values()))
+    print("\U0001F9EE  Reduced in {:.1f} s".format(time.time() - start_time))
+    write_dsigma_dt(merged, args.output_folder, args.dsigma_error,
+                    args.n_resamples, args.seed)
+    write_total_cross_sections(merged, args.output_folder, args.method,
+                               args.n_resamples, args.seed)
+
+
+if __name__ == "__main__":
+    main()
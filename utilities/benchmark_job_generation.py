@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+    This script benchmarks the generation of the job folders by
+    generate_jobs.py and reports the number of jobs generated per second.
+
+    The folders are created with the parameters of a user parameter file
+    in a temporary folder (by default under /tmp), for each number of
+    generation threads.
+"""
+
+import sys
+import argparse
+import shutil
+import tempfile
+import time
+from os import path, mkdir, makedirs
+
+PACKAGE_PATH = path.abspath(path.join(path.dirname(__file__), ".."))
+sys.path.insert(0, PACKAGE_PATH)
+import generate_jobs
+
+
+def prepare_working_folder(working_folder, parameter_dict):
+    """
+        This function creates the model parameters and a code folder with
+        the files linked into the job folders
+    """
+    code_path = path.join(working_folder, "codes")
+    shutil.copytree(path.join(PACKAGE_PATH, "codes"), code_path,
+                    ignore=shutil.ignore_patterns("*_code"))
+    diffraction_path = path.join(code_path, "subnucleondiffraction_code")
+    makedirs(path.join(diffraction_path, "build/bin"))
+    open(path.join(diffraction_path,
+                   parameter_dict.diffraction_dict["wavef_file"]), "w").close()
+    makedirs(path.join(working_folder, "model_parameters/IPGlasma"))
+    with open(path.join(working_folder, "model_parameters/IPGlasma/input"),
+              "w") as f:
+        for key, value in parameter_dict.ipglasma_dict.items():
+            f.write("{} {}\n".format(key, value))
+    return(code_path)
+
+
+def benchmark(parameter_dict, n_jobs, n_workers, tmp_root):
+    """This function generates n_jobs job folders and returns the jobs/s"""
+    working_folder = tempfile.mkdtemp(prefix="benchmark_jobs_", dir=tmp_root)
+    try:
+        code_path = prepare_working_folder(working_folder, parameter_dict)
+        job_list = [[ijob, ijob, 1] for ijob in range(n_jobs)]
+        time_start = time.time()
+        link_list = generate_jobs.generate_shared_files(
+            "IPGlasma", code_path, working_folder, "local", 1,
+            parameter_dict.diffraction_dict)
+        generate_jobs.generate_all_event_folders(
+            "IPGlasma", link_list, working_folder, "local", job_list, 1,
+            False, "", "10:00:00", n_workers=n_workers, show_progress=False)
+        generate_jobs.write_jobs_manifest(working_folder, job_list, {})
+        elapsed = time.time() - time_start
+    finally:
+        shutil.rmtree(working_folder)
+    return(n_jobs/max(elapsed, 1e-9))
+
+
+def main():
+    """This is the main function"""
+    parser = argparse.ArgumentParser(
+        description='\U0001F3CE Benchmark the generation of job folders')
+    parser.add_argument('-n', '--n_jobs', type=int, default=1000,
+                        help='number of job folders to generate')
+    parser.add_argument('-t', '--n_workers', type=int, nargs='*',
+                        default=[1, 4], help='numbers of threads to test')
+    parser.add_argument('-par', '--par_dict', type=str,
+                        default=path.join(
+                            PACKAGE_PATH,
+                            "parameters_dict_user_IPGlasmaJIMWLK_pp.py"),
+                        help='user-defined parameter dictionary file')
+    parser.add_argument('--tmp', type=str, default=tempfile.gettempdir(),
+                        help='folder in which the jobs are generated')
+    args = parser.parse_args()
+
+    sys.path.insert(0, path.dirname(path.abspath(args.par_dict)))
+    parameter_dict = __import__(args.par_dict.split('.py')[0].split("/")[-1])
+    if not path.isdir(args.tmp):
+        mkdir(args.tmp)
+    print("{:>10s} {:>10s} {:>12s}".format("threads", "jobs", "jobs/s"))
+    for n_workers in args.n_workers:
+        rate = benchmark(parameter_dict, args.n_jobs, n_workers, args.tmp)
+        print("{:>10d} {:>10d} {:>12.1f}".format(n_workers, args.n_jobs,
+                                                  rate), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,17 @@
 import numpy as np
 from sys import argv, exit
 from os import path, mkdir
+import sys
 import h5py
 from scipy import interpolate
 import shutil
 
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+from amplitude_index import build_amplitude_index, get_Q2_list
+from amplitude_accumulator import accumulate_amplitudes
+from resampling import (get_block_size, get_resampling_error,
+                        get_resampling_weights, resample_spectra)
+
 
 HBARC = 0.197327053
 
@@ -26,94 +33,67 @@ dsigmadt_data_coherent_error = np.array(
         [18.4, 12.9, 9.3, 7.0, 5.1, 3.7, 2.74, 1.75])
 
 
-try:
-    data_path = path.abspath(argv[1])
-    data_name = data_path.split("/")[-1]
-    results_folder_name = data_name.split(".h5")[0]
-    avg_folder_header = path.join(results_folder_name)
-    print("output folder: %s" % avg_folder_header)
-    if(path.isdir(avg_folder_header)):
-        print("folder %s already exists!" % avg_folder_header)
-        var = input("do you want to delete it? [y/N]")
-        if 'y' in var:
-            shutil.rmtree(avg_folder_header)
-        else:
-            print("please choose another folder path~")
-            exit(0)
-    mkdir(avg_folder_header)
-except IndexError:
-    print("Usage: {} results.h5 results_folder".format(argv[0]))
-    exit(1)
+PREFACTOR = 1e7*HBARC*HBARC/(16*np.pi)
 
+# the errors from the spread of the amplitudes ("analytic"), or from
+# resampling the events ("jackknife" or "bootstrap"), also chosen by the
+# second command-line argument
+ERROR_METHODS = ["analytic", "jackknife", "bootstrap"]
+ERROR_METHOD = "analytic"
+N_RESAMPLES = 5000
+RANDOM_SEED = -1        # -1: from the system entropy
 
-# analysis begins ...
 
-hf = h5py.File(data_path, "r")
-event_list = list(hf.keys())
-ampList = list(hf.get(event_list[0]).keys())
-xList = list(set([x.split("_")[-1] for x in ampList]))
+def compute_dsigma_dt(accumulator, error_method=ERROR_METHOD,
+                      n_resamples=N_RESAMPLES, seed=RANDOM_SEED):
+    """
+        This function computes the coherent and incoherent dsigma/dt from
+        the accumulated Amp tables of a (Q2, x)
+    """
+    t_arr = accumulator.kinematics[:, 0]
+    nev = accumulator.n_events
 
-for x_i in xList:
-    try:
-        float(x_i)
-    except (ValueError,TypeError):
-        print("Skip x_i=",x_i)
-        continue
-    
-    realpart = []
-    imagpart = []
-    t_arr = np.array([])
-    for iev, event_name in enumerate(event_list):
-        event_id = int(event_name.split("_")[-1])
-        event_group = hf.get(event_name)
-        for ifile, fileName in enumerate(event_group.keys()):
-            # Only include the differential cross sectoin data
-            if not fileName.startswith("Amp_"): 
-                continue
-            if x_i in fileName:
-                temp_data1 = np.nan_to_num(event_group.get(fileName))
-                if temp_data1.shape == (0,): continue
-
-                realpart.append(temp_data1[:, 1])
-                imagpart.append(temp_data1[:, 2])
-                if len(t_arr) == 0:
-                    t_arr = temp_data1[:, 0]
-
-    t_arr = np.array(t_arr)
-    realpart = np.array(realpart)
-    imagpart = np.array(imagpart)
-    nev = len(realpart[:, 0])
-    print("total number of events: {}".format(nev))
-
-    real_mean = np.mean(realpart, axis=0)
-    imag_mean = np.mean(imagpart, axis=0)
-    real_std = np.std(realpart, axis=0)
-    imag_std = np.std(imagpart, axis=0)
-    real_sq_mean = np.mean(realpart**2., axis=0)
-    imag_sq_mean = np.mean(imagpart**2., axis=0)
-    real_sq_std = np.std(realpart**2., axis=0)
-    imag_sq_std = np.std(imagpart**2., axis=0)
-
-    prefactor = 1e7*HBARC*HBARC/(16*np.pi)
-
-    coherent = (real_mean**2. + imag_mean**2.)*prefactor
+    real_mean, imag_mean = accumulator.moment(1)
+    real_std, imag_std = accumulator.std(1)
+    real_sq_mean, imag_sq_mean = accumulator.moment(2)
+    real_sq_std, imag_sq_std = accumulator.std(2)
+
+    coherent = (real_mean**2. + imag_mean**2.)*PREFACTOR
     coherent_err = 2.*(np.abs(real_mean)*real_std
-                       + np.abs(imag_mean)*imag_std)*prefactor/np.sqrt(nev)
+                       + np.abs(imag_mean)*imag_std)*PREFACTOR/np.sqrt(nev)
 
     incoherent = (real_sq_mean + imag_sq_mean
-                  - real_mean**2 - imag_mean**2.)*prefactor
+                  - real_mean**2 - imag_mean**2.)*PREFACTOR
     incoherent_err = (
         (real_sq_std + imag_sq_std
          + 2.*(np.abs(real_mean)*real_std + np.abs(imag_mean)*imag_std)
-        )*prefactor/np.sqrt(nev)
+        )*PREFACTOR/np.sqrt(nev)
     )
-    output = np.array([t_arr, coherent, coherent_err,
-                       incoherent, incoherent_err])
-    np.savetxt(path.join(avg_folder_header, f"Diffraction_x_{x_i}.txt"),
-               output.transpose(), fmt="%.6e", delimiter="  ",
-               header="t  coh.  coh_err  incoh.  incoh_err")
-
-    # interpolate the coherent/incoherent cross section to the exp. data points
+    if error_method != "analytic":
+        n_blocks = len(accumulator.block_n)
+        weights = get_resampling_weights(error_method, n_blocks,
+                                         n_resamples, seed)
+        coherent_samples, incoherent_samples = resample_spectra(
+            accumulator, weights)
+        coherent_err = get_resampling_error(
+            coherent_samples, error_method, n_blocks)*PREFACTOR
+        incoherent_err = get_resampling_error(
+            incoherent_samples, error_method, n_blocks)*PREFACTOR
+    return(t_arr, coherent, coherent_err, incoherent, incoherent_err)
+
+
+def interpolate_to_data(t_arr, coherent, coherent_err, incoherent,
+                        incoherent_err):
+    """
+        This function interpolates the coherent/incoherent cross sections
+        to the t of the H1 data points. It returns None if the computed t
+        range does not cover the data.
+    """
+    t_incoherent = t_data_incoherent[0:7]  # only consider 0-2.5 GeV
+    t_max = max(np.max(t_data_coherent), np.max(t_incoherent))
+    if len(t_arr) < 4 or t_arr[0] > np.min(t_data_coherent) \
+            or t_arr[-1] < t_max:
+        return(None)
     f_coh = interpolate.interp1d(t_arr, np.log(coherent + 1e-30), kind="cubic")
     f_coh_err = interpolate.interp1d(t_arr, np.log(coherent_err + 1e-30),
                                      kind="cubic")
@@ -125,15 +105,95 @@ for x_i in xList:
     coh_data = np.exp(f_coh(TT))
     coh_data_err = np.exp(f_coh_err(TT))
 
-    TT = t_data_incoherent[0:7]  # only consider 0-2.5 GeV 
+    TT = t_incoherent
     incoh_data = np.exp(f_incoh(TT))
     incoh_data_err = np.exp(f_incoh_err(TT))
 
-    t_arr = np.concatenate((t_data_incoherent[0:7], t_data_coherent))
+    t_arr = np.concatenate((t_incoherent, t_data_coherent))
     model_result = np.concatenate((incoh_data, coh_data))
     model_err = np.concatenate((incoh_data_err, coh_data_err))
-    np.savetxt(path.join(avg_folder_header, f"Bayesian_output_x_{x_i}.txt"),
-               np.array([t_arr, model_result, model_err]).transpose(),
+    return(t_arr, model_result, model_err)
+
+
+def get_output_label(Q2, x_i, Q2_list):
+    """
+        This function returns the label of the output files of a (Q2, x)
+        pair. Q2 is only in the label if the results have several Q2.
+    """
+    if len(Q2_list) > 1:
+        return("Q2_{}_x_{}".format(Q2, x_i))
+    return("x_{}".format(x_i))
+
+
+def write_results(avg_folder_header, label, spectra):
+    """This function writes the spectra and the Bayesian outputs"""
+    np.savetxt(path.join(avg_folder_header, f"Diffraction_{label}.txt"),
+               np.array(spectra).transpose(), fmt="%.6e", delimiter="  ",
+               header="t  coh.  coh_err  incoh.  incoh_err")
+    model_output = interpolate_to_data(*spectra)
+    if model_output is None:
+        print("The t range of {} does not cover the data, ".format(label)
+              + "skip the Bayesian output")
+        return
+    np.savetxt(path.join(avg_folder_header, f"Bayesian_output_{label}.txt"),
+               np.array(model_output).transpose(),
                fmt="%.6e", delimiter="  ",
                header="t  results  stat. err")
-hf.close()
+
+
+def analyze_results(data_path, avg_folder_header, error_method=ERROR_METHOD):
+    """
+        This function computes dsigma/dt for all the (Q2, x) pairs in a
+        results file
+    """
+    with h5py.File(data_path, "r") as hf:
+        index = build_amplitude_index([hf], "Amp")
+        block_size = 0
+        if error_method != "analytic":
+            block_size = get_block_size(max(
+                [len(entry_list) for entry_list in index.values()] + [0]))
+        accumulator_list = accumulate_amplitudes([hf], index, "Amp",
+                                                 block_size=block_size)
+    Q2_list = get_Q2_list(index)
+    for accumulator in accumulator_list:
+        print("Q2 = {}, x = {}: total number of events: {}".format(
+              accumulator.Q2, accumulator.x, accumulator.n_events))
+        if accumulator.n_events == 0:
+            continue
+        write_results(avg_folder_header,
+                      get_output_label(accumulator.Q2, accumulator.x,
+                                       Q2_list),
+                      compute_dsigma_dt(accumulator, error_method))
+
+
+def main():
+    """This is the main function"""
+    try:
+        data_path = path.abspath(argv[1])
+    except IndexError:
+        print("Usage: {} results.h5 [{}]".format(argv[0],
+                                                "|".join(ERROR_METHODS)))
+        exit(1)
+    error_method = argv[2] if len(argv) > 2 else ERROR_METHOD
+    if error_method not in ERROR_METHODS:
+        print("\U0001F6AB  Unknown error method {}, options: {}".format(
+              error_method, ", ".join(ERROR_METHODS)))
+        exit(1)
+    data_name = data_path.split("/")[-1]
+    results_folder_name = data_name.split(".h5")[0]
+    avg_folder_header = path.join(results_folder_name)
+    print("output folder: %s" % avg_folder_header)
+    if(path.isdir(avg_folder_header)):
+        print("folder %s already exists!" % avg_folder_header)
+        var = input("do you want to delete it? [y/N]")
+        if 'y' in var:
+            shutil.rmtree(avg_folder_header)
+        else:
+            print("please choose another folder path~")
+            exit(0)
+    mkdir(avg_folder_header)
+    analyze_results(data_path, avg_folder_header, error_method)
+
+
+if __name__ == "__main__":
+    main()
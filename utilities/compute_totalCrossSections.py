@@ -9,6 +9,14 @@ import matplotlib.pyplot as plt
 import os
 import sys
 
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+from amplitude_index import (build_amplitude_index, get_Q2_list, get_x_list,
+                             iterate_amplitude_tables)
+from amplitude_accumulator import AmplitudeAccumulator
+from resampling import (get_block_size, get_quadrature_weights,
+                        get_resampling_error, get_resampling_weights,
+                        resample_integrals)
+
 # =========================
 # User settings
 # =========================
@@ -17,129 +25,25 @@ PRINT_FLAG = True
 
 HBARC = 0.197327053  # GeV fm
 
-if len(argv) < 2 or len(argv) > 3:
-    print("Usage: compute_totalCrossSections.py <input_file> [optional_additional_file]")
-    exit(1)
-
-input_file = argv[1]
-extra_file = argv[2] if len(argv) == 3 else None
-
-# =========================
-# Output directory
-# =========================
-if PLOT_FLAG:
-    plot_dir = "plots_Integrated"
-    os.makedirs(plot_dir, exist_ok=True)
-
 # =========================
-# Load HDF5 file
+# Prefactor
 # =========================
-hf1 = h5py.File(input_file, "r")
-event_list1 = list(hf1.keys())
-
-if len(event_list1) == 0:
-    sys.exit("No events found in the file.")
-
-event_list2 = []
-hf2 = None
-if extra_file and os.path.exists(extra_file):
-    hf2 = h5py.File(extra_file, "r")
-    event_list2 = list(hf2.keys())
-elif extra_file and not os.path.exists(extra_file):
-    print(f"File {extra_file} does not exist.")
-# Rename events from second file to avoid collisions
-event_list2_renamed = [name + "_extra" for name in event_list2]
-# Merge event lists
-event_list = event_list1 + event_list2_renamed
-events = {name: hf1[name] for name in event_list1}
-if hf2:
-    events.update({new_name: hf2[old_name] for old_name, new_name in zip(event_list2, event_list2_renamed)})
-
-
-event_data = events[event_list[0]]
-ampList = list(event_data.keys())
-xList = sorted({x.split("_")[-1] for x in ampList}, key=float, reverse=True)
+prefactor_coh = 1e7 * HBARC**2 / (16.0 * np.pi * np.pi)
+prefactor_incoh = 1e7 * HBARC**2 / (16.0 * np.pi * np.pi)
 
 # =========================
-# Storage
+# Jackknife
 # =========================
-sigma_coh_T = []
-sigma_coh_T_err = []
-sigma_incoh_T = []
-sigma_incoh_T_err = []
+number_JK = 5000
+RESAMPLING_METHOD = "jackknife"     # or "bootstrap"
+RANDOM_SEED = -1                    # -1: from the system entropy
 
-sigma_coh_L = []
-sigma_coh_L_err = []
-sigma_incoh_L = []
-sigma_incoh_L_err = []
 
-# =========================
-# Plot setup
-# =========================
-if PLOT_FLAG:
-    # Four rows:
-    # 0: |F_T|^2 (θ-integrated) vs b
-    # 1: |F_L|^2 (θ-integrated) vs b
-    # 2: |F_T|^2 (b-integrated) vs θ
-    # 3: |F_L|^2 (b-integrated) vs θ
-    fig, axs = plt.subplots(4, len(xList), figsize=(5 * len(xList), 10))
-    if len(xList) == 1:
-        # Ensure consistent 2D indexing axs[row, col]
-        axs = np.array(axs).reshape(4, 1)
-
-# =========================
-# Main loop over x
-# =========================
-for k, x_i in enumerate(xList):
-
-    try:
-        float(x_i)
-    except ValueError:
-        continue
-
-    F_T_real = []
-    F_T_imag = []
-    F_L_real = []
-    F_L_imag = []
-    b_arr = None
-    theta_arr = None
-
-    # -------------------------
-    # Read data
-    # -------------------------
-    for event_name in event_list:
-        event_group = events.get(event_name)
-
-        for fileName in event_group.keys():
-            if not fileName.startswith("AmpF_"):
-                continue
-            if x_i not in fileName:
-                continue
-            data = np.nan_to_num(event_group.get(fileName))
-            if data.ndim != 2 or data.shape[1] < 6:
-                continue
-
-            F_T_real.append(data[:, 2])
-            F_T_imag.append(data[:, 3])
-            F_L_real.append(data[:, 4])
-            F_L_imag.append(data[:, 5])
-
-            if b_arr is None:
-                b_arr = data[:, 0]
-            if theta_arr is None:
-                theta_arr = data[:, 1]
-
-    if len(F_T_real) == 0:
-        continue
-
-    F_T_real = np.array(F_T_real)
-    F_T_imag = np.array(F_T_imag)
-    F_L_real = np.array(F_L_real)
-    F_L_imag = np.array(F_L_imag)
-
-    # Infer the 2D (b, theta) grid from the flattened arrays
-    b_arr = np.asarray(b_arr)
-    theta_arr = np.asarray(theta_arr)
+def get_grid(b_arr, theta_arr):
+    """
+        This function infers the 2D (b, theta) grid from the flattened
+        arrays of an AmpF table
+    """
     b_vals = np.unique(b_arr)
     theta_vals = np.unique(theta_arr)
     nb = len(b_vals)
@@ -149,170 +53,205 @@ for k, x_i in enumerate(xList):
         raise RuntimeError(
             f"Inconsistent grid: nb*ntheta={nb*ntheta} but number of points={b_arr.size}"
         )
+    return b_vals, theta_vals
 
-    nev = F_T_real.shape[0]
-    print(f"x={x_i}: Number of events after filtering: {nev}")
 
-    # -------------------------
-    # Plot theta-integrated |F|^2 vs b
-    # -------------------------
-    if PLOT_FLAG:
-        for i in range(nev):
-            # Reshape to (nb, ntheta) to integrate over theta
-            F_T_real_i = F_T_real[i].reshape(nb, ntheta) + 1e-16
-            F_T_imag_i = F_T_imag[i].reshape(nb, ntheta) + 1e-16
-            F_L_real_i = F_L_real[i].reshape(nb, ntheta) + 1e-16
-            F_L_imag_i = F_L_imag[i].reshape(nb, ntheta) + 1e-16
-
-            F_T_abs2 = F_T_real_i**2 + F_T_imag_i**2
-            F_L_abs2 = F_L_real_i**2 + F_L_imag_i**2
-
-            F_T_abs2_int_theta = simpson(F_T_abs2, x=theta_vals, axis=1)  # shape (nb,)
-            F_L_abs2_int_theta = simpson(F_L_abs2, x=theta_vals, axis=1)  # shape (nb,)
-
-            # Integrate over b to get b-integrated profiles vs θ
-            F_T_abs2_int_b = simpson(F_T_abs2, x=b_vals, axis=0)  # shape (ntheta,)
-            F_L_abs2_int_b = simpson(F_L_abs2, x=b_vals, axis=0)  # shape (ntheta,)
-
-            # Plot only lines (no markers) for clearer curves
-            axs[0, k].plot(b_vals, F_T_abs2_int_theta, alpha=0.2, linestyle='-', marker=None)
-            axs[1, k].plot(b_vals, F_L_abs2_int_theta, alpha=0.2, linestyle='-', marker=None)
-            axs[2, k].plot(theta_vals, F_T_abs2_int_b, alpha=0.2, linestyle='-', marker=None)
-            axs[3, k].plot(theta_vals, F_L_abs2_int_b, alpha=0.2, linestyle='-', marker=None)
-
-        axs[0, k].set_title(f"x = {x_i}")
-        axs[0, k].set_xlabel("b [1/GeV]")
-        axs[0, k].set_ylabel(r"|F_T|$^2$ (θ-integrated)")
-        axs[0, k].set_yscale("log")
-
-        axs[1, k].set_xlabel("b [1/GeV]")
-        axs[1, k].set_ylabel(r"|F_L|$^2$ (θ-integrated)")
-        axs[1, k].set_yscale("log")
-
-        axs[2, k].set_xlabel(r"θ")
-        axs[2, k].set_ylabel(r"|F_T|$^2$ (b-integrated)")
-        axs[2, k].set_yscale("log")
-
-        axs[3, k].set_xlabel(r"θ")
-        axs[3, k].set_ylabel(r"|F_L|$^2$ (b-integrated)")
-        axs[3, k].set_yscale("log")
+def plot_profiles(axs, k, F_T_real, F_T_imag, F_L_real, F_L_imag,
+                  b_vals, theta_vals):
+    """
+        This function plots the theta-integrated |F|^2 vs b and the
+        b-integrated |F|^2 vs theta of every event in the column k
+    """
+    nb = len(b_vals)
+    ntheta = len(theta_vals)
+    nev = F_T_real.shape[0]
+    for i in range(nev):
+        # Reshape to (nb, ntheta) to integrate over theta
+        F_T_real_i = F_T_real[i].reshape(nb, ntheta) + 1e-16
+        F_T_imag_i = F_T_imag[i].reshape(nb, ntheta) + 1e-16
+        F_L_real_i = F_L_real[i].reshape(nb, ntheta) + 1e-16
+        F_L_imag_i = F_L_imag[i].reshape(nb, ntheta) + 1e-16
+
+        F_T_abs2 = F_T_real_i**2 + F_T_imag_i**2
+        F_L_abs2 = F_L_real_i**2 + F_L_imag_i**2
+
+        F_T_abs2_int_theta = simpson(F_T_abs2, x=theta_vals, axis=1)  # shape (nb,)
+        F_L_abs2_int_theta = simpson(F_L_abs2, x=theta_vals, axis=1)  # shape (nb,)
+
+        # Integrate over b to get b-integrated profiles vs θ
+        F_T_abs2_int_b = simpson(F_T_abs2, x=b_vals, axis=0)  # shape (ntheta,)
+        F_L_abs2_int_b = simpson(F_L_abs2, x=b_vals, axis=0)  # shape (ntheta,)
+
+        # Plot only lines (no markers) for clearer curves
+        axs[0, k].plot(b_vals, F_T_abs2_int_theta, alpha=0.2, linestyle='-', marker=None)
+        axs[1, k].plot(b_vals, F_L_abs2_int_theta, alpha=0.2, linestyle='-', marker=None)
+        axs[2, k].plot(theta_vals, F_T_abs2_int_b, alpha=0.2, linestyle='-', marker=None)
+        axs[3, k].plot(theta_vals, F_L_abs2_int_b, alpha=0.2, linestyle='-', marker=None)
+
+
+def set_plot_labels(axs, k, x_i):
+    """This function sets the titles and the axes of the column k"""
+    axs[0, k].set_title(f"x = {x_i}")
+    axs[0, k].set_xlabel("b [1/GeV]")
+    axs[0, k].set_ylabel(r"|F_T|$^2$ (θ-integrated)")
+    axs[0, k].set_yscale("log")
+
+    axs[1, k].set_xlabel("b [1/GeV]")
+    axs[1, k].set_ylabel(r"|F_L|$^2$ (θ-integrated)")
+    axs[1, k].set_yscale("log")
+
+    axs[2, k].set_xlabel(r"θ")
+    axs[2, k].set_ylabel(r"|F_T|$^2$ (b-integrated)")
+    axs[2, k].set_yscale("log")
+
+    axs[3, k].set_xlabel(r"θ")
+    axs[3, k].set_ylabel(r"|F_L|$^2$ (b-integrated)")
+    axs[3, k].set_yscale("log")
+
+
+def resample_cross_sections(accumulator, b_vals, theta_vals,
+                            method=RESAMPLING_METHOD, n_samples=number_JK,
+                            seed=RANDOM_SEED):
+    """
+        This function computes the coherent and incoherent cross sections
+        of the transverse and longitudinal components with their
+        resampling errors. It returns a list of (mean, error) for
+        coh_T, incoh_T, coh_L, incoh_L.
+    """
+    n_blocks = len(accumulator.block_n)
+    try:
+        weights = get_resampling_weights(method, n_blocks, n_samples, seed)
+    except ValueError:
+        sys.exit("Not enough events for jackknife.")
+    coherent, incoherent = resample_integrals(
+        accumulator, weights, get_quadrature_weights(b_vals, theta_vals))
+    coherent *= prefactor_coh
+    incoherent *= prefactor_incoh
 
     # =========================
-    # Prefactor
+    # Means and errors
     # =========================
-    prefactor_coh = 1e7 * HBARC**2 / (16.0 * np.pi * np.pi)
-    prefactor_incoh = 1e7 * HBARC**2 / (16.0 * np.pi * np.pi)
+    results = []
+    for samples in [coherent[:, 0], incoherent[:, 0], coherent[:, 1],
+                    incoherent[:, 1]]:
+        results.append((np.mean(samples), get_resampling_error(
+            samples, method, n_blocks)))
+    return results
+
+
+def compute_cross_sections(hf_list, index, Q2, plot_file=None):
+    """
+        This function computes the integrated cross sections at all the x
+        of a Q2. It returns a list of (x, results of
+        resample_cross_sections).
+    """
+    # sorted from the largest x, as in the evolution
+    xList = sorted(get_x_list(index, Q2), key=float, reverse=True)
+    if plot_file is not None:
+        # Four rows:
+        # 0: |F_T|^2 (θ-integrated) vs b
+        # 1: |F_L|^2 (θ-integrated) vs b
+        # 2: |F_T|^2 (b-integrated) vs θ
+        # 3: |F_L|^2 (b-integrated) vs θ
+        fig, axs = plt.subplots(4, len(xList), figsize=(5 * len(xList), 10))
+        # Ensure consistent 2D indexing axs[row, col]
+        axs = np.array(axs).reshape(4, len(xList))
+
+    results = []
+    for k, x_i in enumerate(xList):
+        entry_list = index[(Q2, x_i)]
+        # the events are read in chunks and reduced to block sums
+        accumulator = AmplitudeAccumulator("AmpF", Q2, x_i,
+                                           get_block_size(len(entry_list)))
+        for data in iterate_amplitude_tables(hf_list, entry_list, "AmpF"):
+            if accumulator.n_events == 0:
+                b_vals, theta_vals = get_grid(data[0, :, 0], data[0, :, 1])
+            if plot_file is not None:
+                plot_profiles(axs, k, data[:, :, 2], data[:, :, 3],
+                              data[:, :, 4], data[:, :, 5], b_vals,
+                              theta_vals)
+            accumulator.add_events(data)
+        if accumulator.n_events == 0:
+            continue
+        print(f"x={x_i}: Number of events after filtering: {accumulator.n_events}")
+        if plot_file is not None:
+            set_plot_labels(axs, k, x_i)
+        results.append((x_i, resample_cross_sections(accumulator, b_vals,
+                                                     theta_vals)))
+
+    if plot_file is not None:
+        plt.tight_layout()
+        plt.savefig(plot_file)
+        plt.close(fig)
+    return results
+
+
+def write_cross_sections(output_file, results):
+    """This function writes the integrated cross sections vs x"""
+    with open(output_file, "w") as of:
+        of.write("# x  coh_T[nb]  err_coh_T[nb]  incoh_T[nb]  err_incoh_T[nb]  coh_L[nb]  err_coh_L[nb]  incoh_L[nb]  err_incoh_L[nb] \n")
+        for x, sigma_list in results:
+            of.write(f"{float(x):.6e} " + " ".join(
+                [f"{mean:.6e} {err:.6e}" for mean, err in sigma_list]) + "\n")
+
+    if PRINT_FLAG:
+        for x, sigma_list in results:
+            print(f"x={x}: " + ", ".join(
+                [f"sigma_{name}={mean:.4e}±{err:.4e}" for name, (mean, err)
+                 in zip(["coh_T", "incoh_T", "coh_L", "incoh_L"],
+                        sigma_list)]))
+
+
+def main():
+    """This is the main function"""
+    if len(argv) < 2 or len(argv) > 3:
+        print("Usage: compute_totalCrossSections.py <input_file> [optional_additional_file]")
+        exit(1)
+
+    input_file = argv[1]
+    extra_file = argv[2] if len(argv) == 3 else None
 
     # =========================
-    # Jackknife
+    # Output directory
     # =========================
-    number_JK = 5000
-    delete_n = int(0.2 * nev)
-
-    if delete_n == 0:
-        sys.exit("Not enough events for jackknife.")
-
-    sigma_coh_T_samples = []
-    sigma_incoh_T_samples = []
-    sigma_coh_L_samples = []
-    sigma_incoh_L_samples = []
-
-    # -------------------------
-    # Jackknife resampling
-    # -------------------------
-    for _ in range(number_JK):
-        idx = np.random.choice(nev, nev - delete_n, replace=False)
-
-        # Transverse component: coherent part |<F_T>|^2
-        F_T_real_mean = np.mean(F_T_real[idx], axis=0).reshape(nb, ntheta)
-        F_T_imag_mean = np.mean(F_T_imag[idx], axis=0).reshape(nb, ntheta)
-        F_T_mean_sq = F_T_real_mean**2 + F_T_imag_mean**2
-
-        F_T_mean_sq_int_over_theta = simpson(F_T_mean_sq, x=theta_vals, axis=1)  # shape (nb,)
-        sigma_coh_T_val = prefactor_coh * simpson(F_T_mean_sq_int_over_theta * b_vals, x=b_vals)
-        sigma_coh_T_samples.append(sigma_coh_T_val)
-
-        # Transverse component: incoherent part <|F_T|^2> - |<F_T>|^2
-        F_T_abs2_mean = np.mean(F_T_real[idx]**2 + F_T_imag[idx]**2, axis=0).reshape(nb, ntheta)
-        F_T_var = F_T_abs2_mean - F_T_mean_sq
-        F_T_var_int_over_theta = simpson(F_T_var, x=theta_vals, axis=1)
-        sigma_incoh_T_val = prefactor_incoh * simpson(F_T_var_int_over_theta * b_vals, x=b_vals)
-        sigma_incoh_T_samples.append(sigma_incoh_T_val)
-
-        # Longitudinal component: coherent part |<F_L>|^2
-        F_L_real_mean = np.mean(F_L_real[idx], axis=0).reshape(nb, ntheta)
-        F_L_imag_mean = np.mean(F_L_imag[idx], axis=0).reshape(nb, ntheta)
-        F_L_mean_sq = F_L_real_mean**2 + F_L_imag_mean**2
-
-        F_L_mean_sq_int_over_theta = simpson(F_L_mean_sq, x=theta_vals, axis=1)  # shape (nb,)
-        sigma_coh_L_val = prefactor_coh * simpson(F_L_mean_sq_int_over_theta * b_vals, x=b_vals)
-        sigma_coh_L_samples.append(sigma_coh_L_val)
-
-        # Longitudinal component: incoherent part <|F_L|^2> - |<F_L>|^2
-        F_L_abs2_mean = np.mean(F_L_real[idx]**2 + F_L_imag[idx]**2, axis=0).reshape(nb, ntheta)
-        F_L_var = F_L_abs2_mean - F_L_mean_sq
-        F_L_var_int_over_theta = simpson(F_L_var, x=theta_vals, axis=1)
-        sigma_incoh_L_val = prefactor_incoh * simpson(F_L_var_int_over_theta * b_vals, x=b_vals)
-        sigma_incoh_L_samples.append(sigma_incoh_L_val)
-
-    sigma_coh_T_samples = np.array(sigma_coh_T_samples)
-    sigma_incoh_T_samples = np.array(sigma_incoh_T_samples)
-    sigma_coh_L_samples = np.array(sigma_coh_L_samples)
-    sigma_incoh_L_samples = np.array(sigma_incoh_L_samples)
+    if PLOT_FLAG:
+        plot_dir = "plots_Integrated"
+        os.makedirs(plot_dir, exist_ok=True)
 
     # =========================
-    # Means and errors
+    # Load HDF5 files
     # =========================
-    def jk_err(samples):
-        return np.sqrt((nev - delete_n) / nev * np.var(samples))
+    hf_list = [h5py.File(input_file, "r")]
+    if extra_file and os.path.exists(extra_file):
+        hf_list.append(h5py.File(extra_file, "r"))
+    elif extra_file and not os.path.exists(extra_file):
+        print(f"File {extra_file} does not exist.")
 
-    sigma_coh_T.append(np.mean(sigma_coh_T_samples))
-    sigma_coh_T_err.append(jk_err(sigma_coh_T_samples))
-    sigma_incoh_T.append(np.mean(sigma_incoh_T_samples))
-    sigma_incoh_T_err.append(jk_err(sigma_incoh_T_samples))
+    index = build_amplitude_index(hf_list, "AmpF")
+    if len(index) == 0:
+        sys.exit("No events found in the file.")
 
-    sigma_coh_L.append(np.mean(sigma_coh_L_samples))
-    sigma_coh_L_err.append(jk_err(sigma_coh_L_samples))
-    sigma_incoh_L.append(np.mean(sigma_incoh_L_samples))
-    sigma_incoh_L_err.append(jk_err(sigma_incoh_L_samples))
-
-# =========================
-# Finalize
-# =========================
-hf1.close()
-if hf2:
-    hf2.close()
-
-if PLOT_FLAG:
-    plt.tight_layout()
-    outfile = path.join(
-        plot_dir, f"total_cross_sections_{argv[1].split('_')[-1].split('.')[0]}.png"
-    )
-    plt.savefig(outfile)
-
-# =========================
-# Write output file
-# =========================
-source_dir = path.dirname(path.abspath(argv[1]))
-output_file = path.join(source_dir, "total_cross_sections.dat")
-
-with open(output_file, "w") as of:
-    of.write("# x  coh_T[nb]  err_coh_T[nb]  incoh_T[nb]  err_incoh_T[nb]  coh_L[nb]  err_coh_L[nb]  incoh_L[nb]  err_incoh_L[nb] \n")
-    for i, x in enumerate(xList):
-        of.write(
-            f"{float(x):.6e} "
-            f"{sigma_coh_T[i]:.6e} {sigma_coh_T_err[i]:.6e} "
-            f"{sigma_incoh_T[i]:.6e} {sigma_incoh_T_err[i]:.6e} "
-            f"{sigma_coh_L[i]:.6e} {sigma_coh_L_err[i]:.6e} "
-            f"{sigma_incoh_L[i]:.6e} {sigma_incoh_L_err[i]:.6e}\n"
-        )
-
-if PRINT_FLAG:
-    for i, x in enumerate(xList):
-        print(
-            f"x={x}: "
-            f"sigma_coh_T={sigma_coh_T[i]:.4e}±{sigma_coh_T_err[i]:.4e}, "
-            f"sigma_incoh_T={sigma_incoh_T[i]:.4e}±{sigma_incoh_T_err[i]:.4e}, "
-            f"sigma_coh_L={sigma_coh_L[i]:.4e}±{sigma_coh_L_err[i]:.4e}, "
-            f"sigma_incoh_L={sigma_incoh_L[i]:.4e}±{sigma_incoh_L_err[i]:.4e}"
-        )
+    # =========================
+    # Main loop over Q2 and x
+    # =========================
+    source_dir = path.dirname(path.abspath(input_file))
+    Q2_list = get_Q2_list(index)
+    for Q2 in Q2_list:
+        label = ""
+        if len(Q2_list) > 1:
+            label = f"_Q2_{Q2}"
+        plot_file = None
+        if PLOT_FLAG:
+            plot_file = path.join(
+                plot_dir, f"total_cross_sections{label}_{input_file.split('_')[-1].split('.')[0]}.png"
+            )
+        results = compute_cross_sections(hf_list, index, Q2, plot_file)
+        write_cross_sections(
+            path.join(source_dir, f"total_cross_sections{label}.dat"), results)
+
+    for hf in hf_list:
+        hf.close()
+
+
+if __name__ == "__main__":
+    main()
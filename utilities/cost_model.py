@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+    This script predicts the wall time, memory, and disk usage of the
+    events from their parameters, and sizes the job submissions with it.
+
+    The model is linear in a work measure of each stage:
+        IPGlasma:      size^2*(1 + number of JIMWLK snapshots)
+        diffraction:   number of Wilson-line files*len(Q2List)*mcintpoints
+                       *(nbperp*ntheta for AmpF + len(tlist) for Amp)
+    The default coefficients are rough estimates. They are refitted from
+    the resource_usage_*.json files written by simulation_driver.py.
+"""
+
+import sys
+import json
+from glob import glob
+from math import ceil, floor
+import numpy as np
+
+# cost = intercept + slope*work, in core-seconds, kB and bytes
+DEFAULT_COEFFICIENTS = {
+    'ipglasma_cpu': [30., 2e-4],
+    'diffraction_cpu': [5., 2e-7],
+    'ipglasma_mem_kb': [2e5, 3.],
+    'diffraction_mem_kb': [1e5, 0.2],
+    'disk_bytes': [1e6, 150.],
+}
+
+# the work measure used by each quantity of the model
+WORK_OF = {
+    'ipglasma_cpu': 'ipglasma',
+    'diffraction_cpu': 'diffraction',
+    'ipglasma_mem_kb': 'lattice',
+    'diffraction_mem_kb': 'lattice',
+    'disk_bytes': 'wilson_lines',
+}
+
+
+def get_list(value):
+    """This function reads a list parameter, also from an input file"""
+    if isinstance(value, (list, tuple)):
+        return(list(value))
+    if isinstance(value, str):
+        return([item for item in value.split(",") if item.strip() != ""])
+    return([value])
+
+
+def get_cost_features(ipglasma_dict, diffraction_dict):
+    """
+        This function extracts the parameters which set the cost of an
+        event. It accepts the parameter dictionaries as well as the
+        string values read back from the IPGlasma input file.
+    """
+    use_jimwlk = int(float(ipglasma_dict.get('useJIMWLK', 0)))
+    n_snapshots = 0
+    if use_jimwlk > 0 and int(float(ipglasma_dict.get('saveSnapshots', 0))):
+        n_snapshots = len(get_list(ipglasma_dict.get('xSnapshotList', [])))
+    mcintpoints = diffraction_dict.get('mcintpoints', 0)
+    if mcintpoints == "auto":
+        mcintpoints = (diffraction_dict.get('mc_max_points', 10000000)
+                       * diffraction_dict.get('mc_repeats', 4))
+    tlist = get_list(diffraction_dict.get('tlist', []))
+    if tlist == []:
+        tlist = np.arange(float(diffraction_dict.get('mint', 0.)),
+                          float(diffraction_dict.get('maxt', 1.)),
+                          float(diffraction_dict.get('tstep', 0.1)))
+    features = {
+        'size': float(ipglasma_dict.get('size', 720)),
+        'use_jimwlk': use_jimwlk,
+        'n_snapshots': n_snapshots,
+        'n_wilson_lines': 1 + n_snapshots,
+        'mcintpoints': float(mcintpoints),
+        'n_impact': (float(diffraction_dict.get('nbperp', 0))
+                     *float(diffraction_dict.get('ntheta', 0))),
+        'n_t': len(tlist),
+        'n_Q2': len(get_list(diffraction_dict.get('Q2List', [0.]))),
+        'total_cross_section': int(
+            diffraction_dict.get('computeTotalCrossSection', 0) > 0),
+        'analyze_diffraction': int(
+            diffraction_dict.get('analyzeDiffraction', 0) > 0),
+    }
+    return(features)
+
+
+def get_work(features):
+    """This function returns the work measures of an event"""
+    lattice = features['size']**2
+    points_per_file = features['n_Q2']*features['mcintpoints']*(
+        features['total_cross_section']*features['n_impact']
+        + features['analyze_diffraction']*features['n_t'])
+    return({
+        'lattice': lattice,
+        'ipglasma': lattice*(1. + features['n_snapshots']),
+        'diffraction': features['n_wilson_lines']*points_per_file,
+        'wilson_lines': lattice*features['n_wilson_lines'],
+    })
+
+
+def get_event_costs(event_records):
+    """
+        This function sums the resource records of one event from
+        simulation_driver.py into the quantities of the model
+    """
+    costs = {}
+    for stage in ['ipglasma', 'diffraction']:
+        process_list = [record for record in event_records
+                        if record['stage'] == stage
+                        and record['name'] != "driver"]
+        if not process_list:
+            continue
+        costs['{}_cpu'.format(stage)] = sum(
+            [record['user_time'] + record['sys_time']
+             for record in process_list])
+        costs['{}_mem_kb'.format(stage)] = max(
+            [record['max_rss_kb'] for record in process_list])
+        if stage == "ipglasma":
+            costs['disk_bytes'] = sum([record['output_bytes']
+                                       for record in process_list])
+    return(costs)
+
+
+def load_run_history(pattern_list):
+    """
+        This function reads the resource_usage_*.json files matching the
+        patterns and returns a list of (work measures, costs) per event
+    """
+    history = []
+    for pattern in pattern_list:
+        for file_name in sorted(glob(pattern)):
+            with open(file_name, "r") as f:
+                summary = json.load(f)
+            work = get_work(get_cost_features(
+                summary.get('ipglasma_parameters', {}),
+                summary.get('diffraction_parameters', {})))
+            for event_records in summary.get('events', {}).values():
+                costs = get_event_costs(event_records)
+                if costs:
+                    history.append((work, costs))
+    return(history)
+
+
+def calibrate_cost_model(history, coefficients=None):
+    """
+        This function refits the coefficients of the model from the run
+        history. With a single work value only the slope is rescaled, so
+        that the model passes through the measured mean.
+    """
+    model = {key: list(value) for key, value in
+             (coefficients or DEFAULT_COEFFICIENTS).items()}
+    for key, work_name in WORK_OF.items():
+        points = [(work[work_name], costs[key]) for work, costs in history
+                  if key in costs and work[work_name] > 0]
+        if not points:
+            continue
+        x = np.array([point[0] for point in points])
+        y = np.array([point[1] for point in points])
+        if len(np.unique(x)) > 1:
+            A = np.vstack([np.ones(len(x)), x]).T
+            intercept, slope = np.linalg.lstsq(A, y, rcond=None)[0]
+            if slope <= 0.:
+                intercept, slope = 0., np.mean(y)/np.mean(x)
+            model[key] = [max(0., intercept), slope]
+        else:
+            intercept = min(model[key][0], np.mean(y))
+            model[key] = [intercept, (np.mean(y) - intercept)/x[0]]
+    return(model)
+
+
+def predict_event_cost(model, features):
+    """This function predicts the cost of one event"""
+    work = get_work(features)
+    prediction = {}
+    for key, work_name in WORK_OF.items():
+        intercept, slope = model[key]
+        prediction[key] = intercept + slope*work[work_name]
+    return(prediction)
+
+
+def walltime_to_seconds(walltime):
+    """This function converts a HH:MM:SS walltime string to seconds"""
+    seconds = 0
+    for field in walltime.split(":"):
+        seconds = 60*seconds + int(field)
+    return(seconds)
+
+
+def seconds_to_walltime(seconds):
+    """This function converts seconds to a HH:MM:SS walltime string"""
+    seconds = int(ceil(seconds))
+    return("{:02d}:{:02d}:{:02d}".format(seconds//3600, (seconds % 3600)//60,
+                                         seconds % 60))
+
+
+def plan_job(model, features, n_threads, n_events=0,
+             max_walltime="24:00:00", save_ipglasma=False, safety=1.5):
+    """
+        This function sizes a job: the number of events per job (if
+        n_events is 0, as many as fit in max_walltime), the walltime
+        rounded up to 15 minutes, and the memory and disk requests in GB.
+        Unless the IPGlasma results are saved, at most two events of
+        Wilson lines are on disk at a time. The walltime is capped at
+        max_walltime; if the events need more, the plan is flagged as
+        truncated, with the walltime they need.
+    """
+    cost = predict_event_cost(model, features)
+    event_time = (cost['ipglasma_cpu'] + cost['diffraction_cpu'])/n_threads
+    max_seconds = walltime_to_seconds(max_walltime)
+    if n_events <= 0:
+        n_events = max(1, int(floor((max_seconds - 600.)
+                                    /(safety*event_time))))
+    required_seconds = safety*n_events*event_time + 600.
+    seconds = min(max_seconds, 900.*ceil(required_seconds/900.))
+    memory_kb = cost['ipglasma_mem_kb'] + n_threads*cost['diffraction_mem_kb']
+    n_events_on_disk = n_events if save_ipglasma else min(2, n_events)
+    return({
+        'n_events': n_events,
+        'event_time': event_time,
+        'walltime': seconds_to_walltime(seconds),
+        'truncated': seconds < required_seconds,
+        'required_walltime': seconds_to_walltime(
+                                        900.*ceil(required_seconds/900.)),
+        'memory_gb': max(1, int(ceil(safety*memory_kb/1024.**2))),
+        'disk_gb': max(1, int(ceil(safety*n_events_on_disk
+                                   *cost['disk_bytes']/1024.**3))),
+    })
+
+
+def print_truncation_warning(plan):
+    """This function warns that the walltime of a plan is too short"""
+    print("\U0001F6AB  {} events/job need a walltime of {}, ".format(
+          plan['n_events'], plan['required_walltime'])
+          + "more than the {} allowed; the jobs may time out. ".format(
+          plan['walltime'])
+          + "Use fewer events per job.")
+
+
+def plan_job_from_parameters(parameter_dict, n_threads, n_events=0,
+                             history_list=(), max_walltime=None):
+    """
+        This function sizes a job from a user parameter file module and
+        the run history patterns
+    """
+    model = calibrate_cost_model(load_run_history(history_list))
+    features = get_cost_features(parameter_dict.ipglasma_dict,
+                                 parameter_dict.diffraction_dict)
+    if max_walltime is None:
+        max_walltime = parameter_dict.control_dict.get('max_walltime',
+                                                       "24:00:00")
+    save_ipglasma = parameter_dict.control_dict.get('save_ipglasma_results',
+                                                    False)
+    plan = plan_job(model, features, n_threads, n_events, max_walltime,
+                    save_ipglasma)
+    print("\U0001F4B0  Cost model: {:.0f} s/event on {} threads, ".format(
+          plan['event_time'], n_threads)
+          + "{} events/job, walltime {}, {} GB memory, {} GB disk".format(
+          plan['n_events'], plan['walltime'], plan['memory_gb'],
+          plan['disk_gb']))
+    if plan['truncated']:
+        print_truncation_warning(plan)
+    return(plan)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("{0} parameters_dict_user.py n_threads ".format(sys.argv[0])
+              + "[resource_usage_*.json ...]")
+        exit(1)
+    from os import path
+    sys.path.insert(0, path.dirname(path.abspath(sys.argv[1])))
+    PARAMETERS = __import__(sys.argv[1].split('.py')[0].split("/")[-1])
+    plan_job_from_parameters(PARAMETERS, int(sys.argv[2]),
+                             history_list=sys.argv[3:])
@@ -0,0 +1,56 @@
+#!/usr/bin/env bash
+
+# install the mock IPGlasma and subnucleondiffraction executables in the
+# code folder, in place of the code packages from get_code_packages.sh
+
+usage="$0 [codes_folder]"
+
+Green='\033[0;32m'
+NC='\033[0m'
+
+mockFolder=$(cd "$(dirname "${BASH_SOURCE[0]}")"; pwd)
+codesFolder=$1
+if [ -z "$codesFolder" ]
+then
+    codesFolder=${mockFolder}/../../codes
+fi
+if [ ! -d "$codesFolder" ]
+then
+    echo $usage
+    exit 1
+fi
+codesFolder=$(cd $codesFolder; pwd)
+
+# do not overwrite the real code packages
+for code_i in ipglasma_code subnucleondiffraction_code
+do
+    if [ -d ${codesFolder}/${code_i} ] && [ ! -f ${codesFolder}/${code_i}/MOCK_CODE ]
+    then
+        if [ -n "$(ls -A ${codesFolder}/${code_i} | grep -v "\.dat$")" ]
+        then
+            echo "${codesFolder}/${code_i} holds the real code, remove it first"
+            exit 1
+        fi
+    fi
+done
+
+echo -e "${Green}install the mock IPGlasma in ${codesFolder}/ipglasma_code ${NC}"
+mkdir -p ${codesFolder}/ipglasma_code/utilities
+mkdir -p ${codesFolder}/ipglasma_code/nucleusConfigurations
+touch ${codesFolder}/ipglasma_code/MOCK_CODE
+cp ${mockFolder}/ipglasma ${codesFolder}/ipglasma_code/ipglasma
+chmod +x ${codesFolder}/ipglasma_code/ipglasma
+echo "# mock Q_s^2 adjustment table" > ${codesFolder}/ipglasma_code/qs2Adj_vs_Tp_vs_Y_200.in
+
+echo -e "${Green}install the mock subnucleondiffraction in ${codesFolder}/subnucleondiffraction_code ${NC}"
+mkdir -p ${codesFolder}/subnucleondiffraction_code/build/bin
+touch ${codesFolder}/subnucleondiffraction_code/MOCK_CODE
+cp ${mockFolder}/subnucleondiffraction ${codesFolder}/subnucleondiffraction_code/build/bin/subnucleondiffraction
+chmod +x ${codesFolder}/subnucleondiffraction_code/build/bin/subnucleondiffraction
+for wavef_i in gauss-boosted.dat gaus-lc.dat
+do
+    if [ ! -f ${codesFolder}/subnucleondiffraction_code/${wavef_i} ]
+    then
+        echo "# mock vector meson wave function" > ${codesFolder}/subnucleondiffraction_code/${wavef_i}
+    fi
+done
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+    This script packs the saved IPGlasma results (the ipglasma_results_<id>
+    folders with the Wilson lines) into one hdf5 archive, which can be
+    replayed by simulation_driver.py --replay
+"""
+
+import sys
+from os import path, listdir, walk
+import re
+import h5py
+import numpy as np
+
+
+def print_help():
+    """This function outpus help messages"""
+    print("{0} results_folder archive.h5".format(sys.argv[0]))
+
+
+if len(sys.argv) < 3:
+    print_help()
+    exit(1)
+
+RESULTS_FOLDER = path.abspath(str(sys.argv[1]))
+ARCHIVE_NAME = str(sys.argv[2])
+
+n_events = 0
+with h5py.File(ARCHIVE_NAME, "a") as h5f:
+    for root, dir_list, _ in walk(RESULTS_FOLDER, followlinks=True):
+        for dir_i in sorted(dir_list):
+            if re.fullmatch(r"ipglasma_results_(\d+)", dir_i) is None:
+                continue
+            if dir_i in h5f:
+                print("{0} is already in the archive, skip ...".format(dir_i))
+                continue
+            print("processing {0} ... ".format(path.join(root, dir_i)))
+            gtemp = h5f.create_group(dir_i)
+            res_path = path.join(root, dir_i)
+            for file_i in sorted(listdir(res_path)):
+                with open(path.join(res_path, file_i), "rb") as f:
+                    raw_bytes = np.frombuffer(f.read(), dtype=np.uint8)
+                gtemp.create_dataset(file_i, data=raw_bytes,
+                                     compression="gzip", compression_opts=4)
+            n_events += 1
+print("Packed {0} events into {1}".format(n_events, ARCHIVE_NAME))
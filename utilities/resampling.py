@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+    This module estimates the statistical errors of the coherent and
+    incoherent cross sections by resampling the blocks of events of the
+    amplitude accumulators (see amplitude_accumulator.py).
+
+    All the resamples are drawn at once as a weight matrix W of shape
+    (n_samples, n_blocks): 0/1 for the delete-d jackknife and multinomial
+    counts for the bootstrap. As the cross sections are quadratic in the
+    block sums, every resample is then a matrix product:
+        <A>_s         = (W @ block_sums)_s/N_s
+        coherent_s    = |<A>_s|^2
+        incoherent_s  = (W @ block_abs2)_s/N_s - coherent_s
+    and the integral over the (b, theta) grid of |<F>_s|^2 is
+    W_s M W_s^T/N_s^2 with the block overlap matrix
+        M_bc = sum_g w_g (Re F_bg Re F_cg + Im F_bg Im F_cg).
+"""
+
+import numpy as np
+from scipy.integrate import simpson
+
+N_SAMPLES = 5000
+DELETE_FRACTION = 0.2
+MAX_BLOCKS = 500
+
+
+def get_block_size(n_events, max_blocks=MAX_BLOCKS):
+    """
+        This function returns the number of events per block, so that
+        there are at most max_blocks blocks
+    """
+    return(max(1, int(np.ceil(n_events/max_blocks))))
+
+
+def get_resampling_weights(method, n_blocks, n_samples=N_SAMPLES, seed=-1,
+                           delete_fraction=DELETE_FRACTION):
+    """
+        This function draws the weights of the blocks in all the resamples,
+        reproducibly for a given seed (seed = -1: from the system entropy).
+        The delete-d jackknife removes int(delete_fraction*n_blocks) blocks
+        from each resample, the bootstrap draws n_blocks blocks with
+        replacement.
+    """
+    rng = np.random.default_rng(None if seed == -1 else seed)
+    if method == "bootstrap":
+        return(rng.multinomial(n_blocks, np.full(n_blocks, 1./n_blocks),
+                               size=n_samples).astype(np.float64))
+    if method != "jackknife":
+        raise ValueError("Unknown resampling method {}".format(method))
+    delete_n = int(delete_fraction*n_blocks)
+    if delete_n == 0:
+        raise ValueError("Not enough blocks ({}) for the ".format(n_blocks)
+                         + "delete-d jackknife")
+    weights = np.ones((n_samples, n_blocks))
+    deleted = np.argsort(rng.random((n_samples, n_blocks)),
+                         axis=1)[:, :delete_n]
+    np.put_along_axis(weights, deleted, 0., axis=1)
+    return(weights)
+
+
+def get_resampling_error(samples, method, n_blocks,
+                         delete_fraction=DELETE_FRACTION):
+    """
+        This function returns the error from the resampled values along
+        the first axis
+    """
+    if method == "jackknife":
+        delete_n = int(delete_fraction*n_blocks)
+        return(np.sqrt((n_blocks - delete_n)/n_blocks
+                       * np.var(samples, axis=0)))
+    return(np.std(samples, axis=0))
+
+
+def get_quadrature_weights(b_vals, theta_vals):
+    """
+        This function returns the weights w_g of the integral
+        int b db dtheta on the flattened (b, theta) grid, with the Simpson
+        rule of the analysis
+    """
+    w_b = simpson(np.eye(len(b_vals)), x=b_vals, axis=0)*b_vals
+    w_theta = simpson(np.eye(len(theta_vals)), x=theta_vals, axis=0)
+    return(np.outer(w_b, w_theta).flatten())
+
+
+def resample_spectra(accumulator, weights):
+    """
+        This function returns the coherent and incoherent |A|^2 at every
+        grid point of an Amp accumulator for all the resamples, as two
+        arrays of shape (n_samples, n_rows)
+    """
+    n_s = weights @ accumulator.block_n
+    real_mean = (weights @ accumulator.block_sums[:, 0, :])/n_s[:, None]
+    imag_mean = (weights @ accumulator.block_sums[:, 1, :])/n_s[:, None]
+    coherent = real_mean**2 + imag_mean**2
+    incoherent = ((weights @ accumulator.block_abs2[:, 0, :])/n_s[:, None]
+                  - coherent)
+    return(coherent, incoherent)
+
+
+def resample_integrals(accumulator, weights, grid_weights):
+    """
+        This function returns the integrals over the grid of the coherent
+        and incoherent |F|^2 of every complex component of an AmpF
+        accumulator for all the resamples, as two arrays of shape
+        (n_samples, n_components)
+    """
+    n_s = weights @ accumulator.block_n
+    n_components = accumulator.block_abs2.shape[1]
+    coherent = np.zeros((weights.shape[0], n_components))
+    incoherent = np.zeros((weights.shape[0], n_components))
+    for icomp in range(n_components):
+        real_sums = accumulator.block_sums[:, 2*icomp, :]
+        imag_sums = accumulator.block_sums[:, 2*icomp + 1, :]
+        overlap = ((real_sums*grid_weights) @ real_sums.T
+                   + (imag_sums*grid_weights) @ imag_sums.T)
+        coherent[:, icomp] = np.sum((weights @ overlap)*weights,
+                                    axis=1)/n_s**2
+        incoherent[:, icomp] = (
+            weights @ (accumulator.block_abs2[:, icomp, :] @ grid_weights)
+            )/n_s - coherent[:, icomp]
+    return(coherent, incoherent)
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+    This script finds the events of a production which are missing or
+    invalid, and prepares a compact resubmission covering only them.
+
+    The expected event ids are read from the job folders of the working
+    folder (jobs_manifest.json, or the submit_job.script of every folder).
+    For a replay production, the jobs take the archived events by
+    position, and their ids are read from the archive.
+    An event is valid if its group in a RESULTS_*.h5 file, or its
+    EVENT_RESULTS_*/event_*.h5 file, can be read and is not empty. Merged
+    RESULTS files moved elsewhere can be added with --results.
+
+    The missing events are packed into rerun_<n> folders, as many per job
+    as the cost model fits in the walltime, and a Slurm array
+    (submit_rerun.script) or an HTCondor submit file (rerun.sub) running
+    these folders is written to the working folder, one per number of
+    threads (submit_rerun_<n>threads.script) if the jobs differ. The
+    driver runs exactly the listed events with --event_ids.
+"""
+
+import sys
+import argparse
+import json
+import os
+import re
+from glob import glob
+from os import path, mkdir
+import h5py
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..",
+                             "codes"))
+from cost_model import (calibrate_cost_model, get_cost_features,
+                        load_run_history, plan_job, print_truncation_warning)
+from simulation_driver import list_replay_archive, parse_event_ids
+
+DRIVER_PATTERN = re.compile(
+    r"simulation_driver\.py (\S+) (-?\d+) (\d+) (\d+) (\S+)")
+
+# sorted event ids of the replay archives, which are listed once
+REPLAY_ARCHIVES = {}
+
+
+def get_replay_event_ids(archive):
+    """This function returns the sorted event ids of a replay archive"""
+    if archive not in REPLAY_ARCHIVES:
+        REPLAY_ARCHIVES[archive] = sorted(list_replay_archive(archive).keys())
+    return(REPLAY_ARCHIVES[archive])
+
+
+def get_job_event_ids(event_id0, n_events, driver_options=""):
+    """
+        This function returns the ids of the events of a job from the
+        arguments and options of its simulation_driver.py call. A replay
+        job takes the archived events by position, or by --event_ids.
+    """
+    event_ids_match = re.search(r"--event_ids (\S+)", driver_options)
+    if event_ids_match is not None:
+        return(parse_event_ids(event_ids_match.group(1)))
+    replay_match = re.search(r"--replay (\S+)", driver_options)
+    if replay_match is not None:
+        return(get_replay_event_ids(replay_match.group(1))[
+                                        event_id0:event_id0 + n_events])
+    return(list(range(event_id0, event_id0 + n_events)))
+
+
+def get_expected_events(work_folder):
+    """
+        This function returns a dictionary event id -> job folder of all
+        the events of the production
+    """
+    expected_events = {}
+    manifest_file = path.join(work_folder, "jobs_manifest.json")
+    if path.isfile(manifest_file):
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+        for job_i in manifest['jobs']:
+            folder = path.join(work_folder, "event_{}".format(job_i[0]))
+            for iev in get_job_event_ids(job_i[1], job_i[2],
+                                         manifest.get('driver_options', "")):
+                expected_events[iev] = folder
+        return(expected_events)
+    for folder in glob(path.join(work_folder, "event_*")):
+        for iev in read_job_event_ids(folder):
+            expected_events[iev] = folder
+    return(expected_events)
+
+
+def read_driver_command(folder):
+    """
+        This function returns the arguments of the simulation_driver.py
+        call in the submit_job.script of a job folder, followed by the
+        rest of the line with its options
+    """
+    script_name = path.join(folder, "submit_job.script")
+    if not path.isfile(script_name):
+        return(None)
+    with open(script_name, "r") as f:
+        driver_match = DRIVER_PATTERN.search(f.read())
+    if driver_match is None:
+        return(None)
+    options = driver_match.string[driver_match.end():].split("\n")[0]
+    return(driver_match.groups() + (options,))
+
+
+def read_job_event_ids(folder):
+    """
+        This function returns the ids of the events of a job folder, from
+        its submit_job.script
+    """
+    driver_args = read_driver_command(folder)
+    if driver_args is None:
+        return([])
+    return(get_job_event_ids(int(driver_args[1]), int(driver_args[2]),
+                             driver_args[5]))
+
+
+def check_results_file(file_name, valid_events):
+    """
+        This function adds the ids of the valid event groups of a results
+        file to valid_events
+    """
+    try:
+        with h5py.File(file_name, "r") as h5f:
+            for group_name in h5f.keys():
+                # merged files may append letters to conflicting names
+                group_match = re.fullmatch(r"event_(\d+)[a-z]*", group_name)
+                if group_match is not None and len(h5f[group_name]) > 0:
+                    valid_events.add(int(group_match.group(1)))
+    except (OSError, KeyError) as e:
+        print("\U0001F6AB  Can not read {}: {}".format(file_name, e))
+
+
+def get_valid_events(work_folder, results_list=()):
+    """This function returns the set of the valid event ids"""
+    valid_events = set()
+    file_list = list(results_list)
+    for folder in (glob(path.join(work_folder, "event_*"))
+                   + glob(path.join(work_folder, "rerun_*"))):
+        file_list += glob(path.join(folder, "RESULTS_*.h5"))
+        file_list += glob(path.join(folder, "EVENT_RESULTS_*",
+                                    "event_*.h5"))
+    for file_name in file_list:
+        check_results_file(file_name, valid_events)
+    return(valid_events)
+
+
+def format_event_ids(event_id_list):
+    """This function writes a sorted id list compactly, e.g. 3,7,10-12"""
+    fields = []
+    id_start = id_end = None
+    for iev in event_id_list + [None]:
+        if id_end is not None and iev == id_end + 1:
+            id_end = iev
+            continue
+        if id_start is not None:
+            fields.append(str(id_start) if id_start == id_end
+                          else "{}-{}".format(id_start, id_end))
+        id_start = id_end = iev
+    return(",".join(fields))
+
+
+def read_event_parameters(folder):
+    """This function reads the model parameters of a job folder"""
+    ipglasma_dict = {}
+    input_file = path.join(folder, "ipglasma", "input")
+    if path.isfile(input_file):
+        with open(input_file, "r") as f:
+            for line_i in f:
+                fields = line_i.split()
+                if len(fields) == 2:
+                    ipglasma_dict[fields[0]] = fields[1]
+    diffraction_dict = {}
+    diffraction_file = path.join(folder, "subnucleondiffraction",
+                                 "diffraction_parameters.json")
+    if path.isfile(diffraction_file):
+        with open(diffraction_file, "r") as f:
+            diffraction_dict = json.load(f)
+    return(ipglasma_dict, diffraction_dict)
+
+
+def get_template_key(folder):
+    """
+        This function returns the key of the job folder setup (inputs and
+        number of threads), events with the same key can be packed into
+        the same job
+    """
+    driver_args = read_driver_command(folder)
+    n_threads = driver_args[3] if driver_args is not None else ""
+    return((path.realpath(path.join(folder, "ipglasma", "input")), n_threads))
+
+
+def create_rerun_folder(template_folder, rerun_folder, event_id_list):
+    """
+        This function creates a job folder for the events in event_id_list
+        from the job folder template_folder: the codes and inputs are
+        linked, and the driver runs exactly these events
+    """
+    mkdir(rerun_folder)
+    for entry_i in ["simulation_driver.py", "run_ipglasma.sh",
+                    "run_subnucleondiffraction.sh"]:
+        source = path.join(template_folder, entry_i)
+        if path.exists(source):
+            os.symlink(path.realpath(source), path.join(rerun_folder,
+                                                        entry_i))
+    for code_folder in ["ipglasma", "subnucleondiffraction"]:
+        if not path.isdir(path.join(template_folder, code_folder)):
+            continue
+        mkdir(path.join(rerun_folder, code_folder))
+        for entry_i in os.listdir(path.join(template_folder, code_folder)):
+            source = path.join(template_folder, code_folder, entry_i)
+            # only the links and the parameter files, not the outputs of
+            # an interrupted run
+            if (path.islink(source)
+                    or entry_i in ("input", "diffraction_parameters.json")):
+                os.symlink(path.realpath(source),
+                           path.join(rerun_folder, code_folder, entry_i))
+
+    with open(path.join(template_folder, "submit_job.script"), "r") as f:
+        script = f.read()
+    # the job script may cd to its own folder
+    for folder_i in set([template_folder, path.realpath(template_folder)]):
+        script = script.replace(folder_i, rerun_folder)
+    event_ids_str = format_event_ids(event_id_list)
+    script = DRIVER_PATTERN.sub(
+        lambda m: "simulation_driver.py {} {} {} {} {} --event_ids {}".format(
+            m.group(1), event_id_list[0], len(event_id_list), m.group(4),
+            m.group(5), event_ids_str), script)
+    with open(path.join(rerun_folder, "submit_job.script"), "w") as f:
+        f.write(script)
+
+
+def plan_rerun_jobs(template_folder, n_threads, history_list,
+                    n_events_per_job=0, max_walltime="24:00:00"):
+    """
+        This function sizes the rerun jobs with the cost model, calibrated
+        with the resource usage of the production itself
+    """
+    model = calibrate_cost_model(load_run_history(history_list))
+    ipglasma_dict, diffraction_dict = read_event_parameters(template_folder)
+    features = get_cost_features(ipglasma_dict, diffraction_dict)
+    return(plan_job(model, features, n_threads, n_events_per_job,
+                    max_walltime))
+
+
+def write_slurm_array(work_folder, rerun_index_list, n_threads, job_plan,
+                      suffix=""):
+    """This function writes the Slurm array of the rerun folders"""
+    file_name = "submit_rerun{}.script".format(suffix)
+    with open(path.join(work_folder, file_name), "w") as f:
+        f.write("""#!/usr/bin/env bash
+#SBATCH --job-name rerun
+#SBATCH --array={0:s}
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task={1:d}
+#SBATCH --mem={2:d}G
+#SBATCH -t {3:s}
+#SBATCH -o log/rerun_%a.log
+
+cd {4:s}/rerun_${{SLURM_ARRAY_TASK_ID}}
+bash submit_job.script
+""".format(format_event_ids(rerun_index_list), n_threads,
+           job_plan['memory_gb'], job_plan['walltime'], work_folder))
+    return(file_name)
+
+
+def write_condor_submit(work_folder, rerun_index_list, n_threads, job_plan,
+                        suffix=""):
+    """This function writes the HTCondor submit file of the rerun folders"""
+    file_name = "rerun{}.sub".format(suffix)
+    with open(path.join(work_folder, file_name), "w") as f:
+        f.write("""universe = vanilla
+executable = /bin/bash
+arguments = submit_job.script
+should_transfer_files = NO
+
+error = ../log/rerun.$(Cluster).$(Process).error
+output = ../log/rerun.$(Cluster).$(Process).output
+log = ../log/rerun.log
+
+request_cpus = {0:d}
+request_memory = {1:d} GB
+request_disk = {2:d} GB
+
+queue initialdir from (
+{3:s}
+)
+""".format(n_threads, job_plan['memory_gb'], job_plan['disk_gb'],
+           "\n".join(["rerun_{}".format(i) for i in rerun_index_list])))
+    return(file_name)
+
+
+def main():
+    """This is the main function"""
+    parser = argparse.ArgumentParser(
+        description='\U0001F504 Resubmit only the missing events',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('work_folder', type=str,
+                        help='working folder generated by generate_jobs.py')
+    parser.add_argument('--results', type=str, nargs='*', default=[],
+                        help='merged RESULTS files with finished events')
+    parser.add_argument('--format', type=str, choices=['slurm', 'condor'],
+                        default='slurm', help='submission format')
+    parser.add_argument('--n_events_per_job', type=int, default=0,
+                        help='events per job (0: chosen by the cost model)')
+    parser.add_argument('--max_walltime', type=str, default="24:00:00",
+                        help='longest walltime of a rerun job')
+    parser.add_argument('--cost_history', type=str, nargs='*', default=[],
+                        help=('additional resource_usage_*.json files to '
+                              + 'calibrate the cost model'))
+    parser.add_argument('--dry_run', action='store_true',
+                        help='only report the missing events')
+    args = parser.parse_args()
+
+    work_folder = path.abspath(args.work_folder)
+    expected_events = get_expected_events(work_folder)
+    valid_events = get_valid_events(work_folder, args.results)
+    missing_list = sorted(set(expected_events.keys()) - valid_events)
+    print("\U0001F50D  {} events expected, {} valid, {} missing".format(
+          len(expected_events), len(valid_events & set(expected_events)),
+          len(missing_list)))
+    if missing_list:
+        print("Missing events: {}".format(format_event_ids(missing_list)))
+    if args.dry_run or not missing_list:
+        return
+
+    # the events of job folders with the same setup are packed together
+    group_dict = {}
+    for iev in missing_list:
+        key = get_template_key(expected_events[iev])
+        group_dict.setdefault(key, []).append(iev)
+
+    history_list = args.cost_history + [
+        path.join(work_folder, "*", "resource_usage_*.json")]
+    irerun = 0
+    # the rerun folders and the job plan of each number of threads
+    rerun_arrays = {}
+    rerun_manifest = {}
+    manifest_file = path.join(work_folder, "rerun_manifest.json")
+    if path.isfile(manifest_file):
+        with open(manifest_file, "r") as f:
+            rerun_manifest = json.load(f)
+    for event_id_list in group_dict.values():
+        template_folder = expected_events[event_id_list[0]]
+        driver_args = read_driver_command(template_folder)
+        if driver_args is None:
+            print("\U0001F6AB  No driver command in {}, skip {}".format(
+                  template_folder, format_event_ids(event_id_list)))
+            continue
+        n_threads = int(driver_args[3])
+        job_plan = plan_rerun_jobs(template_folder, n_threads, history_list,
+                                   args.n_events_per_job, args.max_walltime)
+        # balance the events over the jobs and size the walltime for them
+        n_jobs = -(-len(event_id_list)//job_plan['n_events'])
+        n_per_job = -(-len(event_id_list)//n_jobs)
+        job_plan = plan_rerun_jobs(template_folder, n_threads, history_list,
+                                   n_per_job, args.max_walltime)
+        if job_plan['truncated']:
+            print_truncation_warning(job_plan)
+        if n_threads not in rerun_arrays:
+            rerun_arrays[n_threads] = {'index_list': [],
+                                       'plan': dict(job_plan)}
+        array_plan = rerun_arrays[n_threads]['plan']
+        for key in ['walltime', 'memory_gb', 'disk_gb']:
+            array_plan[key] = max(array_plan[key], job_plan[key])
+        array_plan['truncated'] |= job_plan['truncated']
+        for i in range(0, len(event_id_list), n_per_job):
+            while path.exists(path.join(work_folder,
+                                        "rerun_{}".format(irerun))):
+                irerun += 1
+            create_rerun_folder(
+                template_folder,
+                path.join(work_folder, "rerun_{}".format(irerun)),
+                event_id_list[i:i + n_per_job])
+            rerun_manifest["rerun_{}".format(irerun)] = (
+                event_id_list[i:i + n_per_job])
+            rerun_arrays[n_threads]['index_list'].append(irerun)
+
+    if not rerun_arrays:
+        return
+    if not path.exists(path.join(work_folder, "log")):
+        mkdir(path.join(work_folder, "log"))
+    with open(manifest_file, "w") as f:
+        json.dump(rerun_manifest, f, indent=4)
+    # the jobs of an array share their --cpus-per-task (request_cpus)
+    for n_threads, rerun_array in sorted(rerun_arrays.items()):
+        suffix = ""
+        if len(rerun_arrays) > 1:
+            suffix = "_{}threads".format(n_threads)
+        if args.format == "slurm":
+            file_name = write_slurm_array(work_folder,
+                                          rerun_array['index_list'],
+                                          n_threads, rerun_array['plan'],
+                                          suffix)
+        else:
+            file_name = write_condor_submit(work_folder,
+                                            rerun_array['index_list'],
+                                            n_threads, rerun_array['plan'],
+                                            suffix)
+        array_plan = rerun_array['plan']
+        print("\U0001F504  {} jobs with {} threads, walltime {}, ".format(
+              len(rerun_array['index_list']), n_threads,
+              array_plan['walltime']) + "see {}".format(file_name))
+        if array_plan['truncated']:
+            print("\U0001F6AB  The walltime {} is capped by ".format(
+                  array_plan['walltime'])
+                  + "--max_walltime, some rerun jobs may time out again")
+    print("\U0001F504  {} missing events in {} jobs".format(
+          len(missing_list), sum([len(rerun_array['index_list'])
+                                  for rerun_array in rerun_arrays.values()])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+    This script runs the generated job folders of a working folder on the
+    local machine, with as many jobs at a time as the cores and the memory
+    allow. It shows the progress and the time of every finished event.
+
+    The resume semantics are those of the driver: a job whose events all
+    have their event_<id>.h5 is skipped, and the finished events of the
+    other jobs are not rerun. Interrupting (Ctrl-C) stops the running jobs,
+    which merge their finished events; running the script again resumes.
+
+    Usage: run_local_jobs.py workFolder [-j n_workers] [--mem_per_job GB]
+"""
+
+import sys
+import argparse
+import json
+import os
+import re
+import signal
+import subprocess
+import time
+from glob import glob
+from os import path
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+from resubmit_missing_events import (format_event_ids, plan_rerun_jobs,
+                                     read_driver_command, read_job_event_ids)
+
+
+def get_finished_events(folder, event_id_list):
+    """This function returns the events of a job with their event_<id>.h5"""
+    return([iev for iev in event_id_list
+            if path.exists(path.join(folder, "EVENT_RESULTS_{}".format(iev),
+                                     "event_{}.h5".format(iev)))])
+
+
+def get_available_memory_gb():
+    """This function returns the available memory of the machine in GB"""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line_i in f:
+                if line_i.startswith("MemAvailable:"):
+                    return(float(line_i.split()[1])/1024.**2)
+    except OSError:
+        pass
+    return(float("inf"))
+
+
+def get_n_cores():
+    """This function returns the number of cores this process may use"""
+    if hasattr(os, "sched_getaffinity"):
+        return(len(os.sched_getaffinity(0)))
+    return(os.cpu_count() or 1)
+
+
+def get_n_workers(n_threads, mem_per_job):
+    """
+        This function sizes the pool: the jobs may not use more cores or
+        memory than the machine has
+    """
+    n_by_cores = max(1, get_n_cores()//max(1, n_threads))
+    n_by_memory = max(1, int(get_available_memory_gb()//max(mem_per_job,
+                                                             1e-3)))
+    return(min(n_by_cores, n_by_memory))
+
+
+class LocalJob:
+    """This class keeps the state of one job folder run locally"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.name = path.basename(folder)
+        self.event_id_list = read_job_event_ids(folder)
+        self.finished = set(get_finished_events(folder, self.event_id_list))
+        self.proc = None
+        self.start_time = None
+        self.last_time = None
+
+    def is_complete(self):
+        """This function checks whether all the events have finished"""
+        return(len(self.finished) == len(self.event_id_list))
+
+    def start(self, env):
+        """This function starts the job script in its folder"""
+        self.start_time = self.last_time = time.time()
+        with open(path.join(self.folder, "local_run.log"), "a") as log:
+            self.proc = subprocess.Popen(["bash", "submit_job.script"],
+                                         cwd=self.folder, env=env,
+                                         stdout=log, stderr=log,
+                                         start_new_session=True)
+
+    def poll_events(self):
+        """
+            This function returns the newly finished events of the job,
+            with the time since the previous one
+        """
+        event_times = []
+        for iev in get_finished_events(self.folder, self.event_id_list):
+            if iev in self.finished:
+                continue
+            now = time.time()
+            event_times.append((iev, now - self.last_time))
+            self.last_time = now
+            self.finished.add(iev)
+        return(event_times)
+
+    def stop(self):
+        """This function asks the driver to stop and merge its results"""
+        if self.proc is not None and self.proc.poll() is None:
+            os.killpg(self.proc.pid, signal.SIGTERM)
+
+
+def print_progress(n_done, n_running, n_queued, n_events_done, n_events,
+                   event_times, start_time):
+    """This function prints a progress line"""
+    elapsed = time.time() - start_time
+    eta = ""
+    if n_events_done > 0 and n_events > n_events_done:
+        eta = ", ETA {:.0f} s".format(
+            elapsed/n_events_done*(n_events - n_events_done))
+    mean_time = ""
+    if event_times:
+        mean_time = ", {:.1f} s/event".format(
+            sum(event_times)/len(event_times))
+    sys.stdout.write("\r\U0001F3CE  jobs: {} done, {} running, {} queued | "
+                     "events: {}/{}{}{}   ".format(
+                         n_done, n_running, n_queued, n_events_done,
+                         n_events, mean_time, eta))
+    sys.stdout.flush()
+
+
+def run_local_jobs(work_folder, pattern="event_*", n_workers=0,
+                   mem_per_job=0., poll_interval=2.):
+    """
+        This function runs the job folders matching pattern with a pool of
+        n_workers processes (0: sized to the cores and memory). It returns
+        the number of failed jobs.
+    """
+    job_list = [LocalJob(folder) for folder in sorted(
+                glob(path.join(work_folder, pattern)),
+                key=lambda folder: int(re.findall(r"\d+", folder)[-1]))
+                if path.isfile(path.join(folder, "submit_job.script"))]
+    if not job_list:
+        print("\U0001F6AB  No job folders {} in {}".format(pattern,
+                                                          work_folder))
+        return(0)
+    n_events = sum([len(job.event_id_list) for job in job_list])
+    queue = [job for job in job_list if not job.is_complete()]
+    n_done = len(job_list) - len(queue)
+
+    n_threads = int(read_driver_command(job_list[0].folder)[3])
+    if mem_per_job <= 0.:
+        mem_per_job = plan_rerun_jobs(
+            job_list[0].folder, n_threads,
+            [path.join(work_folder, "*", "resource_usage_*.json")],
+            1)['memory_gb']
+    if n_workers <= 0:
+        n_workers = get_n_workers(n_threads, mem_per_job)
+    print("\U0001F3CE  {} jobs ({} already finished) on {} workers, ".format(
+          len(job_list), n_done, n_workers)
+          + "{} threads and {} GB per job".format(n_threads, mem_per_job))
+
+    # no need to stagger the IPGlasma starts on a local disk
+    env = dict(os.environ, IPGLASMA_STAGGER="0")
+    running = []
+    event_times = []
+    n_failed = 0
+    start_time = time.time()
+    try:
+        while queue or running:
+            while queue and len(running) < n_workers:
+                job = queue.pop(0)
+                job.start(env)
+                running.append(job)
+            time.sleep(poll_interval)
+            for job in list(running):
+                new_events = job.poll_events()
+                for iev, duration in new_events:
+                    event_times.append(duration)
+                    sys.stdout.write("\r\U00002705  event {} finished in "
+                                     "{:.1f} s ({}){}\n".format(
+                                         iev, duration, job.name, " "*20))
+                if job.proc.poll() is not None:
+                    running.remove(job)
+                    n_done += 1
+                    if job.proc.returncode != 0 or not job.is_complete():
+                        n_failed += 1
+                        print("\r\U0001F6AB  {} exited with status {}, "
+                              "{} events missing".format(
+                                  job.name, job.proc.returncode,
+                                  len(job.event_id_list) - len(job.finished)))
+            n_events_done = sum([len(job.finished) for job in job_list])
+            print_progress(n_done, len(running), len(queue), n_events_done,
+                           n_events, event_times, start_time)
+    except KeyboardInterrupt:
+        print("\n\U0001F6A6  Stopping the running jobs, run again to resume")
+        for job in running:
+            job.stop()
+        for job in running:
+            job.proc.wait()
+    sys.stdout.write("\n")
+
+    summary = {
+        'elapsed': time.time() - start_time,
+        'n_workers': n_workers,
+        'n_jobs': len(job_list),
+        'n_failed_jobs': n_failed,
+        'event_times': event_times,
+        'missing_events': format_event_ids(sorted(
+            [iev for job in job_list for iev in job.event_id_list
+             if iev not in job.finished])),
+    }
+    if event_times:
+        print("\U0001F3CE  {} events in {:.1f} s: {:.1f} s/event ".format(
+              len(event_times), summary['elapsed'],
+              sum(event_times)/len(event_times))
+              + "(min {:.1f} s, max {:.1f} s)".format(min(event_times),
+                                                      max(event_times)))
+    with open(path.join(work_folder, "local_run_summary.json"), "w") as f:
+        json.dump(summary, f, indent=4)
+    return(n_failed)
+
+
+def main():
+    """This is the main function"""
+    parser = argparse.ArgumentParser(
+        description='\U0001F3CE Run the job folders on the local machine',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('work_folder', type=str,
+                        help='working folder generated by generate_jobs.py')
+    parser.add_argument('-j', '--n_workers', type=int, default=0,
+                        help='jobs run at a time (0: from cores and memory)')
+    parser.add_argument('--mem_per_job', type=float, default=0.,
+                        help='memory per job in GB (0: from the cost model)')
+    parser.add_argument('--pattern', type=str, default="event_*",
+                        help='glob pattern of the job folders')
+    parser.add_argument('--poll', type=float, default=2.,
+                        help='seconds between two progress updates')
+    args = parser.parse_args()
+    n_failed = run_local_jobs(path.abspath(args.work_folder), args.pattern,
+                              args.n_workers, args.mem_per_job, args.poll)
+    exit(1 if n_failed > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()